@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""Usage: bench_codecs.py <dir> [--threads=<n>] [--codecs=<names>]
+
+Compare archive codecs on a built tree (e.g. a build path left behind by `bob build`):
+compression time, decompression time and compression ratio.
+
+"baseline" is the single-threaded tarfile 'w:gz' archiving bob used before codecs were pluggable.
+
+Options:
+    -h --help
+    --threads=<n>  compression threads, defaults to all cores.
+    --codecs=<names>  comma-separated codecs to compare [default: baseline,gzip,xz,zstd].
+"""
+import os
+import shutil
+import sys
+import tarfile
+import time
+from tempfile import mkdtemp
+
+from docopt import docopt
+
+from bob.compression import CODECS
+from bob.utils import archive_tree, extract_tree, tree_size
+
+
+def baseline_archive(dir, archive):
+    with tarfile.open(archive, 'w:gz') as tar:
+        for item in os.listdir(dir):
+            tar.add(dir+"/"+item, arcname=item)
+
+
+def bench(dir, codec, threads, workdir):
+    archive = os.path.join(workdir, 'archive')
+    target = os.path.join(workdir, 'extracted')
+
+    started = time.time()
+    if codec == 'baseline':
+        baseline_archive(dir, archive)
+    else:
+        archive_tree(dir, archive, codec=codec, threads=threads)
+    compress_time = time.time() - started
+
+    started = time.time()
+    extract_tree(archive, target)
+    decompress_time = time.time() - started
+
+    archive_size = os.path.getsize(archive)
+    os.remove(archive)
+    shutil.rmtree(target)
+
+    return compress_time, decompress_time, archive_size
+
+
+def main():
+    args = docopt(__doc__)
+    dir = args['<dir>']
+    threads = int(args['--threads']) if args['--threads'] else None
+    codecs = args['--codecs'].split(',')
+
+    size = tree_size(dir)
+    print('{}: {:.1f} MB, {} threads'.format(dir, size / 1024 / 1024, threads or os.cpu_count()))
+    print('{:<10} {:>12} {:>12} {:>8}'.format('codec', 'compress', 'decompress', 'ratio'))
+
+    workdir = mkdtemp(prefix='bob-bench-')
+    try:
+        for codec in codecs:
+            if codec != 'baseline' and not CODECS[codec].available:
+                print('{:<10} (not available)'.format(codec))
+                continue
+
+            compress_time, decompress_time, archive_size = bench(dir, codec, threads, workdir)
+            print('{:<10} {:>11.2f}s {:>11.2f}s {:>8.2f}'.format(
+                codec, compress_time, decompress_time, size / archive_size if archive_size else 0))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""Usage: bench_suite.py run [--output=<file>] [--endpoint=<url>] [--scale=<factor>] [--repeat=<n>] [--only=<groups>] [--codec=<name>]
+       bench_suite.py compare <baseline> <candidate> [--tolerance=<percent>]
+
+Benchmark bob's I/O hot paths against a local S3 stand-in.
+
+The groups are:
+    archive    archive_tree and extract_tree throughput on synthetic build trees
+    wildcard   wildcard dependency resolution latency as the number of keys grows, with and without the key index
+    build      end-to-end `bob deploy` of dependencies and `bob build` of a formula depending on them, cold and warm cache
+
+Without --endpoint, an in-process moto server (pip install 'moto[server]') is started on a free localhost port.
+Results are written as JSON; compare prints the change of every result two runs have in common.
+
+Options:
+    -h --help
+    --output=<file>  where to write the results [default: bench-results.json].
+    --endpoint=<url>  S3-compatible endpoint to use, e.g. http://127.0.0.1:9000 for a local MinIO.
+    --scale=<factor>  multiplies the number and size of generated files [default: 1].
+    --repeat=<n>  runs of each benchmark; results are the median [default: 3].
+    --only=<groups>  comma-separated groups to run [default: archive,wildcard,build].
+    --codec=<name>  archive codec to benchmark [default: gzip].
+    --tolerance=<percent>  changes smaller than this are reported as unchanged [default: 5].
+"""
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkdtemp
+
+from docopt import docopt
+
+from bob.index import KeyIndex
+from bob.utils import archive_tree, extract_tree, get_with_wildcard, tree_size
+
+BUCKET = 'bob-bench'
+MB = 1024 * 1024
+
+WORDS = [b'static', b'inline', b'const', b'struct', b'return', b'#include', b'define', b'unsigned', b'PyObject',
+         b'void', b'char', b'size_t', b'if', b'else', b'for', b'NULL', b'(', b')', b'{', b'}', b';', b'\n']
+
+
+def small_file(rng, size):
+    """Compressible, source-like content (headers, bytecode)."""
+    return b' '.join(rng.choice(WORDS) for _ in range(size // 5))[:size]
+
+
+def large_file(rng, size):
+    """Shared object-like content: a mix of incompressible and repetitive blocks."""
+    blocks = []
+    for offset in range(0, size, MB):
+        length = min(MB, size - offset)
+        blocks.append(rng.randbytes(length) if rng.random() < 0.5 else small_file(rng, length))
+    return b''.join(blocks)
+
+
+def tree_specs(scale):
+    """Returns {name: (small file count, large file count, large file size)} for the synthetic build trees."""
+    return {
+        'small-files': (int(4000 * scale), 0, 0),
+        'large-files': (0, 3, int(24 * MB * scale)),
+        'mixed': (int(1000 * scale), 1, int(24 * MB * scale)),
+    }
+
+
+def make_tree(path, spec, seed=0):
+    rng = random.Random(seed)
+    small_count, large_count, large_size = spec
+
+    for i in range(small_count):
+        # a spread of directories, like include/, lib/python3.x/site-packages/... and share/
+        dir = os.path.join(path, 'lib', 'pkg{}'.format(i % 40), 'sub{}'.format(i % 7))
+        os.makedirs(dir, exist_ok=True)
+        with open(os.path.join(dir, 'file{}.{}'.format(i, rng.choice(['h', 'pyc', 'py', 'txt']))), 'wb') as f:
+            f.write(small_file(rng, rng.randint(512, 16 * 1024)))
+
+    for i in range(large_count):
+        os.makedirs(os.path.join(path, 'lib'), exist_ok=True)
+        with open(os.path.join(path, 'lib', 'libbig{}.so'.format(i)), 'wb') as f:
+            f.write(large_file(rng, large_size))
+
+    os.makedirs(os.path.join(path, 'bin'), exist_ok=True)
+    os.symlink('../lib', os.path.join(path, 'bin', 'lib'))
+
+
+def timed(fn, repeat, setup=None):
+    """Runs fn repeat times (after setup, untimed) and returns the wall times."""
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.time()
+        fn()
+        runs.append(time.time() - started)
+    return runs
+
+
+def result(runs, bytes=None, **details):
+    entry = {'seconds': statistics.median(runs), 'runs': runs}
+    if bytes is not None:
+        entry['bytes'] = bytes
+        entry['mb_per_s'] = bytes / MB / entry['seconds'] if entry['seconds'] else None
+    entry.update(details)
+    return entry
+
+
+def report(name, entry):
+    line = '{:<40} {:>9.3f}s'.format(name, entry['seconds'])
+    if entry.get('mb_per_s'):
+        line += ' {:>9.1f} MB/s'.format(entry['mb_per_s'])
+    print(line)
+    sys.stdout.flush()
+
+
+def bench_archive(workdir, trees, codec, repeat):
+    results = {}
+
+    for name, tree in trees.items():
+        size = tree_size(tree)
+        archive = os.path.join(workdir, 'archive')
+        target = os.path.join(workdir, 'extracted')
+
+        runs = timed(lambda: archive_tree(tree, archive, codec=codec), repeat)
+        results['archive/{}/{}'.format(codec, name)] = result(
+            runs, bytes=size, archive_size=os.path.getsize(archive), ratio=size / os.path.getsize(archive))
+
+        runs = timed(lambda: extract_tree(archive, target), repeat,
+                     setup=lambda: shutil.rmtree(target, ignore_errors=True))
+        results['extract/{}/{}'.format(codec, name)] = result(runs, bytes=size)
+
+        shutil.rmtree(target, ignore_errors=True)
+        os.remove(archive)
+
+    for name, entry in results.items():
+        report(name, entry)
+    return results
+
+
+def bench_wildcard(workdir, s3, scale, repeat):
+    bucket = s3.Bucket(BUCKET)
+    results = {}
+
+    for count in [10, 100, 1000, 5000]:
+        count = max(int(count * scale), 1)
+        prefix = 'wildcard-{}/'.format(count)
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(lambda i: bucket.put_object(Key='{}lib-1.{}.{}.tar.gz'.format(prefix, i // 100, i % 100), Body=b'x'),
+                          range(count)))
+        pattern = '{}lib-1.*.tar.gz'.format(prefix)
+
+        def resolve(index=None):
+            # e_tag is what callers need next; without the index, it costs a HEAD request
+            return get_with_wildcard(bucket, pattern, index=index).e_tag
+
+        results['wildcard/list/{}'.format(count)] = result(timed(resolve, repeat))
+
+        index_path = os.path.join(workdir, 'index')
+        results['wildcard/index-cold/{}'.format(count)] = result(timed(
+            lambda: resolve(KeyIndex(index_path, ttl=3600)), repeat,
+            setup=lambda: shutil.rmtree(index_path, ignore_errors=True)))
+        results['wildcard/index-warm/{}'.format(count)] = result(timed(
+            lambda: resolve(KeyIndex(index_path, ttl=3600)), repeat))
+
+    for name, entry in results.items():
+        report(name, entry)
+    return results
+
+
+def run_bob(args, env, report_path):
+    started = time.time()
+    subprocess.run([sys.executable, '-m', 'bob'] + args + ['--report={}'.format(report_path)],
+                   env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.time() - started
+
+    with open(report_path) as f:
+        phases = json.load(f)['phases']
+    return elapsed, phases
+
+
+def bench_build(workdir, trees, env, codec, repeat):
+    """Deploys a library formula per tree, then builds a formula depending on all of them."""
+    workspace = os.path.join(workdir, 'workspace')
+    os.makedirs(os.path.join(workspace, 'libraries'))
+    os.makedirs(os.path.join(workspace, 'runtimes'))
+
+    env = dict(env, WORKSPACE_DIR=workspace, BOB_ARCHIVE_CODEC=codec, BOB_HISTORY_PATH='', BOB_INDEX_TTL='0')
+    report_path = os.path.join(workdir, 'report.json')
+    results = {}
+    deps = []
+
+    for name, tree in trees.items():
+        # a wildcard dependency, resolved by listing
+        formula = 'libraries/{}-1.0.0'.format(name)
+        deps.append('libraries/{}-1.*'.format(name))
+        with open(os.path.join(workspace, formula), 'w') as f:
+            f.write('#!/usr/bin/env bash\n# Build Path: {}\ncp -a {}/. "$1"\n'.format(
+                os.path.join(workdir, 'build-{}'.format(name)), tree))
+
+        size = tree_size(tree)
+        for mode, args in [('deploy', []), ('deploy-pipeline', ['--pipeline'])]:
+            runs = []
+            for _ in range(repeat):
+                elapsed, phases = run_bob(['deploy', formula, '--overwrite', '--force'] + args, env, report_path)
+                runs.append(elapsed)
+            results['build/{}/{}'.format(mode, name)] = result(runs, bytes=size, phases=phases)
+
+    with open(os.path.join(workspace, 'runtimes', 'app'), 'w') as f:
+        f.write('#!/usr/bin/env bash\n# Build Path: {}\n# Build Deps: {}\necho built\n'.format(
+            os.path.join(workdir, 'build-app'), ' '.join(deps)))
+
+    cache_dir = os.path.join(workdir, 'cache')
+    for mode in ['cold-cache', 'warm-cache']:
+        runs = []
+        for _ in range(repeat):
+            if mode == 'cold-cache':
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            elapsed, phases = run_bob(['build', 'runtimes/app'], dict(env, BOB_CACHE_DIR=cache_dir), report_path)
+            runs.append(elapsed)
+        results['build/app-with-deps/{}'.format(mode)] = result(runs, phases=phases)
+
+    for name, entry in results.items():
+        report(name, entry)
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_stand_in():
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        print('No --endpoint given and moto is not installed; pip install "moto[server]".', file=sys.stderr)
+        sys.exit(1)
+
+    # keep its request log out of the results
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, 'http://127.0.0.1:{}'.format(port)
+
+
+def run(args):
+    scale = float(args['--scale'])
+    repeat = int(args['--repeat'])
+    codec = args['--codec']
+    groups = args['--only'].split(',')
+
+    server = None
+    endpoint = args['--endpoint']
+    if not endpoint:
+        server, endpoint = start_stand_in()
+
+    env = dict(os.environ, AWS_ENDPOINT_URL=endpoint, S3_BUCKET=BUCKET, S3_PREFIX='', UPSTREAM_S3_BUCKET='')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.update(env)
+
+    import boto3
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+
+    workdir = mkdtemp(prefix='bob-bench-')
+    results = {}
+    try:
+        trees = {}
+        if 'archive' in groups or 'build' in groups:
+            for i, (name, spec) in enumerate(sorted(tree_specs(scale).items())):
+                trees[name] = os.path.join(workdir, 'trees', name)
+                make_tree(trees[name], spec, seed=i)
+                print('Generated {}: {:.1f} MB'.format(name, tree_size(trees[name]) / MB))
+
+        if 'archive' in groups:
+            results.update(bench_archive(workdir, trees, codec, repeat))
+        if 'wildcard' in groups:
+            results.update(bench_wildcard(workdir, s3, scale, repeat))
+        if 'build' in groups:
+            results.update(bench_build(workdir, trees, env, codec, repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if server:
+            server.stop()
+
+    output = {
+        'meta': {
+            'started_at': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'endpoint': args['--endpoint'] or 'moto',
+            'scale': scale,
+            'repeat': repeat,
+            'codec': codec,
+            'revision': git_revision(),
+        },
+        'results': results,
+    }
+    with open(args['--output'], 'w') as f:
+        json.dump(output, f, indent=2)
+        f.write('\n')
+    print('Results written to {}'.format(args['--output']))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(args):
+    with open(args['<baseline>']) as f:
+        baseline = json.load(f)
+    with open(args['<candidate>']) as f:
+        candidate = json.load(f)
+    tolerance = float(args['--tolerance'])
+
+    for label, run in [('baseline', baseline), ('candidate', candidate)]:
+        meta = run['meta']
+        print('{:<10} revision {}, scale {}, codec {}, {} on {}'.format(
+            label, meta['revision'], meta['scale'], meta['codec'], meta['endpoint'], meta['platform']))
+    if baseline['meta']['scale'] != candidate['meta']['scale']:
+        print('Warning: the runs used different scales, timings are not comparable.')
+    print()
+
+    print('{:<40} {:>10} {:>10} {:>8}'.format('benchmark', 'baseline', 'candidate', 'change'))
+    for name in sorted(set(baseline['results']) & set(candidate['results'])):
+        before = baseline['results'][name]['seconds']
+        after = candidate['results'][name]['seconds']
+        change = (after / before - 1) * 100 if before else 0
+
+        verdict = ''
+        if change <= -tolerance:
+            verdict = 'faster'
+        elif change >= tolerance:
+            verdict = 'SLOWER'
+        print('{:<40} {:>9.3f}s {:>9.3f}s {:>+7.1f}% {}'.format(name, before, after, change, verdict))
+
+    for label, names in [('baseline', set(baseline['results']) - set(candidate['results'])),
+                         ('candidate', set(candidate['results']) - set(baseline['results']))]:
+        for name in sorted(names):
+            print('{:<40} only in the {}'.format(name, label))
+
+
+def main():
+    args = docopt(__doc__)
+
+    if args['run']:
+        run(args)
+    if args['compare']:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,10 @@
-from . import cli
+from importlib import import_module
 
 __all__ = ['cli']
+
+
+def __getattr__(name):
+    # imported on first use, so `bob` can hand commands to a daemon without importing the rest
+    if name == 'cli':
+        return import_module('.cli', __name__)
+    raise AttributeError("module 'bob' has no attribute {!r}".format(name))
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from .client import dispatch
+
+dispatch()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import time
+from tempfile import mkstemp
+
+from .transfer import open_object
+from .utils import mkdir_p
+
+# Downloads in progress are written to these first; ones older than PARTIAL_MAX_AGE seconds were interrupted.
+PARTIAL_PREFIX = '.partial-'
+PARTIAL_MAX_AGE = 3600
+
+
+class ArtifactCache(object):
+    """
+    An on-disk cache of dependency archives fetched from S3.
+
+    Entries are keyed by bucket, key and ETag, so a changed object is never served stale,
+    and the least recently used entries are evicted once the cache grows beyond max_size bytes.
+    A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def entry_path(self, bucket, key, etag):
+        digest = hashlib.sha256('\0'.join([bucket, key, etag]).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, 'archives', '{}.archive'.format(digest))
+
+    def entries(self):
+        """Returns a list of (path, size, last use) tuples, least recently used first."""
+        entries = []
+        try:
+            with os.scandir(os.path.join(self.path, 'archives')) as it:
+                for entry in it:
+                    if not entry.name.endswith('.archive'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        except FileNotFoundError:
+            pass
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def partials(self):
+        """Returns a list of (path, size, last write) tuples for the downloads being written into the cache."""
+        partials = []
+        try:
+            with os.scandir(os.path.join(self.path, 'archives')) as it:
+                for entry in it:
+                    if not entry.name.startswith(PARTIAL_PREFIX):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    partials.append((entry.path, stat.st_size, stat.st_mtime))
+        except FileNotFoundError:
+            pass
+
+        return partials
+
+    def stats(self):
+        """Returns the number of entries and their total size in bytes."""
+        entries = self.entries()
+        return len(entries), sum(entry[1] for entry in entries)
+
+    def prune(self, max_size=None):
+        """
+        Evicts least recently used entries until the cache fits max_size; returns the count and bytes removed.
+
+        Downloads that were interrupted (and left their partial file behind) are deleted first;
+        ones still being written count against max_size.
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        removed = freed = 0
+
+        for path, partial_size, written_at in self.partials():
+            if time.time() - written_at < PARTIAL_MAX_AGE:
+                size += partial_size
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += partial_size
+
+        for path, entry_size, _ in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another fetch evicted it already
+                pass
+            size -= entry_size
+            removed += 1
+            freed += entry_size
+
+        return removed, freed
+
+    def open(self, key, settings, reporter=None):
+        """
+        Opens an S3 object for streaming reads, going through the cache.
+
+        Returns a context manager yielding a file object and whether it was served from the cache.
+        Reading the body of a cache miss also stores it, once the with block exits without error.
+        settings and reporter apply to the download from S3, see transfer.open_object().
+        """
+        if not self.enabled:
+            return _Uncached(open_object(key, settings, reporter=reporter))
+
+        # e_tag is populated by a HEAD request if the key hasn't been loaded yet
+        path = self.entry_path(key.bucket_name, key.key, key.e_tag)
+
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return _CachingReader(self, open_object(key, settings, reporter=reporter), path, key.content_length)
+
+        # the modification time tracks the last use, for LRU eviction
+        os.utime(path)
+        return _Cached(f)
+
+
+class _Uncached(object):
+    hit = False
+
+    def __init__(self, body):
+        self.body = body
+
+    def __enter__(self):
+        return self.body
+
+    def __exit__(self, *exc_info):
+        self.body.close()
+
+
+class _Cached(_Uncached):
+    hit = True
+
+
+class _CachingReader(object):
+    """Passes reads through from an S3 response body, writing everything read into a new cache entry."""
+
+    hit = False
+
+    def __init__(self, cache, body, path, size):
+        self.cache = cache
+        self.body = body
+        self.path = path
+        self.size = size
+
+        mkdir_p(os.path.dirname(path))
+        fd, self.temp_path = mkstemp(prefix=PARTIAL_PREFIX, dir=os.path.dirname(path))
+        self.temp = os.fdopen(fd, 'wb')
+
+    def read(self, size=-1):
+        data = self.body.read(size)
+        self.temp.write(data)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                # the reader may stop before the end of the stream (e.g. at tar's end-of-archive blocks)
+                shutil.copyfileobj(self.body, self.temp)
+            self.temp.close()
+            self.body.close()
+
+            if exc_type is None and os.path.getsize(self.temp_path) == self.size:
+                os.replace(self.temp_path, self.path)
+                self.cache.prune()
+        finally:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+
+from botocore.exceptions import ClientError
+
+from .transfer import MultipartUploadWriter, ProgressReporter, open_object
+from .utils import archive_tree, extract_tree, mkdir_p, print_stderr
+
+# Compiler names ccache is put in front of, through symlinks on PATH (ccache's "masquerade" mode).
+COMPILERS = ['cc', 'gcc', 'c++', 'g++', 'clang', 'clang++']
+
+# Files ccache rewrites on every compilation, cache hits included.
+VOLATILE_FILES = ('stats', 'stats.lock')
+
+
+def cache_name(formula):
+    """
+    Returns the name a formula's compiler cache goes by: its path without a trailing version.
+
+    So runtimes/python-3.8.1 and runtimes/python-3.8.2 share a cache, and a patch-level bump
+    only recompiles what changed.
+    """
+    return re.sub(r'-\d[^/]*$', '', formula)
+
+
+class CompilerCache(object):
+    """
+    A ccache directory for a formula, restored before its script runs and saved afterwards.
+
+    The script runs with symlinks to ccache named like the compilers first on its PATH, so any
+    `cc`, `gcc` etc. it runs (including from configure and make) goes through the cache. Sources
+    are built in a new temporary directory every time, so that directory is made ccache's base
+    directory, letting paths below it hash the same from one build to the next.
+
+    With a bucket (a callable returning a utils.Bucket) and prefix, the cache is restored from a
+    compressed snapshot in S3 when another machine saved a newer one, and snapshotted there after
+    builds that added to it (or pruned it), pruned to max_size bytes first.
+
+    The compiler wrappers, and what the cache was last in sync with S3 as, are kept in state_path,
+    outside the snapshotted directory: the wrappers point at this machine's ccache.
+    """
+
+    def __init__(self, name, path, state_path, max_size, bucket=None, prefix='', codec=None, transfer=None):
+        self.name = name
+        self.path = path
+        self.state_path = state_path
+        self.max_size = max_size
+        self.bucket = bucket
+        self.prefix = prefix
+        self.codec = codec
+        self.transfer = transfer
+        self.ccache = shutil.which('ccache')
+
+    @property
+    def available(self):
+        return self.ccache is not None
+
+    @property
+    def wrapper_path(self):
+        return os.path.join(self.state_path, 'bin')
+
+    def snapshot(self):
+        """Returns the S3 object of the cache's snapshot, or None without a bucket."""
+        bucket = self.bucket() if self.bucket and self.prefix else None
+        if not bucket:
+            return None
+        return bucket, bucket.bucket.Object('{}{}{}'.format(self.prefix, self.name, self.codec.extension))
+
+    def environment(self, cwd):
+        """Returns the environment variables a formula script runs with, in the directory cwd."""
+        return {
+            'PATH': os.pathsep.join([self.wrapper_path, os.environ.get('PATH', os.defpath)]),
+            'CCACHE_DIR': self.path,
+            'CCACHE_MAXSIZE': '{}M'.format(self.max_size // 1024 // 1024),
+            'CCACHE_BASEDIR': cwd,
+            # the directory differs every time; with it in the hash, nothing compiled with -g would hit
+            'CCACHE_NOHASHDIR': '1',
+        }
+
+    def ccache_command(self, *args):
+        env = dict(os.environ, CCACHE_DIR=self.path, CCACHE_MAXSIZE='{}M'.format(self.max_size // 1024 // 1024))
+        return subprocess.run([self.ccache] + list(args), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def restore(self):
+        """Sets up the cache and its compiler wrappers, fetching the snapshot from S3 if it's newer."""
+        mkdir_p(self.wrapper_path)
+        for compiler in COMPILERS:
+            link = os.path.join(self.wrapper_path, compiler)
+            if not os.path.lexists(link):
+                os.symlink(self.ccache, link)
+
+        snapshot = self.snapshot()
+        if not snapshot:
+            return
+        _, obj = snapshot
+
+        try:
+            etag = obj.e_tag
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', '403'):
+                raise
+            return
+
+        if etag == self.load_state().get('etag'):
+            return
+
+        # merged into the local cache, where ccache takes whatever it finds
+        download = ProgressReporter('Compiler cache', total=obj.content_length)
+        body = open_object(obj, self.transfer, reporter=download)
+        try:
+            extract_tree(body, self.path)
+        finally:
+            body.close()
+        self.save_state(etag)
+        print_stderr('Restored the compiler cache for {}: {}'.format(self.name, download.finish().summary()))
+
+    def contents(self):
+        """Returns a digest of the names and sizes of the cached files, which builds with only cache hits leave alone."""
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = sorted(name for name in dirs if name != 'tmp')
+            for name in sorted(files):
+                if name in VOLATILE_FILES or name.endswith('.lock'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    size = os.lstat(path).st_size
+                except FileNotFoundError:
+                    continue
+                digest.update('{}\0{}\n'.format(os.path.relpath(path, self.path), size).encode('utf-8'))
+        return digest.hexdigest()
+
+    def load_state(self):
+        """Returns the ETag of the snapshot the cache was last restored from or uploaded as, and its contents() then."""
+        try:
+            with open(os.path.join(self.state_path, 'snapshot.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, etag):
+        mkdir_p(self.state_path)
+        with open(os.path.join(self.state_path, 'snapshot.json'), 'w') as f:
+            json.dump({'etag': etag, 'contents': self.contents()}, f)
+
+    def save(self):
+        """Prunes the cache to its size cap, prints its statistics and uploads a snapshot of it if it changed."""
+        self.ccache_command('--cleanup')
+        stats = self.ccache_command('--show-stats')
+        print_stderr('Compiler cache for {}:\n{}'.format(self.name, stats.stdout.decode('utf-8', 'replace').rstrip()))
+
+        snapshot = self.snapshot()
+        if not snapshot:
+            return
+        bucket, obj = snapshot
+        if bucket.anon:
+            return
+
+        state = self.load_state()
+        if state.get('contents') and state['contents'] == self.contents():
+            print_stderr('The compiler cache for {} is unchanged, not uploading it.'.format(self.name))
+            return
+
+        upload = ProgressReporter('Uploading compiler cache', indent='')
+        try:
+            with MultipartUploadWriter(obj, self.transfer, reporter=upload) as writer:
+                archive_tree(self.path, writer, codec=self.codec.name)
+            # what restore() saw before is stale now
+            obj.reload()
+            self.save_state(obj.e_tag)
+        except ClientError as e:
+            print_stderr('Could not upload the compiler cache for {}: {}'.format(self.name, e), title='WARNING')
+            return
+        print_stderr('Uploaded the compiler cache for {}: {}'.format(self.name, upload.finish().summary()))
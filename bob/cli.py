@@ -1,29 +1,90 @@
 # -*- coding: utf-8 -*-
 
-"""Usage: bob build <formula> [--name=FILE]
-       bob deploy <formula> [--overwrite] [--name=<FILE>]
+"""Usage: bob build <formula> [--name=FILE] [--refresh-index] [--report=<file>] [--summary]
+       bob deploy <formula> [--overwrite] [--force] [--name=<FILE>] [--pipeline] [--refresh-index] [--report=<file>] [--summary]
+       bob lock <formula> [--refresh-index]
+       bob build-all [--jobs=<n>] [--only-changed] [--dry-run] [--overwrite]
+       bob submit <queue> [--only-changed] [--dry-run] [--overwrite]
+       bob worker <queue> [--lease=<seconds>]
+       bob serve
+       bob fetch <url> [--sha256=<hash>] [--output=<file>]
+       bob cache stats
+       bob cache prune [--max-size=<MB>]
+       bob status [<formulas>...] [--check-fingerprints] [--json]
+       bob stats [<formula>] [--window=<n>] [--threshold=<percent>] [--openmetrics]
 
 Build formula and optionally deploy it.
 
+`bob serve` keeps a daemon running that `bob build` and `bob deploy` hand their work to when
+BOB_SOCKET points at it, saving each of them the setup of a new process.
+
+`bob submit` writes a build plan to a work queue at file:///path or s3://bucket/prefix, and
+`bob worker` processes on any number of machines (one per machine, with the same workspace)
+claim and deploy its formulas in dependency order.
+
 Options:
     -h --help
     --overwrite  allow overwriting of deployed archives.
+    --force  rebuild even if the deployed archive's fingerprint shows its inputs haven't changed.
     --name=<path>  allow separate name for the archived output
+    --refresh-index  list S3 again for wildcard dependencies, instead of using listings from the last BOB_INDEX_TTL seconds.
+    --pipeline  stream the archive into S3 while it is being compressed, instead of writing it to disk first.
+    --report=<file>  write the timings of each build phase (and bytes, throughput, CPU time and peak memory where known) to this file as JSON.
+    --summary  print a table of the timings of each build phase when done.
+    --jobs=<n>  number of formulas to build at once [default: 1].
+    --only-changed  only deploy formulas that are missing from S3 or whose fingerprint changed since deployed, and everything depending on them.
+    --dry-run  print the build plan without building anything.
+    --max-size=<MB>  prune the dependency cache (and layer and source stores) down to this size instead of BOB_CACHE_MAX_SIZE (and BOB_LAYERS_MAX_SIZE, BOB_SOURCE_CACHE_MAX_SIZE).
+    --lease=<seconds>  how long a claimed formula stays with a worker that stopped renewing its lease [default: 60].
+    --sha256=<hash>  fail unless the downloaded file has this SHA-256 checksum.
+    --output=<file>  write the downloaded file here instead of to stdout.
+    --window=<n>  number of earlier builds whose median is the baseline for regressions [default: 10].
+    --threshold=<percent>  flag builds whose duration or archive size exceeds the baseline by more than this [default: 25].
+    --check-fingerprints  also tell which deployed formulas changed since, by their fingerprint as with --only-changed (which looks up every formula's archive and dependencies).
+    --json  print the status of the formulas as JSON.
+    --openmetrics  print the statistics in the OpenMetrics text format, for scraping.
 
 Configuration:
     Environment Variables: AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET, S3_PREFIX (optional), UPSTREAM_S3_BUCKET (optional), UPSTREAM_S3_PREFIX (optional)
+    Dependencies (optional): BOB_TRANSITIVE_DEPS (set to 1 to also fetch the dependencies of dependencies that are formulas in the workspace)
+    Fingerprints (optional): BOB_FINGERPRINT_ENV (comma-separated variables that affect builds, default STACK)
+    Tuning (optional): BOB_JOBS (parallel jobs for formula scripts, passed to them as $BOB_JOBS and in MAKEFLAGS, and shared by all formulas of build-all through a make jobserver; default all cores within the cgroup CPU quota), BOB_FETCH_WORKERS (default 4), BOB_EXTRACT_THREADS (file writing threads per dependency, default 1), BOB_CONNECTION_CACHE_TTL (in seconds, default 300, 0 disables caching of credential checks), BOB_INDEX_TTL (in seconds, default 300, 0 disables the bucket listing index), BOB_CACHE_DIR (default $XDG_CACHE_HOME/bob), BOB_CACHE_MAX_SIZE (in MB, default 2048, 0 disables caching)
+    Transfers (optional): BOB_TRANSFER_PART_SIZE (in MB, default 16), BOB_TRANSFER_CONCURRENCY (default 8), BOB_TRANSFER_MAX_BANDWIDTH (in MB/s per transfer, default unlimited)
+    Dependency files (optional): BOB_EXCLUDE_DEPS (set to 1 to leave files dependencies put into the build path out of archives, unless the formula changed them; a manifest of what was left out is deployed next to the archive, and consumers need those dependencies as well, e.g. with BOB_TRANSITIVE_DEPS)
+    Source cache (optional): BOB_SOURCE_CACHE (set to 1 to run formulas with http_proxy pointing at a caching proxy for plain HTTP downloads, and $BOB_FETCH, a `bob fetch` command caching any URL), BOB_SOURCE_CACHE_MAX_SIZE (in MB, default 4096), BOB_SOURCE_MIRROR_PREFIX (prefix in S3_BUCKET to share cached sources between machines)
+    Compiler cache (optional): BOB_CCACHE (set to 1 to run formulas with ccache in front of cc, gcc, g++ and clang, keeping a cache per formula name without its version), BOB_CCACHE_MAX_SIZE (in MB, default 5120), BOB_CCACHE_PREFIX (prefix in S3_BUCKET to share cache snapshots between machines)
+    Layers (optional): BOB_LAYERS (keep dependencies extracted in the cache directory and "reflink" them into build directories, copying where the filesystem can't), BOB_LAYERS_MAX_SIZE (in MB, default 8192)
+    Archives (optional): BOB_ARCHIVE_CODEC (gzip, xz or zstd, default gzip), BOB_ARCHIVE_THREADS (default all cores)
+    Daemon (optional): BOB_SOCKET (Unix socket `bob serve` listens at, default $BOB_CACHE_DIR/serve.sock; when set, `bob build` and `bob deploy` run in the daemon listening there, or locally if there's none)
+    History (optional): BOB_HISTORY_PATH (SQLite database of past builds for `bob stats`, default $BOB_CACHE_DIR/history.sqlite, empty disables recording)
 """
+import json
 import os
+import shutil
 import signal
+import sqlite3
 import sys
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from urllib.error import URLError
 
 from docopt import docopt
-from .models import Formula
-from .utils import print_stderr
+from natsort import natsorted
+from .models import (
+    BUILD_PATH_MARKER, CACHE_DIR, CONNECTION_CACHE_TTL, DEFAULT_BUILD_PATH, DEPS_MARKER, JOBS, S3_BUCKET, S3_REGION,
+    SOCKET_PATH, UPSTREAM_S3_BUCKET, UPSTREAM_S3_REGION, WORKSPACE, Formula, LockfileMismatch, changed_formulas,
+    deployed_archives, deployed_key_name, get_cache, get_history, get_layers, get_sources)
+from .daemon import BuildServer
+from .history import find_regressions, openmetrics, percentile
+from .jobs import Jobserver
+from .scheduler import BuildGraph, Scheduler, scan_workspace
+from .utils import print_stderr, S3ConnectionHandler
+from .workqueue import Worker, open_queue
 
 
-def build(formula, name=None):
-    f = Formula(path=formula, override_path=name)
+def get_formula(formula, name=None, refresh_index=False):
+    f = Formula(path=formula, override_path=name, refresh_index=refresh_index)
 
     try:
         assert f.exists
@@ -31,14 +92,77 @@ def build(formula, name=None):
         print_stderr("Formula {} doesn't exist.".format(formula), title='ERROR')
         sys.exit(1)
 
+    return f
+
+
+def finish_report(f, report=None, summary=False, succeeded=True):
+    if report:
+        f.report.write_json(report)
+    if summary:
+        f.report.print_summary()
+
+    history = get_history()
+    if history:
+        try:
+            history.record(f.report, succeeded=succeeded)
+        except sqlite3.Error as e:
+            print_stderr('Could not record the build in {}: {}'.format(history.path, e), title='WARNING')
+
+
+def build(formula, name=None, refresh_index=False, report=None, summary=False):
+    f = get_formula(formula, name, refresh_index=refresh_index)
+    f.report.details['command'] = 'build'
+
     # CLI lies ahead.
-    f.build()
+    succeeded = False
+    try:
+        f.build()
+        if get_history():
+            # keys the build history; looking up every dependency again isn't worth it otherwise
+            f.fingerprint
+        succeeded = True
+    except LockfileMismatch as e:
+        print_stderr(str(e), title='ERROR')
+        sys.exit(1)
+    finally:
+        # failed builds exit from inside build(), their timings are still worth having
+        finish_report(f, report, summary, succeeded=succeeded)
 
     return f
 
 
-def deploy(formula, overwrite, name):
-    f = build(formula, name)
+def deploy(formula, overwrite, name, pipeline=False, refresh_index=False, force=False, report=None, summary=False):
+    f = get_formula(formula, name, refresh_index=refresh_index)
+    f.report.details['command'] = 'deploy'
+
+    succeeded = False
+    try:
+        _deploy(f, overwrite, pipeline=pipeline, force=force)
+        succeeded = True
+    except LockfileMismatch as e:
+        print_stderr(str(e), title='ERROR')
+        sys.exit(1)
+    finally:
+        finish_report(f, report, summary, succeeded=succeeded)
+
+
+def _deploy(f, overwrite, pipeline=False, force=False):
+    if not force:
+        with f.report.phase('fingerprint check'):
+            up_to_date = f.is_up_to_date()
+
+    if not force and up_to_date:
+        f.report.details['skipped'] = True
+        print_stderr('The deployed archive for {} was built from the same inputs (fingerprint {}), skipping.\n'
+                     'Use the --force flag to rebuild it anyway.'.format(f.deploy_name, f.fingerprint[:12]))
+        return
+
+    f.build()
+
+    if pipeline:
+        print_stderr('Archiving and deploying.')
+        f.archive_and_deploy(allow_overwrite=overwrite)
+        return
 
     print_stderr('Archiving.')
     f.archive()
@@ -47,6 +171,276 @@ def deploy(formula, overwrite, name):
     f.deploy(allow_overwrite=overwrite)
 
 
+def lock(formula, refresh_index=False):
+    f = get_formula(formula, refresh_index=refresh_index)
+    f.lock()
+
+
+def plan_formulas(only_changed=False, overwrite=False):
+    """Returns the workspace's formulas, their graph, the ones to deploy and the `bob deploy` arguments to use."""
+    formulas = scan_workspace(WORKSPACE, DEPS_MARKER, BUILD_PATH_MARKER, DEFAULT_BUILD_PATH)
+
+    try:
+        graph = BuildGraph(formulas)
+    except ValueError as e:
+        print_stderr(str(e), title='ERROR')
+        sys.exit(1)
+
+    selected = set(formulas)
+    deploy_args = ['--overwrite'] if overwrite else []
+
+    if only_changed:
+        if not S3_BUCKET:
+            print_stderr('The environment variable S3_BUCKET must be set to the bucket name.', title='ERROR')
+            sys.exit(1)
+
+        bucket = S3ConnectionHandler(cache_path=CACHE_DIR, ttl=CONNECTION_CACHE_TTL).get_bucket(S3_BUCKET, region_name=S3_REGION).bucket
+        deployed = deployed_archives(bucket, formulas)
+        selected = graph.downstream(changed_formulas(formulas, deployed))
+        # changed formulas are usually deployed already, replacing them is the point
+        deploy_args = ['--overwrite']
+
+    return formulas, graph, selected, deploy_args
+
+
+def print_plan(formulas, graph, selected, heading):
+    levels = graph.levels(selected)
+    print_stderr('{}: {} of {} formulas in {} stages:'.format(heading, len(selected), len(formulas), len(levels)))
+    for i, level in enumerate(levels, 1):
+        print_stderr('  Stage {}:'.format(i))
+        for path in level:
+            print_stderr('    - {} (in {})'.format(path, formulas[path].build_path))
+    print_stderr()
+
+
+def build_all(jobs=1, only_changed=False, dry_run=False, overwrite=False):
+    formulas, graph, selected, deploy_args = plan_formulas(only_changed, overwrite)
+    print_plan(formulas, graph, selected, 'Build plan, {} at a time, sharing {} jobs'.format(jobs, JOBS))
+
+    if dry_run or not selected:
+        return
+
+    # one job per formula running is free, the pipe holds the rest
+    jobserver = Jobserver(JOBS - jobs)
+    try:
+        succeeded = Scheduler(graph, selected, jobs=jobs, deploy_args=deploy_args, jobserver=jobserver, cpus=JOBS).run()
+    finally:
+        jobserver.close()
+    if not succeeded:
+        sys.exit(1)
+
+
+def get_queue(url):
+    handler = S3ConnectionHandler(cache_path=CACHE_DIR, ttl=CONNECTION_CACHE_TTL)
+    try:
+        return open_queue(url, get_bucket=lambda name: handler.get_bucket(name, region_name=S3_REGION))
+    except ValueError as e:
+        print_stderr(str(e), title='ERROR')
+        sys.exit(1)
+
+
+def submit(url, only_changed=False, dry_run=False, overwrite=False):
+    formulas, graph, selected, deploy_args = plan_formulas(only_changed, overwrite)
+    print_plan(formulas, graph, selected, 'Build plan')
+
+    if dry_run or not selected:
+        return
+
+    plan = get_queue(url).submit(formulas, graph, selected, deploy_args=deploy_args)
+    print_stderr('Submitted run {} to {}; start `bob worker {}` on the build machines.'.format(plan['id'], url, url))
+
+
+def worker(url, lease_time=60):
+    queue = get_queue(url)
+    plan = queue.plan()
+    if not plan:
+        print_stderr('There is no build plan in {}, use `bob submit` first.'.format(url), title='ERROR')
+        sys.exit(1)
+
+    w = Worker(queue, scan_workspace(WORKSPACE, DEPS_MARKER, BUILD_PATH_MARKER, DEFAULT_BUILD_PATH), lease_time=lease_time)
+    differing = w.check_workspace(plan)
+    if differing:
+        print_stderr('The workspace differs from the one run {} was submitted from, in: {}'.format(
+            plan['id'], ', '.join(differing)), title='ERROR')
+        sys.exit(1)
+
+    print_stderr('Worker {} working on run {} ({} formulas).'.format(w.name, plan['id'], len(plan['formulas'])))
+    if not w.run(plan):
+        sys.exit(1)
+
+
+def serve():
+    started = time.time()
+    server = BuildServer(SOCKET_PATH, BUILD_PATH_MARKER, __doc__)
+    buckets = [(name, region) for name, region in [(S3_BUCKET, S3_REGION), (UPSTREAM_S3_BUCKET, UPSTREAM_S3_REGION)] if name]
+    server.warm_up(buckets, cache_path=CACHE_DIR, ttl=CONNECTION_CACHE_TTL)
+
+    try:
+        server.listen()
+    except RuntimeError as e:
+        print_stderr(str(e), title='ERROR')
+        sys.exit(1)
+
+    # exit through serve_forever(), which removes the socket
+    for signo in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signo, lambda signo, frame: sys.exit(0))
+
+    print_stderr('Listening at {} (ready after {:.1f}s); set BOB_SOCKET to it to send build and deploy commands here.'.format(
+        SOCKET_PATH, time.time() - started))
+    server.serve_forever()
+
+
+def status(patterns=(), check_fingerprints=False, as_json=False):
+    formulas = scan_workspace(WORKSPACE, DEPS_MARKER, BUILD_PATH_MARKER, DEFAULT_BUILD_PATH)
+
+    selected = natsorted(formulas)
+    if patterns:
+        unmatched = [pattern for pattern in patterns if not any(fnmatchcase(path, pattern) for path in formulas)]
+        if unmatched:
+            print_stderr('No formulas match {}.'.format(', '.join(unmatched)), title='ERROR')
+            sys.exit(1)
+        selected = [path for path in selected if any(fnmatchcase(path, pattern) for pattern in patterns)]
+
+    if not S3_BUCKET:
+        print_stderr('The environment variable S3_BUCKET must be set to the bucket name.', title='ERROR')
+        sys.exit(1)
+
+    bucket = S3ConnectionHandler(cache_path=CACHE_DIR, ttl=CONNECTION_CACHE_TTL).get_bucket(S3_BUCKET, region_name=S3_REGION).bucket
+    deployed = deployed_archives(bucket, selected)
+    # a listing per directory is all it takes otherwise
+    changed = changed_formulas(selected, deployed) if check_fingerprints else None
+
+    rows = []
+    for path in selected:
+        key = deployed_key_name(path)
+        entry = deployed.get(key)
+        rows.append(OrderedDict([
+            ('formula', path),
+            ('key', key),
+            ('deployed', entry is not None),
+            # the fingerprint differs from the archive's, as for build-all --only-changed
+            ('changed', path in changed if changed is not None else None),
+            ('size', entry[2] if entry else None),
+            ('last_modified', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(entry[3])) if entry else None),
+            ('etag', entry[1].strip('"') if entry else None),
+        ]))
+
+    if as_json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print('{:<40} {:<9} {:>10} {:<20} {}'.format('formula', 'status', 'size MB', 'last modified', 'etag'))
+    for row in rows:
+        if not row['deployed']:
+            print('{:<40} {:<9} {:>10} {:<20} {}'.format(row['formula'], 'missing', '-', '-', '-'))
+            continue
+        print('{:<40} {:<9} {:>10.1f} {:<20} {}'.format(
+            row['formula'], 'changed' if row['changed'] else 'deployed', row['size'] / 1024 / 1024,
+            row['last_modified'].replace('T', ' ').rstrip('Z'), row['etag']))
+
+    summary = '{} of {} formulas deployed'.format(sum(1 for row in rows if row['deployed']), len(rows))
+    if check_fingerprints:
+        summary += ', {} of them changed since'.format(sum(1 for row in rows if row['deployed'] and row['changed']))
+    print('\n{}.'.format(summary))
+
+
+def cache_stats():
+    cache = get_cache()
+    count, size = cache.stats()
+
+    print('Location: {}'.format(cache.path))
+    print('Entries: {}'.format(count))
+    print('Size: {:.1f} MB of {:.1f} MB'.format(size / 1024 / 1024, cache.max_size / 1024 / 1024))
+
+    sources = get_sources()
+    count, size = sources.stats()
+    print('Sources: {}, {:.1f} MB of {:.1f} MB'.format(count, size / 1024 / 1024, sources.max_size / 1024 / 1024))
+
+    layers = get_layers()
+    if layers:
+        count, size = layers.stats()
+        print('Layers: {} ({}), {:.1f} MB of {:.1f} MB'.format(count, layers.mode, size / 1024 / 1024, layers.max_size / 1024 / 1024))
+
+
+def cache_prune(max_size=None):
+    cache = get_cache()
+    removed, freed = cache.prune(max_size=max_size * 1024 * 1024 if max_size is not None else None)
+
+    print('Removed {} entries, freeing {:.1f} MB.'.format(removed, freed / 1024 / 1024))
+
+    removed, freed = get_sources().prune(max_size=max_size * 1024 * 1024 if max_size is not None else None)
+    print('Removed {} sources, freeing {:.1f} MB.'.format(removed, freed / 1024 / 1024))
+
+    layers = get_layers()
+    if layers:
+        removed, freed = layers.prune(max_size=max_size * 1024 * 1024 if max_size is not None else None)
+        print('Removed {} layers, freeing {:.1f} MB.'.format(removed, freed / 1024 / 1024))
+
+
+def fetch(url, sha256=None, output=None):
+    try:
+        path = get_sources().get(url, sha256=sha256)
+    except ValueError as e:
+        print_stderr('{}: {}'.format(url, e), title='ERROR')
+        sys.exit(1)
+    except URLError as e:
+        print_stderr('Could not download {}: {}'.format(url, e), title='ERROR')
+        sys.exit(1)
+
+    with open(path, 'rb') as f:
+        if output:
+            with open(output, 'wb') as out:
+                shutil.copyfileobj(f, out)
+        else:
+            shutil.copyfileobj(f, sys.stdout.buffer)
+            sys.stdout.flush()
+
+
+def stats(formula=None, window=10, threshold=25, openmetrics_format=False):
+    history = get_history()
+    if not history:
+        print_stderr('Build history is disabled, set BOB_HISTORY_PATH to enable it.', title='ERROR')
+        sys.exit(1)
+
+    builds = history.builds(formula)
+
+    if openmetrics_format:
+        sys.stdout.write(openmetrics(history, builds, window=window, threshold=threshold / 100.0))
+        return
+
+    if not builds:
+        print('No builds recorded{}.'.format(' for {}'.format(formula) if formula else ''))
+        return
+
+    print('{:<40} {:<7} {:>6} {:>9} {:>9} {:>9} {:>10} {:>10} {:>7}'.format(
+        'formula', 'command', 'builds', 'p50 s', 'p90 s', 'p99 s', 'p50 MB', 'last MB', 'ratio'))
+
+    regressions = []
+    for (name, command), rows in builds.items():
+        durations = [row['wall_time'] for row in rows]
+        sizes = [row['artifact_size'] for row in rows if row['artifact_size'] is not None]
+        ratios = [row['compression_ratio'] for row in rows if row['compression_ratio'] is not None]
+
+        print('{:<40} {:<7} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>10} {:>7}'.format(
+            name, command or '-', len(rows), percentile(durations, 50), percentile(durations, 90), percentile(durations, 99),
+            '{:.1f}'.format(percentile(sizes, 50) / 1024 / 1024) if sizes else '-',
+            '{:.1f}'.format(sizes[-1] / 1024 / 1024) if sizes else '-',
+            '{:.1f}'.format(ratios[-1]) if ratios else '-'))
+
+        regressions.extend(find_regressions(rows, window=window, threshold=threshold / 100.0))
+
+    if regressions:
+        print('\nRegressions (more than {:g}% above the median of the previous {} builds):'.format(threshold, window))
+        for build, label, value, baseline in sorted(regressions, key=lambda regression: regression[0]['started_at']):
+            if label == 'duration':
+                change = '{:.2f}s, baseline {:.2f}s'.format(value, baseline)
+            else:
+                change = '{:.1f} MB, baseline {:.1f} MB'.format(value / 1024 / 1024, baseline / 1024 / 1024)
+            print('  {} {} {} (fingerprint {}): {} {} (+{:.0f}%)'.format(
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(build['started_at'])), build['command'] or '-', build['formula'],
+                (build['fingerprint'] or '-')[:12], label, change, (value / baseline - 1) * 100))
+
+
 def main():
     args = docopt(__doc__)
 
@@ -57,10 +451,46 @@ def main():
     do_name = args['--name']
 
     if do_build:
-        build(formula, name=do_name)
+        build(formula, name=do_name, refresh_index=args['--refresh-index'], report=args['--report'],
+              summary=args['--summary'])
 
     if do_deploy:
-        deploy(formula, overwrite=do_overwrite, name=do_name)
+        deploy(formula, overwrite=do_overwrite, name=do_name, pipeline=args['--pipeline'],
+               refresh_index=args['--refresh-index'], force=args['--force'], report=args['--report'],
+               summary=args['--summary'])
+
+    if args['build-all']:
+        build_all(jobs=int(args['--jobs']), only_changed=args['--only-changed'],
+                  dry_run=args['--dry-run'], overwrite=do_overwrite)
+
+    if args['submit']:
+        submit(args['<queue>'], only_changed=args['--only-changed'], dry_run=args['--dry-run'], overwrite=do_overwrite)
+
+    if args['worker']:
+        worker(args['<queue>'], lease_time=int(args['--lease']))
+
+    if args['lock']:
+        lock(formula, refresh_index=args['--refresh-index'])
+
+    if args['cache'] and args['stats']:
+        cache_stats()
+
+    if args['serve']:
+        serve()
+
+    if args['fetch']:
+        fetch(args['<url>'], sha256=args['--sha256'], output=args['--output'])
+
+    if args['status']:
+        status(args['<formulas>'], check_fingerprints=args['--check-fingerprints'], as_json=args['--json'])
+
+    if args['stats'] and not args['cache']:
+        stats(formula, window=int(args['--window']), threshold=float(args['--threshold']),
+              openmetrics_format=args['--openmetrics'])
+
+    if args['cache'] and args['prune']:
+        max_size = args['--max-size']
+        cache_prune(max_size=int(max_size) if max_size is not None else None)
 
 
 def sigint_handler(signo, frame):
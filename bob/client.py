@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+The `bob` command: hands build and deploy commands to a `bob serve` daemon when BOB_SOCKET
+points at one, and runs everything else (or everything, without a daemon) in this process.
+
+Only the standard library (and bob.jobs, which needs nothing else) is imported before deciding,
+so forwarded commands don't pay for importing boto3 and the rest of bob.
+"""
+
+import json
+import os
+import signal
+import socket
+import sys
+
+from .jobs import inherited_jobserver
+
+# The commands a daemon runs; the rest are quick, or long-running themselves.
+FORWARDED = ('build', 'deploy')
+
+
+def forward(path, argv):
+    """
+    Runs a bob command in the daemon listening at path, with our environment, working directory,
+    standard streams and jobserver (from build-all, if any); returns its exit status (negative
+    for a signal), or None if there's no daemon there.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        request = json.dumps({'argv': argv, 'env': dict(os.environ), 'cwd': os.getcwd()}).encode('utf-8') + b'\n'
+        # the daemon's process writes straight to our stdout and stderr
+        sent = socket.send_fds(sock, [request], [0, 1, 2] + list(inherited_jobserver() or ()))
+        sock.sendall(request[sent:])
+
+        response = b''
+        try:
+            while not response.endswith(b'\n'):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+        except KeyboardInterrupt:
+            # closing the connection makes the daemon interrupt the command too
+            return -signal.SIGINT
+
+    try:
+        response = json.loads(response.decode('utf-8'))
+    except ValueError:
+        print('\nERROR: The bob daemon at {} stopped before the command finished.\n'.format(path), file=sys.stderr)
+        return 1
+
+    if 'error' in response:
+        print('\nERROR: {}\n'.format(response['error']), file=sys.stderr)
+        return 1
+    return response['status']
+
+
+def dispatch():
+    path = os.environ.get('BOB_SOCKET')
+    if path and len(sys.argv) > 1 and sys.argv[1] in FORWARDED:
+        status = forward(path, sys.argv[1:])
+        if status is None:
+            print('\nNOTICE: No bob daemon is listening at {}, running here.\n'.format(path), file=sys.stderr)
+        elif status < 0:
+            # terminated by a signal, so are we (see cli.sigint_handler)
+            signal.signal(-status, signal.SIG_DFL)
+            os.kill(os.getpid(), -status)
+        else:
+            sys.exit(status)
+
+    from .cli import dispatch as run_here
+    run_here()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import lzma
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Codec(object):
+    """
+    A compression format for build archives.
+
+    gzip and xz are compressed in blocks across a pool of threads. gzip blocks are pieced
+    together into a single gzip member (see GzipBlockWriter), so that readers handling only one
+    member, like tarfile's 'r|gz' mode, read the whole archive; xz blocks are complete xz streams,
+    which the format allows concatenating. zstd uses the zstandard package's own multi-threaded
+    compressor, if that package is installed.
+    """
+
+    def __init__(self, name, extension, magic, block_size=None, compress_block=None):
+        self.name = name
+        self.extension = extension
+        self.magic = magic
+        self.block_size = block_size
+        self.compress_block = compress_block
+
+    def __repr__(self):
+        return '<Codec {}>'.format(self.name)
+
+    @property
+    def available(self):
+        if self.name == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                return False
+        return True
+
+    def writer(self, fileobj, threads=None):
+        """Returns a file object that compresses everything written to it into fileobj."""
+        threads = threads or os.cpu_count() or 1
+
+        if self.name == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(threads=threads).stream_writer(fileobj, closefd=False)
+
+        if self.name == 'gzip':
+            return GzipBlockWriter(fileobj, self.block_size, threads)
+
+        return ParallelBlockWriter(fileobj, self.compress_block, self.block_size, threads)
+
+    def reader(self, fileobj):
+        """Returns a file object that decompresses fileobj, which only has to support read()."""
+        if self.name == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False)
+
+        if self.name == 'xz':
+            return lzma.LZMAFile(fileobj)
+
+        # archives deployed before GzipBlockWriter consist of many members, which GzipFile reads (unlike 'r|gz')
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+def _deflate_block(data, dictionary=b''):
+    """Compresses data into raw deflate blocks ending on a byte boundary, referring back into dictionary."""
+    if dictionary:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _xz_block(data):
+    return lzma.compress(data, preset=6)
+
+
+CODECS = {
+    'gzip': Codec('gzip', '.tar.gz', b'\x1f\x8b', block_size=1024 * 1024, compress_block=_deflate_block),
+    'xz': Codec('xz', '.tar.xz', b'\xfd7zXZ\x00', block_size=8 * 1024 * 1024, compress_block=_xz_block),
+    'zstd': Codec('zstd', '.tar.zst', b'\x28\xb5\x2f\xfd'),
+}
+
+
+def detect_codec(fileobj):
+    """
+    Identifies the codec of a compressed stream by its magic bytes.
+
+    Returns the codec, and a file object that replays the bytes consumed for the check.
+    """
+    prefix = fileobj.read(max(len(codec.magic) for codec in CODECS.values()))
+
+    for codec in CODECS.values():
+        if prefix.startswith(codec.magic):
+            return codec, _PrefixedReader(prefix, fileobj)
+
+    raise ValueError('Unknown archive compression format.')
+
+
+class _PrefixedReader(object):
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b''
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            if len(data) < size:
+                data += self.fileobj.read(size - len(data))
+        return data
+
+
+class ParallelBlockWriter(object):
+    """
+    A write-only file object that compresses fixed-size blocks on a thread pool.
+
+    Compressed blocks are written to fileobj in order; at most two blocks per thread are
+    buffered at any time. zlib and lzma release the GIL while compressing, so this scales
+    across cores.
+    """
+
+    def __init__(self, fileobj, compress_block, block_size, threads):
+        self.fileobj = fileobj
+        self.compress_block = compress_block
+        self.block_size = block_size
+        self.max_pending = threads * 2
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+        return len(data)
+
+    def _submit(self, block, *args):
+        if len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pending.append(self.pool.submit(self.compress_block, block, *args))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            if self.buffer or not self.pending:
+                # always emit at least one block, so that empty input still yields a valid file
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Deflate refers back at most this far, so that much of the previous block primes the next one.
+DEFLATE_WINDOW = 32 * 1024
+
+# ID, deflate, no flags, no modification time, no extra flags, Unix.
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+
+# An empty final deflate block, ending the stream after the byte-aligned blocks before it.
+DEFLATE_END = b'\x03\x00'
+
+
+class GzipBlockWriter(ParallelBlockWriter):
+    """
+    A ParallelBlockWriter writing a single gzip member, the way pigz does.
+
+    Every block is compressed to raw deflate data ending on a byte boundary, primed with the
+    last 32 KB of the block before it, so the blocks concatenate into one deflate stream that
+    compresses nearly as well as a serial one. The header, the final block and the trailer with
+    the checksum and length of the input are written around them here.
+    """
+
+    def __init__(self, fileobj, block_size, threads):
+        super(GzipBlockWriter, self).__init__(fileobj, _deflate_block, block_size, threads)
+        self.crc = 0
+        self.length = 0
+        self.dictionary = b''
+        self.fileobj.write(GZIP_HEADER)
+
+    def _submit(self, block, *args):
+        self.crc = zlib.crc32(block, self.crc)
+        self.length += len(block)
+        dictionary, self.dictionary = self.dictionary, block[-DEFLATE_WINDOW:]
+        super(GzipBlockWriter, self)._submit(block, dictionary)
+
+    def close(self):
+        if self.closed:
+            return
+        super(GzipBlockWriter, self).close()
+        self.fileobj.write(DEFLATE_END + struct.pack('<II', self.crc, self.length & 0xffffffff))
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import json
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+from botocore.exceptions import ClientError
+from docopt import docopt
+
+from .client import FORWARDED
+from .jobs import JOBSERVER_ENV
+from .utils import print_stderr, read_markers, S3ConnectionHandler
+
+# The environment variables boto3's default session is set up from; requests with different
+# values get a new session instead of the warm one.
+SESSION_VARIABLES = S3ConnectionHandler.scope_variables + [
+    'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_REGION', 'AWS_DEFAULT_REGION']
+
+# Requests are JSON with the client's environment; anything bigger isn't from our client.
+MAX_REQUEST_SIZE = 1024 * 1024
+
+# Seconds a client has to send its whole request after connecting.
+REQUEST_TIMEOUT = 10
+
+
+class Request(object):
+    """A command sent by a client, with the client's stdin, stdout and stderr, and its jobserver's pipe if it has one."""
+
+    def __init__(self, conn, argv, env, cwd, fds):
+        self.conn = conn
+        self.argv = argv
+        self.env = env
+        self.cwd = cwd
+        self.fds = fds
+        self.build_path = None
+        self.pid = None
+        self.pidfd = None
+        self.started_at = None
+
+    def describe(self):
+        return ' '.join(self.argv)
+
+
+class BuildServer(object):
+    """
+    Runs `bob build` and `bob deploy` commands for clients connecting to a Unix socket.
+
+    The daemon imports bob and boto3, loads boto3's service models and resolves credentials once,
+    and probes the buckets it was started for, leaving the outcome in the connection cache every
+    bob process reads. Each request is then run in a process forked from the daemon, with the
+    client's environment, working directory and standard streams, so it starts with all of that
+    warm (bob's own modules are imported again, to pick up the client's configuration). Requests
+    run concurrently, except for formulas with the same build path, which wait for each other as
+    they do in build-all. A client that disconnects interrupts its command.
+
+    The socket is only accessible to the user running the daemon, which also checks the user of
+    every client.
+
+    usage is bob's docopt usage message, which commands are parsed with to find their formula.
+    """
+
+    def __init__(self, path, build_path_marker, usage):
+        self.path = path
+        self.build_path_marker = build_path_marker
+        self.usage = usage
+        self.selector = selectors.DefaultSelector()
+        self.listener = None
+        self.session_env = dict((name, os.environ.get(name)) for name in SESSION_VARIABLES)
+
+        # connection -> (data, fds, connected at) of requests still being read
+        self.reading = {}
+        self.waiting, self.running = [], {}
+        self.busy_paths = set()
+        # (formula path, modification time) -> build path
+        self.build_paths = {}
+
+    def warm_up(self, buckets, cache_path, ttl):
+        """Sets up boto3 and checks access to buckets, a list of (name, region) pairs."""
+        import boto3
+        boto3.setup_default_session()
+        for service in ['s3', 'sts']:
+            boto3.DEFAULT_SESSION.client(service)
+        boto3.DEFAULT_SESSION.get_credentials()
+
+        handler = S3ConnectionHandler(cache_path=cache_path, ttl=ttl)
+        for name, region in buckets:
+            try:
+                handler.get_bucket(name, region_name=region)
+            except ClientError as e:
+                print_stderr('Could not check access to the bucket {}: {}'.format(name, e), title='WARNING')
+
+    def listen(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise RuntimeError('Another bob daemon is listening at {}.'.format(self.path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by a daemon that died
+                os.remove(self.path)
+            finally:
+                probe.close()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.listener.listen(64)
+        self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+
+    def serve_forever(self):
+        try:
+            while True:
+                for key, _ in self.selector.select(timeout=REQUEST_TIMEOUT):
+                    key.data(key.fileobj)
+                self.drop_stale()
+        finally:
+            for request in self.running.values():
+                try:
+                    os.killpg(request.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            self.listener.close()
+            os.remove(self.path)
+
+    def accept(self, listener):
+        """Takes a new connection; its request is read as it arrives, so a slow client holds up nobody."""
+        conn, _ = listener.accept()
+        try:
+            pid, uid, gid = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+            if uid != os.getuid():
+                raise ValueError('client process {} belongs to another user'.format(pid))
+        except (OSError, ValueError) as e:
+            print_stderr('Rejected a request: {}'.format(e))
+            conn.close()
+            return
+
+        conn.setblocking(False)
+        self.reading[conn] = (b'', None, time.time())
+        self.selector.register(conn, selectors.EVENT_READ, self.read)
+
+    def read(self, conn):
+        """Reads what arrived of a connection's request, queueing the request once it's complete."""
+        data, fds, connected_at = self.reading[conn]
+        try:
+            if fds is None:
+                # the standard streams, then the jobserver's read and write ends, come with the first data
+                chunk, fds, _, _ = socket.recv_fds(conn, 64 * 1024, 5)
+                if len(fds) not in (3, 5):
+                    for fd in fds:
+                        os.close(fd)
+                    raise ValueError('expected the standard streams of the client')
+            else:
+                chunk = conn.recv(64 * 1024)
+            data += chunk
+            self.reading[conn] = (data, fds, connected_at)
+
+            if not chunk or len(data) > MAX_REQUEST_SIZE:
+                raise ValueError('incomplete request')
+            if not data.endswith(b'\n'):
+                return
+            request = json.loads(data.decode('utf-8'))
+            request = Request(conn, list(request['argv']), dict(request['env']), request['cwd'], fds)
+        except BlockingIOError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            print_stderr('Rejected a request: {}'.format(e))
+            self.drop(conn)
+            return
+
+        del self.reading[conn]
+        self.selector.unregister(conn)
+        conn.settimeout(REQUEST_TIMEOUT)
+
+        if not request.argv or request.argv[0] not in FORWARDED:
+            for fd in request.fds:
+                os.close(fd)
+            self.respond(request, error='The bob daemon only runs {} commands.'.format(' and '.join(FORWARDED)))
+            return
+
+        request.build_path = self.build_path(request)
+        self.waiting.append(request)
+        self.selector.register(conn, selectors.EVENT_READ, lambda conn: self.disconnected(request))
+        self.start_ready()
+
+    def drop(self, conn):
+        """Closes a connection whose request is still being read, along with the streams it sent."""
+        _, fds, _ = self.reading.pop(conn)
+        for fd in fds or ():
+            os.close(fd)
+        self.selector.unregister(conn)
+        conn.close()
+
+    def drop_stale(self):
+        for conn, (_, _, connected_at) in list(self.reading.items()):
+            if time.time() - connected_at > REQUEST_TIMEOUT:
+                print_stderr('Rejected a request: not sent within {} seconds'.format(REQUEST_TIMEOUT))
+                self.drop(conn)
+
+    def build_path(self, request):
+        """Returns the build path of the request's formula, or None if it can't be told."""
+        try:
+            formula = docopt(self.usage, argv=request.argv, help=False)['<formula>']
+        except SystemExit:
+            # bad arguments, which running the command reports
+            return None
+        if not formula:
+            return None
+
+        # as models.py reads them
+        workspace = request.env.get('WORKSPACE_DIR', 'workspace')
+        full_path = os.path.join(request.cwd, workspace, formula)
+        try:
+            key = (full_path, os.path.getmtime(full_path))
+        except OSError:
+            return None
+
+        if key not in self.build_paths:
+            markers = read_markers(full_path, [self.build_path_marker])[self.build_path_marker]
+            self.build_paths[key] = markers[0] if markers else request.env.get('DEFAULT_BUILD_PATH', '/app/.heroku/')
+        return self.build_paths[key]
+
+    def start_ready(self):
+        for request in list(self.waiting):
+            if request.build_path is not None and request.build_path in self.busy_paths:
+                continue
+            self.waiting.remove(request)
+            self.start(request)
+
+    def start(self, request):
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            self.run_request(request)
+
+        for fd in request.fds:
+            os.close(fd)
+        request.pid = pid
+        request.started_at = time.time()
+        request.pidfd = os.pidfd_open(pid)
+        self.running[pid] = request
+        if request.build_path is not None:
+            self.busy_paths.add(request.build_path)
+        self.selector.register(request.pidfd, selectors.EVENT_READ, lambda pidfd: self.finished(request))
+        print_stderr('[{}] bob {}'.format(pid, request.describe()))
+
+    def run_request(self, request):
+        """Runs a request in the forked process; never returns."""
+        status = 1
+        try:
+            os.setsid()
+            # nothing of the daemon's, or of other requests, stays open in here
+            for key in list(self.selector.get_map().values()):
+                if isinstance(key.fileobj, int):
+                    os.close(key.fileobj)
+                else:
+                    key.fileobj.close()
+            self.selector.close()
+            request.conn.close()
+            for other in self.waiting:
+                for fd in other.fds:
+                    os.close(fd)
+            for _, fds, _ in self.reading.values():
+                for fd in fds or ():
+                    os.close(fd)
+            for target, fd in enumerate(request.fds[:3]):
+                os.dup2(fd, target)
+                os.close(fd)
+            sys.stdout.reconfigure(line_buffering=True)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            os.chdir(request.cwd)
+            os.environ.clear()
+            os.environ.update(request.env)
+            # the client's jobserver fds are numbered differently in here
+            if len(request.fds) == 5:
+                os.environ[JOBSERVER_ENV] = '{},{}'.format(*request.fds[3:])
+            else:
+                os.environ.pop(JOBSERVER_ENV, None)
+
+            if dict((name, os.environ.get(name)) for name in SESSION_VARIABLES) != self.session_env:
+                import boto3
+                boto3.DEFAULT_SESSION = None
+
+            # bob reads its configuration when imported, so import it again with the client's
+            for name in list(sys.modules):
+                if name == 'bob' or name.startswith('bob.'):
+                    del sys.modules[name]
+            cli = importlib.import_module('bob.cli')
+
+            sys.argv = ['bob'] + request.argv
+            try:
+                cli.dispatch()
+                status = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+            except BaseException:
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+
+    def finished(self, request):
+        _, status = os.waitpid(request.pid, 0)
+        status = os.waitstatus_to_exitcode(status)
+
+        self.selector.unregister(request.pidfd)
+        os.close(request.pidfd)
+        del self.running[request.pid]
+        self.busy_paths.discard(request.build_path)
+
+        print_stderr('[{}] bob {}: exit status {} after {:.1f}s'.format(
+            request.pid, request.describe(), status, time.time() - request.started_at))
+        self.respond(request, status=status)
+        self.start_ready()
+
+    def disconnected(self, request):
+        """Interrupts (or drops) the request of a client that went away."""
+        self.selector.unregister(request.conn)
+        request.conn.close()
+
+        if request in self.waiting:
+            self.waiting.remove(request)
+            for fd in request.fds:
+                os.close(fd)
+        elif request.pid in self.running:
+            print_stderr('[{}] client went away, interrupting'.format(request.pid))
+            try:
+                os.killpg(request.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    def respond(self, request, **response):
+        if request.conn.fileno() == -1:
+            return
+        try:
+            self.selector.unregister(request.conn)
+        except KeyError:
+            pass
+        try:
+            request.conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError:
+            pass
+        request.conn.close()
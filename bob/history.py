@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    formula TEXT NOT NULL,
+    command TEXT,
+    fingerprint TEXT,
+    started_at REAL NOT NULL,
+    succeeded INTEGER NOT NULL,
+    wall_time REAL NOT NULL,
+    codec TEXT,
+    build_size INTEGER,
+    artifact_size INTEGER,
+    compression_ratio REAL,
+    fetch_bytes INTEGER,
+    download_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS builds_formula ON builds (formula, started_at);
+CREATE TABLE IF NOT EXISTS phases (
+    build_id INTEGER NOT NULL REFERENCES builds (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    wall_time REAL NOT NULL,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS phases_build ON phases (build_id);
+"""
+
+# The measures regressions are detected on, as (column, label) pairs.
+MEASURES = [('wall_time', 'duration'), ('artifact_size', 'artifact size')]
+
+
+def percentile(values, p):
+    """Returns the p-th percentile (0-100) of values, interpolating between the closest ranks."""
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = (len(values) - 1) * p / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+class BuildHistory(object):
+    """
+    A local SQLite database of past builds, for spotting formulas that got slower or bigger.
+
+    Every build or deploy records its total and per-phase timings, keyed by formula path, command
+    (build or deploy, which also archives and uploads, so they're never compared) and fingerprint,
+    along with the sizes of its build tree and archive and the dependency bytes it fetched.
+    Concurrent bob processes (e.g. from build-all) may write to it at the same time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA foreign_keys = ON')
+        db.executescript(SCHEMA)
+        return db
+
+    def record(self, report, succeeded=True):
+        """Stores a BuildReport; reports of deploys skipped as up to date aren't builds and are left out."""
+        details = report.details
+        if details.get('skipped'):
+            return
+
+        dep_phases = [phase for phase in report.phases if 'cached' in phase]
+        build_size = details.get('build_size')
+        artifact_size = details.get('artifact_size')
+
+        db = self.connect()
+        try:
+            with db:
+                cursor = db.execute(
+                    'INSERT INTO builds (formula, command, fingerprint, started_at, succeeded, wall_time, codec, build_size,'
+                    ' artifact_size, compression_ratio, fetch_bytes, download_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (report.formula, details.get('command'), details.get('fingerprint'), report.started_at, int(succeeded),
+                     time.time() - report.started_at, details.get('codec'), build_size, artifact_size,
+                     build_size / artifact_size if build_size and artifact_size else None,
+                     sum(phase['bytes'] for phase in dep_phases),
+                     sum(phase['bytes'] for phase in dep_phases if not phase['cached'])))
+
+                db.executemany(
+                    'INSERT INTO phases (build_id, name, wall_time, bytes) VALUES (?, ?, ?, ?)',
+                    [(cursor.lastrowid, phase['name'], phase['wall_time'], phase.get('bytes')) for phase in report.phases])
+        finally:
+            db.close()
+
+    def builds(self, formula=None):
+        """Returns the successful builds as {(formula, command): [rows, oldest first]}, for one formula or all of them."""
+        query = 'SELECT * FROM builds WHERE succeeded'
+        params = ()
+        if formula:
+            query += ' AND formula = ?'
+            params = (formula,)
+
+        db = self.connect()
+        try:
+            builds = OrderedDict()
+            for row in db.execute(query + ' ORDER BY formula, command, started_at', params):
+                builds.setdefault((row['formula'], row['command']), []).append(row)
+            return builds
+        finally:
+            db.close()
+
+    def phases(self, build_id):
+        db = self.connect()
+        try:
+            return db.execute('SELECT * FROM phases WHERE build_id = ? ORDER BY rowid', (build_id,)).fetchall()
+        finally:
+            db.close()
+
+
+def find_regressions(builds, window=10, threshold=0.25):
+    """
+    Compares every build with the median of the window builds before it.
+
+    builds are the rows of one formula and command, as BuildHistory.builds() groups them.
+
+    Returns (build, measure label, value, baseline) for every build whose duration or artifact size
+    exceeds its baseline by more than threshold (a fraction, 0.25 for 25%). Builds with fewer than
+    three predecessors have no meaningful baseline and are never flagged.
+    """
+    regressions = []
+
+    for i, build in enumerate(builds):
+        previous = builds[max(i - window, 0):i]
+        for column, label in MEASURES:
+            history = [row[column] for row in previous if row[column] is not None]
+            if build[column] is None or len(history) < 3:
+                continue
+
+            baseline = percentile(history, 50)
+            if baseline and build[column] > baseline * (1 + threshold):
+                regressions.append((build, label, build[column], baseline))
+
+    return regressions
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def openmetrics(history, builds, window=10, threshold=0.25):
+    """Renders per-formula (and per-command) build statistics in the OpenMetrics text format."""
+    quantiles = [0.5, 0.9, 0.99]
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('# HELP {} {}'.format(name, help_text))
+
+    def sample(name, labels, value):
+        rendered = ','.join('{}="{}"'.format(key, _escape_label(str(label))) for key, label in labels.items())
+        lines.append('{}{{{}}} {}'.format(name, rendered, repr(float(value)) if isinstance(value, float) else value))
+
+    def labels(key, *extra):
+        formula, command = key
+        return OrderedDict([('formula', formula), ('command', command or 'unknown')] + list(extra))
+
+    family('bob_build_duration_seconds', 'summary', 'Wall time of successful builds.')
+    for key, rows in builds.items():
+        durations = [row['wall_time'] for row in rows]
+        for q in quantiles:
+            sample('bob_build_duration_seconds', labels(key, ('quantile', q)), percentile(durations, q * 100))
+        sample('bob_build_duration_seconds_sum', labels(key), float(sum(durations)))
+        sample('bob_build_duration_seconds_count', labels(key), len(durations))
+
+    gauges = [
+        ('bob_build_last_duration_seconds', 'Wall time of the latest successful build.', 'wall_time'),
+        ('bob_artifact_last_size_bytes', 'Archive size of the latest successful build that archived.', 'artifact_size'),
+        ('bob_build_last_size_bytes', 'Build directory size of the latest successful build.', 'build_size'),
+        ('bob_artifact_last_compression_ratio', 'Build directory size over archive size of the latest successful build.', 'compression_ratio'),
+        ('bob_dependency_last_fetch_bytes', 'Dependency archive bytes read by the latest successful build.', 'fetch_bytes'),
+    ]
+    for name, help_text, column in gauges:
+        family(name, 'gauge', help_text)
+        for key, rows in builds.items():
+            values = [row[column] for row in rows if row[column] is not None]
+            if values:
+                sample(name, labels(key), values[-1])
+
+    family('bob_build_last_phase_duration_seconds', 'gauge', 'Wall time of each phase of the latest successful build.')
+    for key, rows in builds.items():
+        for phase in history.phases(rows[-1]['id']):
+            sample('bob_build_last_phase_duration_seconds', labels(key, ('phase', phase['name'])), phase['wall_time'])
+
+    family('bob_build_regressed', 'gauge', 'Whether the latest successful build regressed against its rolling baseline.')
+    for key, rows in builds.items():
+        latest = rows[-1]['id']
+        regressed = {label for build, label, _, _ in find_regressions(rows, window, threshold) if build['id'] == latest}
+        for _, label in MEASURES:
+            sample('bob_build_regressed', labels(key, ('measure', label)), int(label in regressed))
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import threading
+import time
+from fnmatch import fnmatchcase
+from tempfile import mkstemp
+
+from natsort import natsorted
+
+from .utils import mkdir_p
+
+
+class KeyIndex(object):
+    """
+    A locally persisted listing of bucket keys, for resolving wildcard dependencies without listing S3.
+
+    Listings are kept per bucket and "directory" prefix (e.g. "runtimes/"), so every wildcard
+    under one directory is served from a single listing, as is every key looked up in bulk. Keys
+    are stored in natsort order, making the highest matching version the last match. A listing
+    older than ttl seconds is fetched again on next use; refresh=True does that once for every
+    listing this process uses.
+    """
+
+    def __init__(self, path, ttl, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+
+        self.listings = {}
+        self.lock = threading.Lock()
+        self.listing_locks = {}
+
+    def listing_path(self, bucket_name, prefix):
+        digest = hashlib.sha256('\0'.join([bucket_name, prefix]).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}.json'.format(digest))
+
+    def listing(self, bucket, prefix):
+        """Returns (key, etag, size, last modified timestamp) tuples for all keys under prefix, in natsort order."""
+        with self.lock:
+            lock = self.listing_locks.setdefault((bucket.name, prefix), threading.Lock())
+
+        # concurrent lookups under one prefix wait for a single listing
+        with lock:
+            if (bucket.name, prefix) in self.listings:
+                return self.listings[bucket.name, prefix]
+
+            path = self.listing_path(bucket.name, prefix)
+            keys = None if self.refresh else self._load(path)
+
+            if keys is None:
+                pages = bucket.meta.client.get_paginator('list_objects_v2').paginate(Bucket=bucket.name, Prefix=prefix)
+                keys = natsorted(
+                    ((summary['Key'], summary['ETag'], summary['Size'], summary['LastModified'].timestamp())
+                     for page in pages for summary in page.get('Contents', [])),
+                    key=lambda entry: entry[0])
+                self._save(path, bucket.name, prefix, keys)
+
+            self.listings[bucket.name, prefix] = keys
+            return keys
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                listing = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - listing['listed_at'] > self.ttl:
+            return None
+        return [tuple(entry) for entry in listing['keys']]
+
+    def _save(self, path, bucket_name, prefix, keys):
+        mkdir_p(self.path)
+        fd, temp_path = mkstemp(prefix='.partial-', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'bucket': bucket_name, 'prefix': prefix, 'listed_at': time.time(), 'keys': keys}, f)
+        os.replace(temp_path, path)
+
+    def lookup(self, bucket, pattern):
+        """Returns the (key, etag, size, last modified) of the highest version matching a wildcard pattern, or None."""
+        wildcard = pattern.index('*')
+        prefix = pattern[:pattern.rfind('/', 0, wildcard) + 1]
+
+        match = None
+        for entry in self.listing(bucket, prefix):
+            if fnmatchcase(entry[0], pattern):
+                match = entry
+        return match
+
+    def entries(self, bucket, keys):
+        """
+        Returns {key: (key, etag, size, last modified)} for those of keys that exist.
+
+        Each directory the keys are in is listed once, or not at all when it lies below another
+        one that's listed anyway, so looking up hundreds of keys takes a few paginated listings
+        instead of a HEAD request each.
+        """
+        prefixes = set(key[:key.rfind('/') + 1] for key in keys)
+        listed = [prefix for prefix in prefixes
+                  if not any(prefix != other and prefix.startswith(other) for other in prefixes)]
+
+        wanted = set(keys)
+        found = {}
+        for prefix in natsorted(listed):
+            for entry in self.listing(bucket, prefix):
+                if entry[0] in wanted:
+                    found[entry[0]] = entry
+        return found
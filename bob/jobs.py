@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import math
+import os
+
+# Where the CPU quota of the cgroup we run in is found, for cgroup v2 and v1.
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+# Passes an inherited jobserver's pipe, as "<read fd>,<write fd>", from build-all to `bob deploy`.
+JOBSERVER_ENV = 'BOB_JOBSERVER'
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().split()
+    except (OSError, ValueError):
+        return None
+
+
+def cgroup_cpu_quota():
+    """Returns the number of CPUs the cgroup CPU quota allows (rounded up), or None without a quota."""
+    fields = _read_first_line(CGROUP_V2_CPU_MAX)
+    if fields and len(fields) == 2 and fields[0] != 'max':
+        quota, period = fields
+    else:
+        quota, period = (_read_first_line(CGROUP_V1_CPU_QUOTA) or [''])[0], (_read_first_line(CGROUP_V1_CPU_PERIOD) or [''])[0]
+
+    try:
+        quota, period = int(quota), int(period)
+    except ValueError:
+        return None
+    # cgroup v1 reports -1 without a quota
+    if quota <= 0 or period <= 0:
+        return None
+    return max(int(math.ceil(quota / float(period))), 1)
+
+
+def available_cpus():
+    """Returns the number of CPUs we may use: those we're allowed to run on, capped by any cgroup quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = cgroup_cpu_quota()
+    return max(min(cpus, quota) if quota else cpus, 1)
+
+
+class Jobserver(object):
+    """
+    A GNU make jobserver: a pipe holding one byte per job that may run besides the ones running already.
+
+    Every make connected to it runs one job for free and takes a token from the pipe for every
+    job beyond that, writing it back when the job finishes. build-all creates one for the machine
+    and hands it to every formula it builds, so their makes share a single pool of CPUs: a formula
+    building alone gets all of them, and concurrent ones split them up as jobs come and go.
+    """
+
+    def __init__(self, tokens):
+        self.fds = os.pipe()
+        # inherited by the processes they're passed to (pass_fds), but nothing else
+        for fd in self.fds:
+            os.set_inheritable(fd, False)
+        if tokens > 0:
+            os.write(self.fds[1], b'+' * tokens)
+
+    def environment(self):
+        return {JOBSERVER_ENV: '{},{}'.format(*self.fds)}
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+
+
+def inherited_jobserver():
+    """Returns the fds of the jobserver build-all passed us, or None if there's none (or they're gone)."""
+    try:
+        fds = tuple(int(fd) for fd in os.environ.get(JOBSERVER_ENV, '').split(','))
+        if len(fds) != 2:
+            return None
+        for fd in fds:
+            os.fstat(fd)
+    except (ValueError, OSError):
+        return None
+    return fds
+
+
+def job_environment(jobs, jobserver=None):
+    """
+    Returns the environment variables that tell a formula script how many jobs to run.
+
+    $BOB_JOBS is for build tools that don't speak the jobserver protocol (`ninja -j`, `cargo -j`
+    etc.). MAKEFLAGS makes any make the script runs parallel: connected to the jobserver if one
+    is given, as a (read fd, write fd) pair the script must inherit, with `-j<jobs>` otherwise.
+    A MAKEFLAGS set by whoever runs bob is kept without a jobserver, as their choice.
+    """
+    env = {'BOB_JOBS': str(jobs)}
+    if jobserver:
+        # what make passes its own sub-makes; make 3.81 needs the plain -j, 4.2 onwards still takes --jobserver-fds
+        env['MAKEFLAGS'] = '-j --jobserver-fds={0},{1}'.format(*jobserver)
+    elif 'MAKEFLAGS' not in os.environ:
+        env['MAKEFLAGS'] = '-j{}'.format(jobs)
+    return env
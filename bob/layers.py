@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+from .utils import merge_tree, mkdir_p, tree_size
+
+# ioctl cloning a file's extents into another on copy-on-write filesystems (btrfs, XFS), from linux/fs.h
+FICLONE = 0x40049409
+
+# What failing clones report when the filesystem can't do them (or not across filesystems).
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM)
+
+# Hardlinks would share the inode with the layer, which a formula modifying a dependency's file in
+# place (rather than replacing it) would then corrupt for every later build.
+MODES = ('reflink',)
+
+
+class LayerStore(object):
+    """
+    Extracted dependency archives, kept so builds can reuse them without decompressing again.
+
+    Each layer is the tree of one archive, keyed by bucket, key and ETag like the archive cache.
+    Layers are materialized into build directories with reflinks (copy-on-write clones) where the
+    filesystem supports them, making setting up a build a metadata-only operation. Files are
+    copied where it doesn't, or when the build path is on another filesystem than the store, so
+    builds never share a file with the layer.
+
+    The least recently used layers are evicted once the store grows beyond max_size bytes.
+    """
+
+    def __init__(self, path, max_size, mode='reflink'):
+        assert mode in MODES
+        self.path = path
+        self.max_size = max_size
+        self.mode = mode
+        # downgraded to "copy" on the first file that can't be cloned
+        self.method = mode
+
+    def layer_path(self, bucket, key, etag):
+        digest = hashlib.sha256('\0'.join([bucket, key, etag]).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, 'layers', digest)
+
+    def get(self, key):
+        """Returns the tree of the layer for an S3 object, or None if it hasn't been stored."""
+        path = self.layer_path(key.bucket_name, key.key, key.e_tag)
+        if not os.path.exists(os.path.join(path, 'layer.json')):
+            return None
+
+        # the modification time tracks the last use, for LRU eviction
+        os.utime(path)
+        return os.path.join(path, 'tree')
+
+    def add(self, key, fill):
+        """Stores the layer for an S3 object, calling fill(dir) to extract it; returns the layer's tree."""
+        path = self.layer_path(key.bucket_name, key.key, key.e_tag)
+        mkdir_p(os.path.dirname(path))
+
+        temp_path = mkdtemp(prefix='.partial-', dir=os.path.dirname(path))
+        try:
+            tree = os.path.join(temp_path, 'tree')
+            os.mkdir(tree)
+            fill(tree)
+
+            with open(os.path.join(temp_path, 'layer.json'), 'w') as f:
+                json.dump({'bucket': key.bucket_name, 'key': key.key, 'etag': key.e_tag,
+                           'size': tree_size(tree), 'created_at': time.time()}, f)
+
+            try:
+                os.rename(temp_path, path)
+            except OSError as e:
+                # another build stored the same layer first
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path, ignore_errors=True)
+
+        self.prune()
+        return os.path.join(path, 'tree')
+
+    def entries(self):
+        """Returns a list of (path, size, last use) tuples, least recently used first."""
+        entries = []
+        try:
+            with os.scandir(os.path.join(self.path, 'layers')) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        with open(os.path.join(entry.path, 'layer.json')) as f:
+                            size = json.load(f)['size']
+                        entries.append((entry.path, size, entry.stat().st_mtime))
+                    except (OSError, ValueError):
+                        continue
+        except FileNotFoundError:
+            pass
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def stats(self):
+        """Returns the number of layers and their total size in bytes."""
+        entries = self.entries()
+        return len(entries), sum(entry[1] for entry in entries)
+
+    def prune(self, max_size=None):
+        """Evicts least recently used layers until the store fits max_size; returns the count and bytes removed."""
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        removed = freed = 0
+
+        for path, entry_size, _ in entries:
+            if size <= max_size:
+                break
+            # out of the way first, so nobody picks up a half deleted layer
+            trash = os.path.join(os.path.dirname(path), '.deleted-{}'.format(os.path.basename(path)))
+            try:
+                os.rename(path, trash)
+            except FileNotFoundError:
+                # another build evicted it already
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+            size -= entry_size
+            removed += 1
+            freed += entry_size
+
+        return removed, freed
+
+    def materialize(self, tree, dst):
+        """Lays the files of a layer's tree into dst, replacing existing entries like merge_tree()."""
+        merge_tree(tree, dst, place=self.place)
+
+    def place(self, source, target):
+        if os.path.lexists(target):
+            os.remove(target)
+
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+            return
+
+        if self.method == 'reflink':
+            try:
+                clone_file(source, target)
+                shutil.copystat(source, target)
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                if os.path.lexists(target):
+                    os.remove(target)
+                self.method = 'copy'
+
+        shutil.copy2(source, target)
+
+
+def clone_file(source, target):
+    """Makes target a copy-on-write clone of source; raises OSError where the filesystem can't."""
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
@@ -1,19 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
 import os
-import re
+import shlex
 import shutil
 import signal
 import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
 from tempfile import mkstemp, mkdtemp
 from subprocess import Popen
 from urllib.parse import urlsplit
 
 from botocore.exceptions import ClientError
-
+from natsort import natsorted
+
+from .cache import ArtifactCache
+from .ccache import CompilerCache, cache_name
+from .compression import CODECS
+from .history import BuildHistory
+from .index import KeyIndex
+from .jobs import available_cpus, inherited_jobserver, job_environment
+from .layers import MODES as LAYER_MODES, LayerStore
+from .report import BuildReport
+from .sources import SourceProxy, SourceStore
+from .transfer import MB, MultipartUploadWriter, ProgressReporter, TransferSettings
 from .utils import (
-    archive_tree, extract_tree, get_with_wildcard, iter_marker_lines, mkdir_p,
-    print_stderr, S3ConnectionHandler)
+    archive_tree, extract_tree, get_with_wildcard, merge_tree, print_stderr,
+    read_markers, reset_dir, snapshot_tree, split_deps, tree_size, S3ConnectionHandler)
 
 
 WORKSPACE = os.environ.get('WORKSPACE_DIR', 'workspace')
@@ -24,6 +42,56 @@ S3_REGION = os.environ.get('S3_REGION')
 UPSTREAM_S3_BUCKET = os.environ.get('UPSTREAM_S3_BUCKET')
 UPSTREAM_S3_PREFIX = os.environ.get('UPSTREAM_S3_PREFIX', '')
 UPSTREAM_S3_REGION = os.environ.get('UPSTREAM_S3_REGION')
+ARCHIVE_CODEC = os.environ.get('BOB_ARCHIVE_CODEC', 'gzip')
+# Defaults to all available cores.
+ARCHIVE_THREADS = int(os.environ.get('BOB_ARCHIVE_THREADS', 0)) or None
+FETCH_WORKERS = max(int(os.environ.get('BOB_FETCH_WORKERS', 4)), 1)
+# Jobs formula scripts run at once (in $BOB_JOBS and MAKEFLAGS); defaults to the CPUs available, within any cgroup quota.
+JOBS = max(int(os.environ.get('BOB_JOBS', 0)) or available_cpus(), 1)
+# Threads writing the files of each dependency archive; more than 1 helps archives of many small files on fast disks.
+EXTRACT_THREADS = max(int(os.environ.get('BOB_EXTRACT_THREADS', 1)), 1)
+# Also fetch the dependencies of the workspace formulas behind each dependency, recursively.
+TRANSITIVE_DEPS = os.environ.get('BOB_TRANSITIVE_DEPS', '') not in ('', '0')
+# How long, in seconds, the outcome of S3 credential and bucket access checks is reused; 0 checks every time.
+CONNECTION_CACHE_TTL = int(os.environ.get('BOB_CONNECTION_CACHE_TTL', 300))
+# How long, in seconds, bucket listings used for wildcard dependencies are reused; 0 always lists S3.
+INDEX_TTL = int(os.environ.get('BOB_INDEX_TTL', 300))
+# Environment variables that affect build output, and so are part of build fingerprints.
+FINGERPRINT_ENV = [name for name in os.environ.get('BOB_FINGERPRINT_ENV', 'STACK').split(',') if name]
+FINGERPRINT_METADATA = 'bob-fingerprint'
+# Part size and bandwidth limit in megabytes; a bandwidth limit of 0 means unlimited.
+TRANSFER = TransferSettings(
+    part_size=int(os.environ.get('BOB_TRANSFER_PART_SIZE', 16)) * MB,
+    concurrency=int(os.environ.get('BOB_TRANSFER_CONCURRENCY', 8)),
+    max_bandwidth=int(float(os.environ.get('BOB_TRANSFER_MAX_BANDWIDTH', 0)) * MB))
+CACHE_DIR = os.environ.get('BOB_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'bob')
+# In megabytes; 0 disables the dependency archive cache.
+CACHE_MAX_SIZE = int(os.environ.get('BOB_CACHE_MAX_SIZE', 2048))
+# Leave the files dependencies put into the build path out of the archive, unless the formula changed them.
+EXCLUDE_DEPS = os.environ.get('BOB_EXCLUDE_DEPS', '') not in ('', '0')
+# Deployed next to each archive built with EXCLUDE_DEPS, listing the dependency files left out.
+MANIFEST_SUFFIX = '.manifest.json'
+# Run formulas with a caching proxy (and $BOB_FETCH) for the source tarballs they download.
+SOURCE_CACHE = os.environ.get('BOB_SOURCE_CACHE', '') not in ('', '0')
+# In megabytes.
+SOURCE_CACHE_MAX_SIZE = int(os.environ.get('BOB_SOURCE_CACHE_MAX_SIZE', 4096))
+# A prefix in S3_BUCKET to share downloaded sources between build machines; empty for none.
+SOURCE_MIRROR_PREFIX = os.environ.get('BOB_SOURCE_MIRROR_PREFIX', '')
+# Run formulas with ccache in front of the compilers, keeping a cache per formula (without its version).
+CCACHE = os.environ.get('BOB_CCACHE', '') not in ('', '0')
+# In megabytes.
+CCACHE_MAX_SIZE = int(os.environ.get('BOB_CCACHE_MAX_SIZE', 5120))
+# A prefix in S3_BUCKET to keep compiler cache snapshots under, for other build machines; empty for none.
+CCACHE_PREFIX = os.environ.get('BOB_CCACHE_PREFIX', '')
+# Keep dependencies extracted and clone them into build directories: "reflink" or empty (off).
+LAYER_MODE = os.environ.get('BOB_LAYERS', '')
+# In megabytes.
+LAYER_MAX_SIZE = int(os.environ.get('BOB_LAYERS_MAX_SIZE', 8192))
+# Where `bob serve` listens, and where build and deploy commands are sent to it if set.
+SOCKET_PATH = os.environ.get('BOB_SOCKET') or os.path.join(CACHE_DIR, 'serve.sock')
+# The build history database; set to an empty value to stop recording builds.
+HISTORY_PATH = os.environ.get('BOB_HISTORY_PATH', os.path.join(CACHE_DIR, 'history.sqlite'))
 
 # Append a slash for backwards compatibility.
 if S3_PREFIX and not S3_PREFIX.endswith('/'):
@@ -33,25 +101,144 @@ if UPSTREAM_S3_PREFIX and not UPSTREAM_S3_PREFIX.endswith('/'):
 
 DEPS_MARKER = '# Build Deps: '
 BUILD_PATH_MARKER = '# Build Path: '
+MARKERS = [DEPS_MARKER, BUILD_PATH_MARKER]
+
+# A dependency archive fetched by Formula.resolve_deps, along with the time each step took.
+FetchedDep = namedtuple('FetchedDep', ['dep', 'key_name', 'key', 'upstream', 'cached', 'path', 'lookup_time', 'fetch_time', 'download', 'layer'])
+
+
+class LockfileMismatch(Exception):
+    """A formula's lockfile no longer matches its dependencies or the bucket configuration."""
+
+
+def deployed_key_name(name):
+    """Returns the S3 key a formula (or its --name override) is deployed to."""
+    return '{}{}{}'.format(S3_PREFIX, name, CODECS[ARCHIVE_CODEC].extension)
+
+
+def deployed_archives(bucket, paths):
+    """
+    Returns {key: (key, etag, size, last modified)} for the deployed archives of formulas.
+
+    Comes from fresh listings of the directories the archives are in (which also refresh the
+    index used for wildcard dependencies), rather than a HEAD request per formula.
+    """
+    index = KeyIndex(os.path.join(CACHE_DIR, 'index'), ttl=INDEX_TTL, refresh=True)
+    return index.entries(bucket, [deployed_key_name(path) for path in paths])
+
+
+def changed_formulas(paths, deployed):
+    """
+    Returns the formulas that aren't deployed, or whose fingerprint differs from their archive's.
+
+    deployed is what deployed_archives() returned for them; only the formulas found there are
+    fingerprinted and have their archive's metadata fetched, a few at a time.
+    """
+    def is_changed(path):
+        try:
+            return not Formula(path).is_up_to_date()
+        except LockfileMismatch:
+            # deploying it will complain about the stale lockfile again
+            return True
+
+    changed = set(path for path in paths if deployed_key_name(path) not in deployed)
+    candidates = [path for path in paths if path not in changed]
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        changed.update(path for path, result in zip(candidates, pool.map(is_changed, candidates)) if result)
+    return changed
+
+
+def declared_deps(full_path):
+    """Returns the dependencies declared by the Build Deps markers of a formula."""
+    return [dep for line in read_markers(full_path, MARKERS)[DEPS_MARKER] for dep in split_deps(line)]
+
+
+def workspace_formula_for(dep):
+    """Returns the workspace formula a dependency refers to (the highest version for wildcards), or None."""
+    matches = [os.path.relpath(path, WORKSPACE) for path in glob(os.path.join(WORKSPACE, dep))
+               if os.path.isfile(path) and not path.endswith('.lock')]
+
+    return natsorted(matches)[-1] if matches else None
+
+
+def get_cache():
+    return ArtifactCache(CACHE_DIR, max_size=CACHE_MAX_SIZE * 1024 * 1024)
+
+
+def get_layers():
+    return LayerStore(CACHE_DIR, max_size=LAYER_MAX_SIZE * 1024 * 1024, mode=LAYER_MODE) if LAYER_MODE else None
+
+
+def get_sources():
+    def mirror():
+        return S3ConnectionHandler(cache_path=CACHE_DIR, ttl=CONNECTION_CACHE_TTL).get_bucket(S3_BUCKET, region_name=S3_REGION)
+
+    return SourceStore(os.path.join(CACHE_DIR, 'sources'), max_size=SOURCE_CACHE_MAX_SIZE * 1024 * 1024,
+                       mirror=mirror if SOURCE_MIRROR_PREFIX and S3_BUCKET else None, mirror_prefix=SOURCE_MIRROR_PREFIX)
+
+
+def get_history():
+    return BuildHistory(HISTORY_PATH) if HISTORY_PATH else None
+
 
 class Formula(object):
 
-    def __init__(self, path, override_path=None):
+    def __init__(self, path, override_path=None, refresh_index=False):
         self.path = path
         self.archived_path = None
         self.override_path = override_path
+        self.cache = get_cache()
+        self.index = KeyIndex(os.path.join(CACHE_DIR, 'index'), ttl=INDEX_TTL, refresh=refresh_index) if INDEX_TTL > 0 else None
+        self.locks = None
+        self.locks_checked = False
+        self.resolved = {}
+        self._fingerprint = None
+        self.report = BuildReport(path)
+        # What resolve_deps() put into the build path, for EXCLUDE_DEPS.
+        self.dep_snapshot = None
+        self.excluded = []
+        self.report.details['codec'] = ARCHIVE_CODEC
 
         if not S3_BUCKET:
             print_stderr('The environment variable S3_BUCKET must be set to the bucket name.', title='ERROR')
             sys.exit(1)
 
-        s3 = S3ConnectionHandler()
-        self.bucket = s3.get_bucket(S3_BUCKET, region_name=S3_REGION)
-        self.upstream = s3.get_bucket(UPSTREAM_S3_BUCKET, region_name=UPSTREAM_S3_REGION) if UPSTREAM_S3_BUCKET else None
+        self.codec = CODECS.get(ARCHIVE_CODEC)
+        if not self.codec or not self.codec.available:
+            print_stderr('Archive codec "{}" is not available, use one of: {}.'.format(
+                ARCHIVE_CODEC, ', '.join(name for name, codec in sorted(CODECS.items()) if codec.available)), title='ERROR')
+            sys.exit(1)
+
+        if LAYER_MODE and LAYER_MODE not in LAYER_MODES:
+            print_stderr('BOB_LAYERS must be one of: {}.'.format(', '.join(LAYER_MODES)), title='ERROR')
+            sys.exit(1)
+        self.layers = get_layers()
+
+        # S3 is only connected to once needed, see connect().
+        self.connection_lock = threading.Lock()
+        self._buckets = None
 
     def __repr__(self):
         return '<Formula {}>'.format(self.path)
 
+    def connect(self):
+        """Sets up the S3 buckets on first use, so formulas that never touch S3 don't wait for it."""
+        with self.connection_lock:
+            if self._buckets is None:
+                s3 = S3ConnectionHandler(cache_path=CACHE_DIR, ttl=CONNECTION_CACHE_TTL)
+                self._buckets = (
+                    s3.get_bucket(S3_BUCKET, region_name=S3_REGION),
+                    s3.get_bucket(UPSTREAM_S3_BUCKET, region_name=UPSTREAM_S3_REGION) if UPSTREAM_S3_BUCKET else None)
+        return self._buckets
+
+    @property
+    def bucket(self):
+        return self.connect()[0]
+
+    @property
+    def upstream(self):
+        return self.connect()[1]
+
     @property
     def workspace_path(self):
         return os.path.join(WORKSPACE, self.path)
@@ -69,66 +256,345 @@ class Formula(object):
     def depends_on(self):
         """Extracts a list of declared dependencies from a given formula."""
         # Depends: libraries/libsqlite, libraries/libsqlite
-
-        depends = []
-
-        for result in iter_marker_lines(DEPS_MARKER, self.full_path):
-            # Split on both space and comma.
-            result = re.split(r'[ ,]+', result)
-            depends.extend(result)
-
-            return depends
+        return declared_deps(self.full_path)
 
     @property
     def build_path(self):
         """Extracts a declared build path from a given formula."""
 
-        for result in iter_marker_lines(BUILD_PATH_MARKER, self.full_path):
+        for result in read_markers(self.full_path, MARKERS)[BUILD_PATH_MARKER]:
             return result
 
         # If none was provided, fallback to default.
         return DEFAULT_BUILD_PATH
 
-    def resolve_deps(self):
+    @property
+    def all_deps(self):
+        """
+        Returns the declared dependencies, plus (with BOB_TRANSITIVE_DEPS) those of the workspace formulas behind them.
+
+        Transitive dependencies come before the ones requiring them, so that dependents still
+        overwrite their dependencies' files on extraction.
+        """
+        if not TRANSITIVE_DEPS:
+            return self.depends_on
+
+        closure = []
+        seen = set()
+
+        def visit(full_path, trail):
+            for dep in declared_deps(full_path):
+                path = workspace_formula_for(dep)
+                if path in trail:
+                    print_stderr('Dependency cycle: {}'.format(' -> '.join(trail[trail.index(path):] + [path])), title='ERROR')
+                    sys.exit(1)
 
-        # Dependency metadata, extracted from bash comments.
-        deps = self.depends_on
+                if (path or dep) in seen:
+                    continue
+                if path:
+                    visit(os.path.abspath(os.path.join(WORKSPACE, path)), trail + [path])
+                seen.add(path or dep)
+                closure.append(dep)
+
+        visit(self.full_path, [self.path])
+        return closure
+
+    @property
+    def lock_path(self):
+        return '{}.lock'.format(self.workspace_path)
+
+    def read_lock(self):
+        """Returns the dependencies pinned by the formula's lockfile, keyed by name, or None if there is none."""
+        try:
+            with open(self.lock_path) as f:
+                locked = json.load(f)['deps']
+        except FileNotFoundError:
+            return None
+
+        return {entry['dep']: entry for entry in locked}
+
+    def lock(self):
+        """Resolves the formula's dependencies once, and pins the exact archives in a lockfile next to it."""
+        # resolve from S3, not from the existing lockfile
+        self.locks = None
+        self.locks_checked = True
+        deps = self.all_deps
+
+        with ThreadPoolExecutor(max_workers=max(min(FETCH_WORKERS, len(deps)), 1)) as pool:
+            lookups = list(pool.map(self.lookup_dep, deps))
+
+        locked = []
+        for dep, (key_name, key, upstream) in zip(deps, lookups):
+            if not key:
+                print_stderr('Archive {} does not exist.\n'
+                             'Please deploy it to continue.'.format(key_name), title='ERROR')
+                sys.exit(1)
+
+            print_stderr('  - {} => s3://{}/{}'.format(dep, key.bucket_name, key.key))
+            locked.append({'dep': dep, 'bucket': key.bucket_name, 'upstream': upstream,
+                           'key': key.key, 'etag': key.e_tag, 'size': key.content_length})
+
+        with open(self.lock_path, 'w') as f:
+            json.dump({'deps': locked}, f, indent=2)
+            f.write('\n')
+
+        print_stderr('\nLocked {} dependencies in {}'.format(len(locked), self.lock_path))
+
+    def check_lock(self, deps):
+        """
+        Loads the lockfile, if any, making sure it still matches the formula and bucket configuration.
+
+        Raises LockfileMismatch if it doesn't.
+        """
+        if self.locks_checked:
+            return
+        self.locks_checked = True
+
+        self.locks = self.read_lock()
+        if self.locks is None:
+            return
+
+        if set(self.locks) != set(deps):
+            raise LockfileMismatch('Lockfile {} does not match the dependencies of {}.\n'
+                                   'Run "bob lock {}" to update it.'.format(self.lock_path, self.path, self.path))
+
+        for entry in self.locks.values():
+            bucket = UPSTREAM_S3_BUCKET if entry['upstream'] else S3_BUCKET
+            if entry['bucket'] != bucket:
+                raise LockfileMismatch('Lockfile {} pins {} to bucket "{}", but {} is "{}".'.format(
+                    self.lock_path, entry['dep'], entry['bucket'],
+                    'UPSTREAM_S3_BUCKET' if entry['upstream'] else 'S3_BUCKET', bucket))
+
+        print_stderr('Using locked dependencies from {}'.format(self.lock_path))
+
+    def lookup_dep(self, dep):
+        """Finds the archive key for a dependency, falling back to UPSTREAM_S3_BUCKET.
+
+        Returns a tuple of the key name tried last, the key (or None) and whether it came from upstream.
+        Results are memoized, so the fingerprint and the build agree on the archives used.
+        """
+        if dep not in self.resolved:
+            self.resolved[dep] = self._lookup_dep(dep)
+        return self.resolved[dep]
+
+    def _lookup_dep(self, dep):
+        if self.locks is not None:
+            # No listing or HEAD request needed, the lockfile has it all.
+            entry = self.locks[dep]
+            key = (self.upstream if entry['upstream'] else self.bucket).bucket.Object(entry['key'])
+            key.meta.data = {'ETag': entry['etag'], 'ContentLength': entry['size']}
+            return entry['key'], key, entry['upstream']
+
+        key_name, key = self.find_archive(self.bucket.bucket, S3_PREFIX, dep)
+
+        if key or not self.upstream:
+            return key_name, key, False
+
+        key_name, key = self.find_archive(self.upstream.bucket, UPSTREAM_S3_PREFIX, dep)
+
+        return key_name, key, True
+
+    def find_archive(self, bucket, prefix, dep):
+        """
+        Returns the key name for a dependency in the configured codec, and its archive key (or None).
+
+        Dependencies may have been deployed with any codec, since extraction detects it, so every
+        extension is tried, the configured codec's first. Of wildcard matches in several codecs, the
+        highest version wins, and the configured codec among equal ones.
+        """
+        codecs = [self.codec] + [codec for codec in CODECS.values() if codec is not self.codec]
+        key_name = '{}{}{}'.format(prefix, dep, self.codec.extension)
+
+        matches = []
+        for codec in codecs:
+            key = get_with_wildcard(bucket, '{}{}{}'.format(prefix, dep, codec.extension), index=self.index)
+            if key and '*' not in dep:
+                return key_name, key
+            if key:
+                matches.append((key.key[:-len(codec.extension)], key))
+
+        if not matches:
+            return key_name, None
+        # natsorted is stable, so reversing makes the configured codec's match last among equal versions
+        return key_name, natsorted(reversed(matches), key=lambda match: match[0])[-1][1]
+
+    @property
+    def deploy_name(self):
+        return self.override_path if self.override_path != None else self.path
+
+    @property
+    def fingerprint(self):
+        """
+        A hash of everything that determines the formula's archive.
+
+        That is the formula itself, the archives its dependencies resolve to, the deployed name,
+        the archive codec and the environment variables listed in BOB_FINGERPRINT_ENV.
+        """
+        if self._fingerprint:
+            return self._fingerprint
 
+        deps = self.all_deps
         if deps:
-            print_stderr('Fetching dependencies... found {}:'.format(len(deps)))
+            self.check_lock(deps)
+
+        with ThreadPoolExecutor(max_workers=max(min(FETCH_WORKERS, len(deps)), 1)) as pool:
+            lookups = list(pool.map(self.lookup_dep, deps))
+
+        inputs = {
+            'name': self.deploy_name,
+            'codec': self.codec.name,
+            'deps': [[dep, key.bucket_name, key.key, key.e_tag] if key else [dep, None] for dep, (_, key, _) in zip(deps, lookups)],
+            'env': dict((name, os.environ.get(name)) for name in FINGERPRINT_ENV),
+        }
+        if EXCLUDE_DEPS:
+            inputs['exclude_deps'] = True
+
+        fingerprint = hashlib.sha256()
+        with open(self.full_path, 'rb') as f:
+            fingerprint.update(f.read())
+        fingerprint.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+
+        self._fingerprint = self.report.details['fingerprint'] = fingerprint.hexdigest()
+        return self._fingerprint
+
+    def is_up_to_date(self):
+        """Returns True if the deployed archive was built from inputs with the same fingerprint."""
+        target = self.bucket.bucket.Object(deployed_key_name(self.deploy_name))
+        try:
+            target.load()
+        except ClientError as e:
+            if e.response['Error']['Code'] != "404":
+                raise
+            return False
+
+        return target.metadata.get(FINGERPRINT_METADATA) == self.fingerprint
+
+    def fetch_dep(self, dep, path):
+        """Looks up a dependency and streams its archive from S3 (or the local cache) into the given directory."""
+        started = time.time()
+        key_name, key, upstream = self.lookup_dep(dep)
+        looked_up = time.time()
+
+        cached = layer = False
+        download = None
+        if key and self.layers:
+            # With the layer store, path is ignored; the layer is materialized from the store.
+            path = self.layers.get(key)
+            layer = path is not None
+            cached = layer
+
+        if key and not layer:
+            # Download and extraction overlap; the archive only touches the disk to be cached.
+            download = ProgressReporter(dep, total=key.content_length)
+            archive = self.cache.open(key, TRANSFER, reporter=download)
+
+            def extract(path):
+                with archive as f:
+                    extract_tree(f, path, threads=EXTRACT_THREADS)
+
+            if self.layers:
+                path = self.layers.add(key, extract)
+            else:
+                extract(path)
+            download.finish()
+            cached = archive.hit
+
+        return FetchedDep(dep, key_name, key, upstream, cached, path, looked_up - started, time.time() - looked_up, download, layer)
+
+    def compiler_cache(self):
+        name = cache_name(self.path)
+        return CompilerCache(name, os.path.join(CACHE_DIR, 'ccache', name), os.path.join(CACHE_DIR, 'ccache-state', name),
+                             max_size=CCACHE_MAX_SIZE * 1024 * 1024, bucket=lambda: self.bucket, prefix=CCACHE_PREFIX, codec=self.codec, transfer=TRANSFER)
 
-            for dep in deps:
-                print_stderr('  - {}'.format(dep))
+    def resolve_deps(self):
 
-                key_name = '{}{}.tar.gz'.format(S3_PREFIX, dep)
-                key = get_with_wildcard(self.bucket.bucket, key_name)
+        # Dependency metadata, extracted from bash comments.
+        deps = self.all_deps
 
-                if not key and self.upstream:
-                    print_stderr('    Not found in S3_BUCKET, trying UPSTREAM_S3_BUCKET...')
-                    key_name = '{}{}.tar.gz'.format(UPSTREAM_S3_PREFIX, dep)
-                    key = get_with_wildcard(self.upstream.bucket, key_name)
+        if deps:
+            self.check_lock(deps)
 
-                if not key:
-                    print_stderr('Archive {} does not exist.\n'
-                                 'Please deploy it to continue.'.format(key_name), title='ERROR')
-                    sys.exit(1)
+            transitive = len([dep for dep in deps if dep not in self.depends_on])
+            print_stderr('Fetching dependencies... found {}{}:'.format(
+                len(deps), ' ({} transitive)'.format(transitive) if transitive else ''))
 
-                # Grab the Dep from S3, download it to a temp file.
-                archive = mkstemp(prefix='bob-dep-', suffix='.tar.gz')[1]
-                key.download_file(archive)
+            workers = min(FETCH_WORKERS, len(deps))
+            pool = ThreadPoolExecutor(max_workers=workers)
 
-                # Extract the Dep to the appropriate location.
-                extract_tree(archive, self.build_path)
+            # Concurrent fetches each extract into their own staging directory (next to the build path,
+            # so moving files out of it is a rename), which are then merged in declaration order,
+            # so that files from later dependencies still overwrite those from earlier ones.
+            # With the layer store, every dependency is extracted into its own layer in the store instead.
+            staging = None
+            if workers > 1 and not self.layers:
+                staging = mkdtemp(prefix='bob-deps-', dir=os.path.dirname(os.path.normpath(self.build_path)))
+
+            try:
+                fetches = []
+                for i, dep in enumerate(deps):
+                    path = os.path.join(staging, str(i)) if staging else None if self.layers else self.build_path
+                    fetches.append(pool.submit(self.fetch_dep, dep, path))
+
+                for dep, fetch in zip(deps, fetches):
+                    try:
+                        fetched = fetch.result()
+                    except ClientError as e:
+                        if e.response['Error']['Code'] not in ('PreconditionFailed', '412'):
+                            raise
+                        print_stderr('Archive for {} changed since it was {}.\n'
+                                     'Please {} to continue.'.format(
+                                         dep, 'locked' if self.locks else 'listed',
+                                         'run "bob lock {}"'.format(self.path) if self.locks else 'use --refresh-index'),
+                                     title='ERROR')
+                        sys.exit(1)
+
+                    print_stderr('  - {}'.format(fetched.dep))
+
+                    if fetched.upstream:
+                        print_stderr('    Not found in S3_BUCKET, trying UPSTREAM_S3_BUCKET...')
+
+                    if not fetched.key:
+                        print_stderr('Archive {} does not exist.\n'
+                                     'Please deploy it to continue.'.format(fetched.key_name), title='ERROR')
+                        sys.exit(1)
+
+                    source = 'layer hit' if fetched.layer else 'cache hit and extract' if fetched.cached else 'download and extract'
+                    timings = 'lookup {:.2f}s, {} {:.2f}s'.format(fetched.lookup_time, source, fetched.fetch_time)
+                    if not fetched.cached:
+                        timings += ' ({:.1f} MB at {:.1f} MB/s)'.format(fetched.download.transferred / MB, fetched.download.rate / MB)
+
+                    self.report.add('dep {} lookup'.format(dep), fetched.lookup_time)
+                    self.report.add('dep {} {}'.format(dep, source), fetched.fetch_time,
+                                    bytes=fetched.key.content_length, cached=fetched.cached)
+
+                    if self.layers:
+                        with self.report.phase('dep {} materialize'.format(dep)) as materialize:
+                            self.layers.materialize(fetched.path, self.build_path)
+                        timings += ', {} {:.2f}s'.format(self.layers.method, materialize['wall_time'])
+                    elif staging:
+                        with self.report.phase('dep {} merge'.format(dep)) as merge:
+                            merge_tree(fetched.path, self.build_path)
+                        timings += ', merge {:.2f}s'.format(merge['wall_time'])
+
+                    print_stderr('    {}'.format(timings))
+            finally:
+                pool.shutdown(cancel_futures=True)
+                if staging:
+                    shutil.rmtree(staging, ignore_errors=True)
 
             print_stderr()
 
     def build(self):
         # Prepare build directory.
-        if os.path.exists(self.build_path):
-                shutil.rmtree(self.build_path)
-        mkdir_p(self.build_path)
+        with self.report.phase('cleanup'):
+            reset_dir(self.build_path)
+
+        with self.report.phase('dependencies'):
+            self.resolve_deps()
 
-        self.resolve_deps()
+        if EXCLUDE_DEPS:
+            with self.report.phase('dependency snapshot'):
+                self.dep_snapshot = snapshot_tree(self.build_path)
 
         # Temporary directory where work will be carried out, because of David.
         cwd_path = mkdtemp(prefix='bob-')
@@ -140,9 +606,46 @@ class Formula(object):
         if self.override_path != None:
             args.append(self.override_path)
 
-        p = Popen(args, cwd=cwd_path, shell=False, stderr=sys.stdout.fileno()) # we have to pass sys.stdout.fileno(), because subprocess.STDOUT will not do what we want on older versions: https://bugs.python.org/issue22274
+        # build-all shares one jobserver between the formulas it builds at once
+        jobserver = inherited_jobserver()
+        env = dict(os.environ, **job_environment(JOBS, jobserver))
+        proxy = None
+        if SOURCE_CACHE:
+            # downloads are served from (and added to) the source cache
+            proxy = SourceProxy(get_sources()).start()
+            env.update(proxy.environment())
+            env['BOB_FETCH'] = '{} -m bob fetch'.format(shlex.quote(sys.executable))
+            print_stderr('Source cache proxy: {}\n'.format(proxy.url))
+
+        compiler_cache = None
+        if CCACHE:
+            compiler_cache = self.compiler_cache()
+            if compiler_cache.available:
+                with self.report.phase('compiler cache restore'):
+                    compiler_cache.restore()
+                env.update(compiler_cache.environment(cwd_path))
+            else:
+                print_stderr('ccache is not installed, building without a compiler cache.', title='NOTICE')
+                compiler_cache = None
+
+        started = time.time()
+        try:
+            p = Popen(args, cwd=cwd_path, shell=False, stderr=sys.stdout.fileno(), env=env, pass_fds=jobserver or ()) # we have to pass sys.stdout.fileno(), because subprocess.STDOUT will not do what we want on older versions: https://bugs.python.org/issue22274
+
+            # wait4() rather than p.wait(), for the resource usage of the script and everything it waited for
+            _, status, rusage = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+        finally:
+            if proxy:
+                proxy.stop()
+
+        # even a failed build leaves compiled objects worth keeping
+        if compiler_cache:
+            with self.report.phase('compiler cache save'):
+                compiler_cache.save()
 
-        p.wait()
+        self.report.add('script', time.time() - started, cpu_user=rusage.ru_utime, cpu_system=rusage.ru_stime,
+                        max_rss=rusage.ru_maxrss * 1024)  # ru_maxrss is in kilobytes on Linux
 
         if p.returncode > 0:
             print_stderr('Formula exited with return code {}.'.format(p.returncode), title='ERROR')
@@ -157,32 +660,30 @@ class Formula(object):
             print_stderr('Formula terminated by signal {}.'.format(signame), title='ERROR')
             sys.exit(128+signum) # best we can do, given how we weren't terminated ourselves with the same signal (maybe we're PID 1, maybe another reason)
 
+        self.report.details['build_size'] = tree_size(self.build_path)
+
         print_stderr('\nBuild complete: {}'.format(self.build_path))
 
     def archive(self):
-        """Archives the build directory as a tar.gz."""
-        archive = mkstemp(prefix='bob-build-', suffix='.tar.gz')[1]
-        archive_tree(self.build_path, archive)
+        """Archives the build directory with the configured codec."""
+        archive = mkstemp(prefix='bob-build-', suffix=self.codec.extension)[1]
+        with self.report.phase('archive', codec=self.codec.name) as phase:
+            self.excluded = archive_tree(self.build_path, archive, codec=self.codec.name, threads=ARCHIVE_THREADS,
+                                         exclude=self.dep_snapshot)
+            phase['bytes'] = os.path.getsize(archive)
+        self.report.details['artifact_size'] = phase['bytes']
+        self.report_excluded()
 
         print_stderr('Created: {}'.format(archive))
         self.archived_path = archive
 
-    def deploy(self, allow_overwrite=False):
-        """Deploys the formula's archive to S3."""
-        assert self.archived_path
-
+    def deploy_target(self, allow_overwrite=False):
+        """Returns the S3 object the formula's archive deploys to, once it's clear we may write it."""
         if self.bucket.anon:
             print_stderr('Deploy requires valid AWS credentials.', title='ERROR')
             sys.exit(1)
 
-        if self.override_path != None:
-            name = self.override_path
-        else:
-            name = self.path
-
-        key_name = '{}{}.tar.gz'.format(S3_PREFIX, name)
-
-        target = self.bucket.bucket.Object(key_name)
+        target = self.bucket.bucket.Object(deployed_key_name(self.deploy_name))
         try:
             target.load()
             if not allow_overwrite:
@@ -197,7 +698,83 @@ class Formula(object):
         # boto can only generate URLs with expiry, so we're splitting off the signature part, as our URLs are always expected to be public
         print_stderr('Uploading to: {}'.format(urlsplit(url)._replace(query=None).geturl()))
 
-        # Upload the archive
-        target.upload_file(self.archived_path)
+        return target
+
+    def deploy(self, allow_overwrite=False):
+        """Deploys the formula's archive to S3."""
+        assert self.archived_path
 
-        print_stderr('Upload complete!')
+        target = self.deploy_target(allow_overwrite=allow_overwrite)
+
+        # Upload the archive
+        upload = ProgressReporter('Uploading', total=os.path.getsize(self.archived_path), indent='')
+        target.upload_file(self.archived_path, Config=TRANSFER.boto3_config(), Callback=upload,
+                           ExtraArgs={'Metadata': {FINGERPRINT_METADATA: self.fingerprint}})
+        upload.finish()
+        self.report.add('upload', upload.elapsed, bytes=upload.transferred)
+
+        print_stderr('Upload complete! {}'.format(upload.summary()))
+        self.deploy_manifest(target)
+
+    def archive_and_deploy(self, allow_overwrite=False):
+        """Archives the build directory straight into a multipart upload to S3, without an intermediate file."""
+        target = self.deploy_target(allow_overwrite=allow_overwrite)
+
+        # Parts upload while later files are still being compressed.
+        upload = ProgressReporter('Uploading', indent='')
+        with MultipartUploadWriter(target, TRANSFER, reporter=upload,
+                                   extra_args={'Metadata': {FINGERPRINT_METADATA: self.fingerprint}}) as writer:
+            self.excluded = archive_tree(self.build_path, writer, codec=self.codec.name, threads=ARCHIVE_THREADS,
+                                         exclude=self.dep_snapshot)
+        upload.finish()
+        self.report_excluded()
+        self.report.add('archive and upload', upload.elapsed, bytes=upload.transferred, codec=self.codec.name)
+        self.report.details['artifact_size'] = upload.transferred
+
+        print_stderr('Upload complete! {}'.format(upload.summary()))
+        self.deploy_manifest(target)
+
+    def report_excluded(self):
+        if self.dep_snapshot is None:
+            return
+
+        excluded_files = [path for path in self.excluded if self.dep_snapshot[path][0] == 'f']
+        excluded_size = sum(self.dep_snapshot[path][1] for path in excluded_files)
+        self.report.details['excluded_files'] = len(excluded_files)
+        self.report.details['excluded_size'] = excluded_size
+        print_stderr('Left out {} files ({:.1f} MB) provided by dependencies.'.format(len(excluded_files), excluded_size / MB))
+
+    def manifest(self):
+        """Describes the dependencies a build used and the files from them its archive leaves out."""
+        dependencies = []
+        for dep in self.all_deps:
+            _, key, _ = self.lookup_dep(dep)
+            dependencies.append({'name': dep, 'bucket': key.bucket_name, 'key': key.key, 'etag': key.e_tag})
+
+        files = {}
+        for path in self.excluded:
+            entry = self.dep_snapshot[path]
+            if entry[0] == 'f':
+                files[path] = {'type': 'file', 'size': entry[1], 'mode': entry[2], 'mtime_ns': entry[3]}
+            elif entry[0] == 'l':
+                files[path] = {'type': 'symlink', 'target': entry[1]}
+            else:
+                files[path] = {'type': 'directory'}
+
+        return {
+            'formula': self.path,
+            'name': self.deploy_name,
+            'fingerprint': self.fingerprint,
+            'created_at': time.time(),
+            'dependencies': dependencies,
+            'excluded': files,
+        }
+
+    def deploy_manifest(self, target):
+        """Uploads the manifest of an archive built with EXCLUDE_DEPS next to it."""
+        if self.dep_snapshot is None:
+            return
+
+        manifest = target.Bucket().Object(target.key + MANIFEST_SUFFIX)
+        manifest.put(Body=json.dumps(self.manifest(), indent=2, sort_keys=True).encode('utf-8'), ContentType='application/json')
+        print_stderr('Manifest: {}/{}'.format(manifest.bucket_name, manifest.key))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from .utils import print_stderr
+
+
+class BuildReport(object):
+    """
+    Per-phase timings of a build or deploy.
+
+    Each phase records its wall time, and optionally the bytes it moved (giving a throughput)
+    and any other details, such as the CPU time and peak RSS of the formula script.
+    """
+
+    def __init__(self, formula):
+        self.formula = formula
+        self.started_at = time.time()
+        self.phases = []
+        self.details = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, wall_time, bytes=None, **details):
+        phase = {'name': name, 'wall_time': round(wall_time, 6)}
+        if bytes is not None:
+            phase['bytes'] = bytes
+            phase['throughput'] = round(bytes / wall_time, 1) if wall_time else None
+        phase.update(details)
+
+        with self.lock:
+            self.phases.append(phase)
+        return phase
+
+    @contextmanager
+    def phase(self, name, **details):
+        """
+        Times the with block as a phase.
+
+        The yielded dict can be updated with more details (e.g. bytes), and holds the recorded phase afterwards.
+        """
+        started = time.time()
+        details = dict(details)
+        yield details
+        details.update(self.add(name, time.time() - started, **details))
+
+    def phase_time(self, name):
+        return sum(phase['wall_time'] for phase in self.phases if phase['name'] == name)
+
+    def to_dict(self):
+        return {
+            'formula': self.formula,
+            'started_at': self.started_at,
+            'wall_time': round(time.time() - self.started_at, 6),
+            'phases': self.phases,
+            'details': self.details,
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+    def print_summary(self):
+        print_stderr('\nTimings for {}:'.format(self.formula))
+        print_stderr('  {:<48} {:>10} {:>10} {:>10}'.format('phase', 'seconds', 'MB', 'MB/s'))
+
+        for phase in self.phases:
+            size = throughput = ''
+            if phase.get('bytes') is not None:
+                size = '{:.1f}'.format(phase['bytes'] / 1024 / 1024)
+                if phase.get('throughput') is not None:
+                    throughput = '{:.1f}'.format(phase['throughput'] / 1024 / 1024)
+            print_stderr('  {:<48} {:>10.2f} {:>10} {:>10}'.format(phase['name'], phase['wall_time'], size, throughput))
+
+            if 'cpu_user' in phase:
+                print_stderr('  {:<48} user {:.2f}s, system {:.2f}s, peak RSS {:.1f} MB'.format(
+                    '', phase['cpu_user'], phase['cpu_system'], phase['max_rss'] / 1024 / 1024))
+
+        print_stderr('  {:<48} {:>10.2f}'.format('total', time.time() - self.started_at))
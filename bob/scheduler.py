@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import threading
+from collections import namedtuple
+from fnmatch import fnmatchcase
+
+from natsort import natsorted
+
+from .utils import print_stderr, read_markers, split_deps
+
+# A formula found in the workspace, with the dependencies and build path its markers declare.
+WorkspaceFormula = namedtuple('WorkspaceFormula', ['path', 'full_path', 'deps', 'build_path'])
+
+
+def scan_workspace(workspace, deps_marker, build_path_marker, default_build_path):
+    """Finds all formulas (executable scripts starting with a shebang) below the workspace directory."""
+    formulas = {}
+
+    for root, dirs, files in os.walk(workspace):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            if name.startswith('.') or name.endswith('.lock'):
+                continue
+
+            with open(full_path, 'rb') as f:
+                if f.read(2) != b'#!':
+                    continue
+
+            markers = read_markers(full_path, [deps_marker, build_path_marker])
+            deps = [dep for line in markers[deps_marker] for dep in split_deps(line)]
+            build_path = markers[build_path_marker][0] if markers[build_path_marker] else default_build_path
+
+            path = os.path.relpath(full_path, workspace)
+            formulas[path] = WorkspaceFormula(path, os.path.abspath(full_path), deps, build_path)
+
+    return formulas
+
+
+def resolve_workspace_dep(formulas, dep):
+    """Returns the workspace formula a dependency refers to (the highest version for wildcards), or None."""
+    if '*' not in dep:
+        return dep if dep in formulas else None
+
+    matches = natsorted(path for path in formulas if fnmatchcase(path, dep))
+    return matches[-1] if matches else None
+
+
+class BuildGraph(object):
+    """The dependency graph of a workspace's formulas; deps that aren't formulas in it must already be deployed."""
+
+    def __init__(self, formulas):
+        self.formulas = formulas
+        self.requires = {}
+        self.required_by = dict((path, set()) for path in formulas)
+
+        for path, formula in formulas.items():
+            self.requires[path] = set()
+            for dep in formula.deps:
+                target = resolve_workspace_dep(formulas, dep)
+                if target:
+                    self.requires[path].add(target)
+                    self.required_by[target].add(path)
+
+        self.check_cycles()
+
+    def check_cycles(self):
+        visiting, done = set(), set()
+
+        def visit(path, trail):
+            if path in done:
+                return
+            if path in visiting:
+                cycle = trail[trail.index(path):] + [path]
+                raise ValueError('Dependency cycle: {}'.format(' -> '.join(cycle)))
+
+            visiting.add(path)
+            for dep in sorted(self.requires[path]):
+                visit(dep, trail + [path])
+            visiting.discard(path)
+            done.add(path)
+
+        for path in sorted(self.formulas):
+            visit(path, [])
+
+    def downstream(self, paths):
+        """Returns the given formulas plus everything that depends on them, directly or not."""
+        result = set()
+        pending = list(paths)
+        while pending:
+            path = pending.pop()
+            if path not in result:
+                result.add(path)
+                pending.extend(self.required_by[path])
+        return result
+
+    def levels(self, selected):
+        """Groups the selected formulas into levels, each only depending on formulas in earlier ones."""
+        remaining = set(selected)
+        levels = []
+        while remaining:
+            level = natsorted(path for path in remaining if not self.requires[path] & remaining)
+            levels.append(level)
+            remaining.difference_update(level)
+        return levels
+
+
+class Scheduler(object):
+    """
+    Deploys formulas in dependency order, running up to jobs of them at once.
+
+    Every formula is deployed by its own `bob deploy` process, with its output prefixed by the
+    formula's path. The build path is compiled into the binaries, so it cannot be moved to keep
+    parallel builds apart; instead, formulas sharing a build path never run at the same time.
+    When a formula fails, everything depending on it is skipped.
+
+    With a jobserver (a jobs.Jobserver), every formula's make draws its parallel jobs from the
+    jobserver's shared pool, and other build tools are told their share of the cpus in $BOB_JOBS.
+    """
+
+    def __init__(self, graph, selected, jobs=1, deploy_args=(), jobserver=None, cpus=1):
+        self.graph = graph
+        self.selected = set(selected)
+        self.jobs = max(jobs, 1)
+        self.deploy_args = list(deploy_args)
+        self.jobserver = jobserver
+        self.cpus = cpus
+
+        self.condition = threading.Condition()
+        self.output_lock = threading.Lock()
+        self.done, self.failed, self.skipped, self.running = set(), set(), set(), set()
+        self.busy_paths = set()
+
+    def is_ready(self, path):
+        formula = self.graph.formulas[path]
+        return (formula.build_path not in self.busy_paths
+                and all(dep in self.done or dep not in self.selected for dep in self.graph.requires[path]))
+
+    def run(self):
+        pending = set(self.selected)
+        threads = []
+
+        with self.condition:
+            while pending or self.running:
+                # anything downstream of a failure will never become ready
+                blocked = self.graph.downstream(self.failed | self.skipped) & pending
+                for path in natsorted(blocked):
+                    pending.discard(path)
+                    self.skipped.add(path)
+                    print_stderr('[{}] skipped, a dependency failed'.format(path))
+
+                ready = [path for path in natsorted(pending) if self.is_ready(path)]
+                while ready and len(self.running) < self.jobs:
+                    path = ready.pop(0)
+                    if not self.is_ready(path):
+                        continue
+                    pending.discard(path)
+                    self.running.add(path)
+                    self.busy_paths.add(self.graph.formulas[path].build_path)
+
+                    thread = threading.Thread(target=self.deploy, args=(path,))
+                    thread.start()
+                    threads.append(thread)
+
+                if pending or self.running:
+                    self.condition.wait()
+
+        for thread in threads:
+            thread.join()
+
+        return not self.failed and not self.skipped
+
+    def deploy(self, path):
+        args = [sys.executable, '-m', 'bob', 'deploy', path] + self.deploy_args
+        env, fds = None, ()
+        if self.jobserver:
+            env = dict(os.environ, BOB_JOBS=str(max(self.cpus // self.jobs, 1)), **self.jobserver.environment())
+            fds = self.jobserver.fds
+
+        returncode = None
+        try:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, pass_fds=fds)
+            for line in p.stdout:
+                with self.output_lock:
+                    sys.stdout.write('[{}] {}'.format(path, line.decode('utf-8', 'replace')))
+                    sys.stdout.flush()
+            returncode = p.wait()
+        finally:
+            with self.condition:
+                self.running.discard(path)
+                self.busy_paths.discard(self.graph.formulas[path].build_path)
+                if returncode == 0:
+                    self.done.add(path)
+                    print_stderr('[{}] deployed'.format(path))
+                else:
+                    self.failed.add(path)
+                    print_stderr('[{}] failed with exit status {}'.format(path, returncode))
+                self.condition.notify()
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import selectors
+import shutil
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import mkstemp
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from botocore.exceptions import ClientError
+
+from .utils import mkdir_p, print_stderr
+
+# Attempts at downloading a source from its upstream host, which are not always reliable.
+DOWNLOAD_ATTEMPTS = 3
+
+# What S3 answers for objects missing from the mirror, or ones we may not read.
+MIRROR_MISSING = ('NoSuchKey', '404', 'AccessDenied', '403')
+
+
+# The response headers relayed for HEAD requests.
+FORWARDED_HEADERS = ('Content-Type', 'Content-Length', 'ETag', 'Last-Modified', 'Location')
+
+
+def select_validators(validators):
+    """Returns the etag and last_modified of validators (a stored entry, or None) that are set."""
+    return dict((name, validators[name]) for name in ('etag', 'last_modified') if validators and validators.get(name))
+
+
+class SourceStore(object):
+    """
+    A content-addressed on-disk store of downloaded source tarballs.
+
+    Objects are stored under their SHA-256, and every URL fetched maps to the object it returned,
+    so the same tarball behind different URLs is stored once. Downloads are verified against an
+    expected checksum when one is given; without one, the upstream host is asked whether what's
+    stored for a URL changed every time it's requested (see get()). The least recently used
+    objects are evicted once the store grows beyond max_size bytes.
+
+    With a mirror (a callable returning a utils.Bucket) and mirror_prefix, objects missing
+    locally are looked for in the bucket before going upstream, and new downloads are copied to
+    it (given credentials), so other build machines can warm their stores from it.
+    """
+
+    def __init__(self, path, max_size, mirror=None, mirror_prefix=''):
+        self.path = path
+        self.max_size = max_size
+        self.mirror = mirror
+        self.mirror_prefix = mirror_prefix
+        self._mirror_bucket = None
+
+        self.lock = threading.Lock()
+        self.url_locks = {}
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def url_name(self, url):
+        return '{}.json'.format(hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def lookup(self, url):
+        """Returns what was stored for a URL (its digest and the validators of its response), or None."""
+        try:
+            with open(os.path.join(self.path, 'urls', self.url_name(url))) as f:
+                entry = json.load(f)
+            digest = entry['sha256']
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return entry if os.path.exists(self.object_path(digest)) else None
+
+    def get(self, url, sha256=None):
+        """
+        Returns the path of the stored source for a URL, downloading it if needed.
+
+        With sha256, whatever is stored under that checksum is used as is. Without one, the
+        upstream host is asked whether the stored source is still current (with If-None-Match
+        and If-Modified-Since), and it is downloaded again if it isn't; the stored source is only
+        used without asking if the host can't be reached.
+
+        Raises ValueError if sha256 is given and the source doesn't match it, and
+        urllib.error.URLError (or HTTPError) if it can't be downloaded.
+        """
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+
+        # concurrent requests for one URL wait for a single download
+        with url_lock:
+            digest = self.get_pinned(url, sha256) if sha256 else self.revalidate(url)
+
+        return self.object_path(digest)
+
+    def hit(self, url, digest, message='Source cache hit'):
+        # the modification time tracks the last use, for LRU eviction
+        os.utime(self.object_path(digest))
+        print_stderr('    {}: {}'.format(message, url))
+        return digest
+
+    def get_pinned(self, url, sha256):
+        if not os.path.exists(self.object_path(sha256)):
+            return self.fetch_mirror(url, sha256) or self.download(url, sha256)
+
+        entry = self.lookup(url)
+        if not entry or entry['sha256'] != sha256:
+            self.save_url(url, sha256)
+        return self.hit(url, sha256)
+
+    def revalidate(self, url):
+        entry = self.lookup(url)
+        # the mirror's copy is as good as ours, once upstream confirms it
+        stored = entry or self.mirror_entry(url)
+
+        try:
+            digest = self.download(url, stored=stored)
+        except (URLError, OSError) as e:
+            # a source that's gone upstream is gone, but a host that's down doesn't make ours stale
+            if not entry or (isinstance(e, HTTPError) and e.code < 500):
+                raise
+            print_stderr('Could not check {} for changes, using the stored source: {}'.format(url, e), title='WARNING')
+            return self.hit(url, entry['sha256'])
+
+        if digest:
+            return digest
+        if entry:
+            return self.hit(url, entry['sha256'], 'Source cache hit, not modified upstream')
+        return self.fetch_mirror(url, stored['sha256'], validators=stored) or self.download(url)
+
+    def save_url(self, url, digest, validators=None):
+        mkdir_p(os.path.join(self.path, 'urls'))
+        fd, temp_path = mkstemp(prefix='.partial-', dir=os.path.join(self.path, 'urls'))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(url=url, sha256=digest, stored_at=time.time(), **select_validators(validators)), f)
+        os.replace(temp_path, os.path.join(self.path, 'urls', self.url_name(url)))
+
+    def store(self, reader, sha256=None):
+        """Stores what reader returns under its digest; returns the digest."""
+        mkdir_p(os.path.join(self.path, 'objects'))
+        fd, temp_path = mkstemp(prefix='.partial-', dir=os.path.join(self.path, 'objects'))
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: reader.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            digest = digest.hexdigest()
+            if sha256 and digest != sha256:
+                raise ValueError('Checksum mismatch: expected sha256 {}, got {}'.format(sha256, digest))
+
+            mkdir_p(os.path.dirname(self.object_path(digest)))
+            os.replace(temp_path, self.object_path(digest))
+            return digest
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def download(self, url, sha256=None, stored=None):
+        """
+        Downloads a URL's source from its upstream host into the store; returns its digest.
+
+        With stored, what the store (or the mirror) has for the URL, the request is conditional,
+        and None is returned if the source wasn't modified since.
+        """
+        headers = {}
+        if stored and stored.get('etag'):
+            headers['If-None-Match'] = stored['etag']
+        if stored and stored.get('last_modified'):
+            headers['If-Modified-Since'] = stored['last_modified']
+
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            if stored:
+                print_stderr('    Source stored, checking for changes upstream: {}'.format(url))
+            else:
+                print_stderr('    Source cache miss, downloading: {}'.format(url))
+            try:
+                with urlopen(Request(url, headers=headers), timeout=60) as response:
+                    digest = self.store(response, sha256)
+                    validators = response.headers
+                break
+            except HTTPError as e:
+                if e.code == 304 and stored:
+                    return None
+                # retrying won't turn a 404 into something else
+                if e.code < 500 or attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+            except (URLError, OSError):
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+            time.sleep(2 ** attempt)
+
+        self.save_url(url, digest, validators={'etag': validators.get('ETag'), 'last_modified': validators.get('Last-Modified')})
+        self.push_mirror(url, digest)
+        self.prune()
+        return digest
+
+    def mirror_bucket(self):
+        with self.lock:
+            if self.mirror and self._mirror_bucket is None:
+                self._mirror_bucket = self.mirror()
+            return self._mirror_bucket
+
+    def mirror_entry(self, url):
+        """Returns what the mirror has for a URL (like lookup()), or None."""
+        bucket = self.mirror_bucket()
+        if not bucket:
+            return None
+
+        try:
+            return json.loads(bucket.bucket.Object(self.mirror_prefix + 'urls/' + self.url_name(url)).get()['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in MIRROR_MISSING:
+                raise
+        except ValueError:
+            pass
+        return None
+
+    def fetch_mirror(self, url, sha256, validators=None):
+        """Copies the source with the given digest from the mirror, if it's there; returns its digest or None."""
+        bucket = self.mirror_bucket()
+        if not bucket:
+            return None
+
+        try:
+            body = bucket.bucket.Object(self.mirror_prefix + 'objects/' + sha256).get()['Body']
+            # objects are verified against their address, so a bad copy in the bucket is never used
+            digest = self.store(body, sha256)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in MIRROR_MISSING:
+                raise
+            return None
+        except ValueError:
+            return None
+
+        self.save_url(url, digest, validators=validators)
+        print_stderr('    Source cache miss, copied from the mirror: {}'.format(url))
+        self.prune()
+        return digest
+
+    def push_mirror(self, url, digest):
+        bucket = self.mirror_bucket()
+        if not bucket or bucket.anon:
+            return
+
+        try:
+            bucket.bucket.upload_file(self.object_path(digest), self.mirror_prefix + 'objects/' + digest)
+            # with the validators, so other machines can check with upstream before using it
+            with open(os.path.join(self.path, 'urls', self.url_name(url))) as f:
+                bucket.bucket.put_object(Key=self.mirror_prefix + 'urls/' + self.url_name(url), Body=f.read().encode('utf-8'))
+        except ClientError as e:
+            print_stderr('Could not copy {} to the source mirror: {}'.format(url, e), title='WARNING')
+
+    def entries(self):
+        """Returns a list of (path, size, last use) tuples, least recently used first."""
+        entries = []
+        for root, dirs, files in os.walk(os.path.join(self.path, 'objects')):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((os.path.join(root, name), stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def stats(self):
+        """Returns the number of stored sources and their total size in bytes."""
+        entries = self.entries()
+        return len(entries), sum(entry[1] for entry in entries)
+
+    def prune(self, max_size=None):
+        """Evicts least recently used sources until the store fits max_size; returns the count and bytes removed."""
+        if max_size is None:
+            max_size = self.max_size
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        removed = freed = 0
+
+        for path, entry_size, _ in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            removed += 1
+            freed += entry_size
+
+        return removed, freed
+
+
+class SourceProxy(object):
+    """
+    A local HTTP forward proxy serving GET requests from a SourceStore, for the formula scripts.
+
+    Plain HTTP downloads (e.g. `curl http://...` with http_proxy set) are cached, and revalidated
+    with the upstream host whenever they're requested again; HEAD requests go upstream. HTTPS can't be
+    cached without intercepting TLS, so CONNECT requests are tunnelled to the upstream host as is;
+    formulas can fetch HTTPS sources through the cache with $BOB_FETCH instead.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.server = None
+
+    def start(self):
+        handler = type('Handler', (_ProxyHandler,), {'store': self.store})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def environment(self):
+        """Returns the environment variables that make curl, wget, pip etc. use the proxy."""
+        env = {}
+        for name in ['http_proxy', 'https_proxy']:
+            env[name] = env[name.upper()] = self.url
+        env['no_proxy'] = env['NO_PROXY'] = 'localhost,127.0.0.1'
+        return env
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def do_GET(self):
+        if not self.path.startswith('http://'):
+            self.send_error(400, 'Only proxy requests for http:// URLs are supported')
+            return
+
+        try:
+            path = self.store.get(self.path)
+        except HTTPError as e:
+            self.send_error(e.code, str(e.reason))
+            return
+        except (URLError, OSError, ValueError) as e:
+            self.send_error(502, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_HEAD(self):
+        if not self.path.startswith('http://'):
+            self.send_error(400, 'Only proxy requests for http:// URLs are supported')
+            return
+
+        # nothing to cache, and no reason to download the source for it
+        try:
+            response = urlopen(Request(self.path, method='HEAD'), timeout=60)
+        except HTTPError as e:
+            response = e
+        except (URLError, OSError) as e:
+            self.send_error(502, str(e))
+            return
+
+        with response:
+            self.send_response(response.status)
+            for name in FORWARDED_HEADERS:
+                if response.headers.get(name):
+                    self.send_header(name, response.headers[name])
+            self.end_headers()
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=60)
+        except (OSError, ValueError) as e:
+            self.send_error(502, str(e))
+            return
+
+        self.send_response(200, 'Connection Established')
+        self.end_headers()
+
+        with upstream, selectors.DefaultSelector() as selector:
+            selector.register(self.connection, selectors.EVENT_READ, upstream)
+            selector.register(upstream, selectors.EVENT_READ, self.connection)
+            while True:
+                events = selector.select(timeout=300)
+                if not events:
+                    return
+                for key, _ in events:
+                    data = key.fileobj.recv(64 * 1024)
+                    if not data:
+                        return
+                    key.data.sendall(data)
+
+    def log_message(self, format, *args):
+        pass
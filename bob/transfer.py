@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import print_stderr
+
+MB = 1024 * 1024
+
+
+class TransferSettings(object):
+    """Part size, concurrency and bandwidth limit (in bytes per second, 0 for none) for S3 transfers."""
+
+    def __init__(self, part_size=16 * MB, concurrency=8, max_bandwidth=0):
+        self.part_size = max(part_size, 5 * MB)  # S3's minimum for all but the last part
+        self.concurrency = max(concurrency, 1)
+        self.max_bandwidth = max_bandwidth
+
+    def boto3_config(self):
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(multipart_threshold=self.part_size, multipart_chunksize=self.part_size,
+                              max_concurrency=self.concurrency, max_bandwidth=self.max_bandwidth or None)
+
+    def throttle(self):
+        return Throttle(self.max_bandwidth) if self.max_bandwidth else None
+
+
+class Throttle(object):
+    """Limits the combined rate of the transfers sharing it by making them sleep."""
+
+    def __init__(self, max_bandwidth):
+        self.max_bandwidth = max_bandwidth
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.transferred = 0
+
+    def consume(self, amount):
+        with self.lock:
+            self.transferred += amount
+            delay = self.started + self.transferred / self.max_bandwidth - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ProgressReporter(object):
+    """
+    Tracks the progress of a transfer, printing throughput and ETA to stderr every few seconds.
+
+    Instances are callable with a byte count, like the callbacks boto3's transfer methods take.
+    """
+
+    interval = 5
+
+    def __init__(self, label, total=None, indent='    '):
+        self.label = label
+        self.total = total
+        self.indent = indent
+        self.lock = threading.Lock()
+        self.started = self.reported = time.time()
+        self.finished = None
+        self.transferred = 0
+
+    def __call__(self, amount):
+        with self.lock:
+            self.transferred += amount
+            now = time.time()
+            if now - self.reported < self.interval:
+                return
+            self.reported = now
+
+        message = '{}{}: {:.1f} MB'.format(self.indent, self.label, self.transferred / MB)
+        if self.total:
+            message += ' of {:.1f} MB'.format(self.total / MB)
+        message += ', {:.1f} MB/s'.format(self.rate / MB)
+        if self.total and self.rate:
+            message += ', ETA {:.0f}s'.format((self.total - self.transferred) / self.rate)
+        print_stderr(message)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """Bytes per second so far."""
+        return self.transferred / self.elapsed if self.elapsed else 0
+
+    def finish(self):
+        self.finished = time.time()
+        return self
+
+    def summary(self):
+        return '{:.1f} MB in {:.2f}s at {:.1f} MB/s'.format(self.transferred / MB, self.elapsed, self.rate / MB)
+
+
+def open_object(obj, settings, reporter=None):
+    """
+    Opens an S3 object for sequential reads.
+
+    Objects larger than a part are fetched with parallel byte-range GETs, the rest with a single GET.
+    """
+    throttle = settings.throttle()
+
+    if settings.concurrency > 1 and obj.content_length > settings.part_size:
+        return RangedReader(obj, settings, throttle=throttle, reporter=reporter)
+
+    # when the ETag is already known (from a lockfile or listing), make sure that's what we get
+    pinned = {'IfMatch': obj.meta.data['ETag']} if obj.meta.data and 'ETag' in obj.meta.data else {}
+
+    return _MeteredReader(obj.get(**pinned)['Body'], throttle=throttle, reporter=reporter)
+
+
+class _MeteredReader(object):
+
+    def __init__(self, body, throttle=None, reporter=None):
+        self.body = body
+        self.throttle = throttle
+        self.reporter = reporter
+
+    def read(self, size=-1):
+        data = self.body.read(size)
+        if self.throttle:
+            self.throttle.consume(len(data))
+        if self.reporter:
+            self.reporter(len(data))
+        return data
+
+    def close(self):
+        self.body.close()
+
+
+class RangedReader(object):
+    """
+    A sequential reader over an S3 object that fetches the parts ahead of the reader concurrently.
+
+    Each part is a byte-range GET pinned to the object's ETag, so a concurrent overwrite fails
+    the read instead of mixing two versions. At most settings.concurrency parts are held in memory.
+    """
+
+    def __init__(self, obj, settings, throttle=None, reporter=None):
+        self.obj = obj
+        self.etag = obj.e_tag
+        self.size = obj.content_length
+        self.part_size = settings.part_size
+        self.throttle = throttle
+        self.reporter = reporter
+
+        self.pool = ThreadPoolExecutor(max_workers=settings.concurrency)
+        self.offsets = iter(range(0, self.size, self.part_size))
+        self.pending = deque()
+        self.buffer = memoryview(b'')
+
+        for _ in range(settings.concurrency):
+            self._submit_next()
+
+    def _submit_next(self):
+        offset = next(self.offsets, None)
+        if offset is not None:
+            self.pending.append(self.pool.submit(self._fetch, offset))
+
+    def _fetch(self, offset):
+        byte_range = 'bytes={}-{}'.format(offset, min(offset + self.part_size, self.size) - 1)
+        data = self.obj.get(Range=byte_range, IfMatch=self.etag)['Body'].read()
+
+        if self.throttle:
+            self.throttle.consume(len(data))
+        if self.reporter:
+            self.reporter(len(data))
+        return data
+
+    def read(self, size=-1):
+        chunks = []
+
+        while size is None or size < 0 or size > 0:
+            if not self.buffer:
+                if not self.pending:
+                    break
+                self.buffer = memoryview(self.pending.popleft().result())
+                self._submit_next()
+
+            chunk = self.buffer if size is None or size < 0 else self.buffer[:size]
+            self.buffer = self.buffer[len(chunk):]
+            chunks.append(chunk)
+            if size is not None and size >= 0:
+                size -= len(chunk)
+
+        return b''.join(chunks)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+class MultipartUploadWriter(object):
+    """
+    A write-only file object that streams everything written to it into an S3 multipart upload.
+
+    Writes are cut into parts of settings.part_size bytes, which are uploaded on a pool of
+    settings.concurrency threads while the caller keeps producing data. Writers block once that
+    many parts are in flight, so memory use stays bounded at (concurrency + 1) * part_size.
+
+    Use it as a context manager: the upload is completed when the block exits cleanly, and
+    aborted (so S3 discards the parts) if it raises.
+    """
+
+    def __init__(self, obj, settings, extra_args=None, reporter=None):
+        self.client = obj.meta.client
+        self.bucket = obj.bucket_name
+        self.key = obj.key
+        self.part_size = settings.part_size
+        self.throttle = settings.throttle()
+        self.reporter = reporter
+
+        self.pool = ThreadPoolExecutor(max_workers=settings.concurrency)
+        self.slots = threading.BoundedSemaphore(settings.concurrency)
+        self.parts = []
+        self.buffer = bytearray()
+        self.bytes_written = 0
+
+        self.upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key, **(extra_args or {}))['UploadId']
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, body):
+        # fail early instead of compressing the rest of the archive for nothing
+        for part in self.parts:
+            if part.done() and part.exception():
+                raise part.exception()
+
+        self.slots.acquire()
+        part = self.pool.submit(self._upload_part, len(self.parts) + 1, body)
+        part.add_done_callback(lambda _: self.slots.release())
+        self.parts.append(part)
+
+    def _upload_part(self, number, body):
+        if self.throttle:
+            self.throttle.consume(len(body))
+
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body)
+
+        if self.reporter:
+            self.reporter(len(body))
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def complete(self):
+        if self.buffer or not self.parts:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        parts = [part.result() for part in self.parts]
+        self.pool.shutdown()
+
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.complete()
+            except BaseException:
+                self.abort()
+                raise
+        else:
+            self.abort()
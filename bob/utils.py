@@ -3,19 +3,28 @@
 from __future__ import print_function
 
 import errno
+import hashlib
+import json
 import os
+import re
+import shutil
+import stat
+import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 
-import boto3
-from botocore import UNSIGNED
-from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
 
 from fnmatch import fnmatchcase
 from natsort import natsorted
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .compression import CODECS, detect_codec
 
 Bucket = namedtuple('Bucket', ['bucket', 'anon'], defaults=[False])
 
@@ -23,18 +32,37 @@ def print_stderr(message='', title=''):
     print(('\n{1}: {0}\n' if title else '{0}').format(message, title), file=sys.stderr)
 
 
-def iter_marker_lines(marker, formula, strip=True):
-    """Extracts any markers from a given formula."""
+_markers_cache = {}
+
+
+def read_markers(formula, markers):
+    """
+    Returns the values of all lines starting with each of the given markers, as {marker: [values]}.
+
+    Results are memoized until the formula's modification time changes, so the properties
+    reading them don't rescan the file on every access.
+    """
+    mtime = os.stat(formula).st_mtime_ns
+    cache_key = (formula, tuple(markers))
+
+    cached = _markers_cache.get(cache_key)
+    if cached and cached[0] == mtime:
+        return cached[1]
 
+    values = dict((marker, []) for marker in markers)
     with open(formula) as f:
         for line in f:
-            if line.startswith(marker):
+            for marker in markers:
+                if line.startswith(marker):
+                    values[marker].append(line[len(marker):].strip())
 
-                if strip:
-                    line = line[len(marker):]
-                    line = line.strip()
+    _markers_cache[cache_key] = (mtime, values)
+    return values
 
-                yield line
+
+def split_deps(line):
+    """Splits a Build Deps marker value on both space and comma."""
+    return [dep for dep in re.split(r'[ ,]+', line) if dep]
 
 
 def mkdir_p(path):
@@ -47,42 +75,353 @@ def mkdir_p(path):
             raise
 
 
-def archive_tree(dir, archive):
-    """Creates a tar.gz archive from a given directory."""
-    with tarfile.open(archive, 'w:gz') as tar:
-        # do not tar.add(dir) with empty arcname, that will create a "/" entry and tar will complain when extracting
-        for item in os.listdir(dir):
-            tar.add(dir+"/"+item, arcname=item)
-
-
-def extract_tree(archive, dir):
-    """Extract tar.gz archive to a given directory."""
-    with tarfile.open(archive, 'r:gz') as tar:
-        def is_within_directory(directory, target):
-            
-            abs_directory = os.path.abspath(directory)
-            abs_target = os.path.abspath(target)
-        
-            prefix = os.path.commonprefix([abs_directory, abs_target])
-            
-            return prefix == abs_directory
-        
-        def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-        
-            for member in tar.getmembers():
-                member_path = os.path.join(path, member.name)
-                if not is_within_directory(path, member_path):
-                    raise Exception("Attempted Path Traversal in Tar File")
-        
-            tar.extractall(path, members, numeric_owner=numeric_owner) 
-            
-        
-        safe_extract(tar, dir)
+# Old build directories are moved into siblings with this prefix (and the pid of the bob process) to be deleted.
+TRASH_PREFIX = '.bob-trash-'
+
+
+def reset_dir(path):
+    """
+    Empties a directory (creating it if needed) without waiting for its old contents to be deleted.
+
+    The directory is renamed into a trash directory next to it, which is atomic on the same
+    filesystem, and a background process deletes the trash while the caller carries on.
+    Trash left behind by earlier runs that died before it was gone is deleted as well.
+    """
+    path = os.path.normpath(path)
+    parent = os.path.dirname(path)
+    sweep_trash(parent)
+
+    if os.path.lexists(path):
+        try:
+            trash = tempfile.mkdtemp(prefix='{}{}-'.format(TRASH_PREFIX, os.getpid()), dir=parent)
+            os.rename(path, os.path.join(trash, os.path.basename(path)))
+        except OSError:
+            # e.g. a mount point, or a parent we may not write to
+            shutil.rmtree(path)
+        else:
+            delete_in_background(trash)
+
+    mkdir_p(path)
+
+
+def delete_in_background(path):
+    # a process rather than a thread, so it finishes even if bob exits first
+    subprocess.Popen(['rm', '-rf', '--', path], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def sweep_trash(dir):
+    """Deletes trash directories in dir whose bob process is gone, in the background."""
+    try:
+        names = os.listdir(dir)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        if not name.startswith(TRASH_PREFIX):
+            continue
+        try:
+            pid = int(name[len(TRASH_PREFIX):].split('-')[0])
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            delete_in_background(os.path.join(dir, name))
+        except (ValueError, PermissionError):
+            # not ours, or a process of another user that is still running
+            pass
+
+
+def archive_tree(dir, archive, codec='gzip', threads=None, exclude=None):
+    """Creates a compressed tar archive from a given directory.
+
+    The archive may be a path or a writable file object; codec is one of the names in compression.CODECS.
+    exclude is a snapshot (see snapshot_tree) of entries to leave out, unless they have changed since;
+    directories are then only archived if they are new or contain something archived.
+    Returns the paths that were left out.
+    """
+    if isinstance(archive, str):
+        with open(archive, 'wb') as f:
+            return archive_tree(dir, f, codec=codec, threads=threads, exclude=exclude)
+
+    with CODECS[codec].writer(archive, threads=threads) as compressed:
+        with tarfile.open(fileobj=compressed, mode='w|') as tar:
+            if exclude is None:
+                # do not tar.add(dir) with empty arcname, that will create a "/" entry and tar will complain when extracting
+                for item in os.listdir(dir):
+                    tar.add(dir+"/"+item, arcname=item)
+                return []
+
+            current = snapshot_tree(dir)
+            excluded = [path for path, entry in current.items() if exclude.get(path) == entry]
+            included = set(current).difference(excluded)
+
+            # keep the directories leading to anything archived
+            for path in list(included):
+                parent = os.path.dirname(path)
+                while parent and parent not in included:
+                    included.add(parent)
+                    parent = os.path.dirname(parent)
+
+            # sorted, parents come before their contents
+            for path in sorted(included):
+                tar.add(os.path.join(dir, path), arcname=path, recursive=False)
+            return sorted(path for path in excluded if current[path][0] != 'd' or path not in included)
+
+
+def snapshot_tree(dir):
+    """
+    Returns {relative path: signature} for everything below a directory.
+
+    Signatures are ('f', size, mode, mtime in ns) for files, ('l', target) for symlinks and ('d',) for
+    directories, so they change whenever an entry is replaced or modified.
+    """
+    snapshot = {}
+    for root, dirs, files in os.walk(dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            info = os.lstat(path)
+            if stat.S_ISLNK(info.st_mode):
+                # os.walk() lists symlinks to directories with the directories
+                entry = ('l', os.readlink(path))
+            elif stat.S_ISDIR(info.st_mode):
+                entry = ('d',)
+            else:
+                entry = ('f', info.st_size, info.st_mode, info.st_mtime_ns)
+            snapshot[os.path.relpath(path, dir)] = entry
+    return snapshot
+
+
+# Regular files up to this size are read into memory and written by a pool thread, when extracting with threads.
+THREADED_WRITE_MAX_SIZE = 1024 * 1024
+
+
+def member_path(name):
+    """Returns a member name normalized relative to the extraction directory, or None if it would escape it."""
+    name = os.path.normpath(name)
+    if os.path.isabs(name) or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+
+class ExtractionGuard(object):
+    """
+    Validates tar members just before they are extracted into dir.
+
+    Members must stay inside dir, may not be devices or FIFOs, and may not be written through a
+    symlink the archive itself created: tar.add() never archives a path below a symlink, so only
+    a crafted archive would. Symlinks already in dir (say lib64 -> lib, from an earlier dependency)
+    are replaced by a real directory where the archive needs one, as merge_tree() does. Relative
+    symlinks may not point out of dir; absolute ones are allowed, as build trees are installed at
+    an absolute build path. Hardlinks must point to a regular file already extracted.
+
+    Only directories and symlinks are remembered, so memory use grows with the number of those in
+    the archive, not with the number of members.
+    """
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.checked_dirs = {'.'}
+        self.links = set()
+
+    def check_dir(self, name, member_name):
+        """Makes sure the directory name is a real directory, or can be created as one."""
+        if name in self.links:
+            raise Exception("Tar File member {} would be written through a symlink".format(member_name))
+
+        path = os.path.join(self.dir, name)
+        if os.path.islink(path):
+            os.remove(path)
+
+    def check_parent(self, name):
+        """Makes sure every directory above the member is a real directory, creating missing ones."""
+        parent = os.path.dirname(name) or '.'
+        if parent in self.checked_dirs:
+            return
+
+        self.check_parent(parent)
+        self.check_dir(parent, name)
+        os.makedirs(os.path.join(self.dir, parent), exist_ok=True)
+        self.checked_dirs.add(parent)
+
+    def check(self, member):
+        """Returns the path to extract member to, after validating it."""
+        name = member_path(member.name)
+        if name is None or name == '.':
+            raise Exception("Attempted Path Traversal in Tar File")
+        if member.ischr() or member.isblk() or member.isfifo():
+            raise Exception("Tar File contains the device or FIFO {}".format(member.name))
+
+        self.check_parent(name)
+        path = os.path.join(self.dir, name)
+
+        if member.issym() and not os.path.isabs(member.linkname):
+            if member_path(os.path.join(os.path.dirname(name), member.linkname)) is None:
+                raise Exception("Tar File symlink {} points outside of the archive".format(member.name))
+
+        if member.islnk():
+            target = member_path(member.linkname)
+            if target is None:
+                raise Exception("Tar File hardlink {} points outside of the archive".format(member.name))
+            # files extracted from the archive are in directories it checked; os.link() would
+            # follow a symlink, and link whatever it points to into the tree
+            target_path = os.path.join(self.dir, target)
+            extracted = (os.path.dirname(target) or '.') in self.checked_dirs and os.path.isfile(target_path)
+            if not extracted or os.path.islink(target_path):
+                raise Exception("Tar File hardlink {} does not point to an extracted file".format(member.name))
+
+        if member.isdir():
+            self.check_dir(name, member.name)
+            self.checked_dirs.add(name)
+        elif os.path.islink(path):
+            # a later member replaces an earlier one; writing to the existing symlink would follow it
+            os.unlink(path)
+            self.links.discard(name)
+
+        if member.issym():
+            self.links.add(name)
+
+        return path
+
+
+def _write_file(tar, member, path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    tar.chown(member, path, numeric_owner=False)
+    tar.chmod(member, path)
+    tar.utime(member, path)
+
+
+def extract_tree(archive, dir, threads=None):
+    """Extract a compressed tar archive to a given directory, detecting its codec.
+
+    The archive may be a path or a readable file object (such as a streaming S3 response body).
+    It is read exactly once, and each member is validated (see ExtractionGuard) just before it is
+    extracted. With threads > 1, small files are written by a pool of threads while the archive is
+    still being decompressed, which helps archives of many thousands of small files.
+    """
+    if isinstance(archive, str):
+        with open(archive, 'rb') as f:
+            return extract_tree(f, dir, threads=threads)
+
+    codec, archive = detect_codec(archive)
+    guard = ExtractionGuard(dir)
+    # extraction filters are applied by the guard; newer Pythons would otherwise reject absolute symlinks
+    trusted = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+
+    pool = ThreadPoolExecutor(max_workers=threads) if threads and threads > 1 else None
+    # bounds the file contents held in memory for the pool
+    slots = threading.BoundedSemaphore(threads * 4) if pool else None
+    writes = []
+
+    def wait_for_writes():
+        for write in writes:
+            write.result()
+        del writes[:]
+
+    try:
+        with codec.reader(archive) as decompressed, tarfile.open(fileobj=decompressed, mode='r|') as tar:
+            directories = []
+
+            while True:
+                member = tar.next()
+                if member is None:
+                    break
+                # the stream is read only once, so the TarInfo objects tarfile keeps around are of no use
+                tar.members = []
+
+                if member.islnk() and writes:
+                    # the link target may still be being written
+                    wait_for_writes()
+
+                if member.isdir() and member_path(member.name) == '.':
+                    # archives made with `tar -C dir .` have an entry for the directory itself
+                    continue
+                path = guard.check(member)
+
+                if member.isdir():
+                    # like extractall(), set directory attributes only once their contents are in place
+                    os.makedirs(path, exist_ok=True)
+                    directories.append((path, member.mode, member.mtime, member.uid, member.gid, member.uname, member.gname))
+                elif pool and member.isreg() and member.size <= THREADED_WRITE_MAX_SIZE:
+                    data = tar.extractfile(member).read()
+                    slots.acquire()
+                    write = pool.submit(_write_file, tar, member, path, data)
+                    write.add_done_callback(lambda _: slots.release())
+                    writes.append(write)
+
+                    if len(writes) > threads * 16:
+                        # surface errors early, and keep the list short
+                        for write in [write for write in writes if write.done()]:
+                            write.result()
+                            writes.remove(write)
+                else:
+                    tar.extract(member, dir, set_attrs=True, **trusted)
+
+            wait_for_writes()
+
+            directories.sort(reverse=True)
+            for path, mode, mtime, uid, gid, uname, gname in directories:
+                member = tarfile.TarInfo()
+                member.mode, member.mtime, member.uid, member.gid, member.uname, member.gname = mode, mtime, uid, gid, uname, gname
+                tar.chown(member, path, numeric_owner=False)
+                tar.utime(member, path)
+                tar.chmod(member, path)
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+
+def tree_size(dir):
+    """Returns the total size of the regular files below a directory, not following symlinks."""
+    size = 0
+    for root, dirs, files in os.walk(dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+    return size
+
+
+def merge_tree(src, dst, place=os.replace):
+    """
+    Moves the contents of directory src into directory dst, replacing any existing entries.
+
+    place(source, target) puts each file and symlink into place, over anything already at target
+    that isn't a directory; the default moves them, see layers.LayerStore for other ways.
+    """
+    directories = []
+
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+
+        for name in list(dirs):
+            source, target = os.path.join(root, name), os.path.join(target_root, name)
+            if os.path.islink(source):
+                # os.walk() lists symlinks to directories here, but they move like files
+                dirs.remove(name)
+                files.append(name)
+                continue
+
+            if not os.path.isdir(target) or os.path.islink(target):
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.mkdir(target)
+            directories.append((source, target))
+
+        for name in files:
+            source, target = os.path.join(root, name), os.path.join(target_root, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            place(source, target)
+
+    for source, target in reversed(directories):
+        shutil.copystat(source, target)
+
 
 # get a key, or the highest matching (as in software version) key if it contains wildcards
 # e.g. get_with_wildcard("foobar/dep-1.2.3.tar.gz") fetches that version
 # e.g. get_with_wildcard("foobar/dep-1.2.*.tar.gz") fetches the "latest" matching
-def get_with_wildcard(bucket, name):
+# with an index (see index.KeyIndex), wildcards are resolved against its local listing instead of listing S3
+def get_with_wildcard(bucket, name, index=None):
     parts = name.partition("*")
     
     if not parts[1]: # no "*" in name
@@ -95,6 +434,15 @@ def get_with_wildcard(bucket, name):
                 return None
             raise
     
+    if index:
+        match = index.lookup(bucket, name)
+        if not match:
+            return None
+        ret = bucket.Object(match[0])
+        # the listing already told us what a HEAD request would, so skip it
+        ret.meta.data = {'ETag': match[1], 'ContentLength': match[2]}
+        return ret
+
     firstparts = bucket.objects.filter(Prefix=parts[0]) # use anything before "*" as the prefix for S3 listing
     matches = [i for i in firstparts if fnmatchcase(i.key, name)] # fnmatch entire name with wildcard against found keys in S3 - prefix for "dep-1.2.*.tar.gz" was "dep-1.2", but there might be a "dep-1.2.3.sig" or whatnot
     # natsorted will sort correctly by version parts, even if the element is something like "dep-1.2.3.tar.gz"
@@ -112,18 +460,64 @@ class S3ConnectionHandler(object):
     boto finds in the environment don't permit access to the bucket, or when boto was
     unable to find any credentials at all.
 
+    Nothing is imported or probed until the first bucket is requested. With a cache_path,
+    the outcome of the credential check and of each bucket's probe is remembered for ttl
+    seconds, per set of credential settings in the environment, so that later invocations
+    skip those requests entirely.
+
     Returns a named tuple containing a boto3 Bucket resource object and an anonymous mode indicator.
     """
 
     buckets = {}
-    all_anon = True
+    all_anon = None
 
-    def __init__(self):
-        sts = boto3.client('sts')
-        try:
-            sts.get_caller_identity()
-            self.all_anon = False
-        except NoCredentialsError:
+    # environment variables that decide which credentials (and endpoints) boto ends up using
+    scope_variables = ['AWS_ACCESS_KEY_ID', 'AWS_PROFILE', 'AWS_SHARED_CREDENTIALS_FILE', 'AWS_CONFIG_FILE',
+                       'AWS_ENDPOINT_URL', 'AWS_ENDPOINT_URL_S3', 'AWS_ENDPOINT_URL_STS']
+
+    def __init__(self, cache_path=None, ttl=0):
+        self.decisions_path = None
+        self.decisions = {'checked_at': time.time(), 'authenticated': None, 'buckets': {}}
+
+        if cache_path and ttl > 0:
+            scope = '\0'.join(os.environ.get(name, '') for name in self.scope_variables)
+            digest = hashlib.sha256(scope.encode('utf-8')).hexdigest()
+            self.decisions_path = os.path.join(cache_path, 'connections', '{}.json'.format(digest))
+
+            try:
+                with open(self.decisions_path) as f:
+                    decisions = json.load(f)
+                if time.time() - decisions['checked_at'] < ttl:
+                    self.decisions = decisions
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def save_decisions(self):
+        if not self.decisions_path:
+            return
+
+        mkdir_p(os.path.dirname(self.decisions_path))
+        temp_path = '{}.{}.tmp'.format(self.decisions_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(self.decisions, f)
+        os.replace(temp_path, self.decisions_path)
+
+    def check_credentials(self):
+        if self.all_anon is not None:
+            return
+
+        if self.decisions['authenticated'] is None:
+            import boto3
+            sts = boto3.client('sts')
+            try:
+                sts.get_caller_identity()
+                self.decisions['authenticated'] = True
+            except NoCredentialsError:
+                self.decisions['authenticated'] = False
+            self.save_decisions()
+
+        self.all_anon = not self.decisions['authenticated']
+        if self.all_anon:
             print_stderr('No AWS credentials found. Requests will be made without authentication.',
                          title='WARNING')
 
@@ -131,6 +525,11 @@ class S3ConnectionHandler(object):
         if name in self.buckets:
             return self.buckets[name]
 
+        import boto3
+        from botocore import UNSIGNED
+        from botocore.config import Config
+
+        self.check_credentials()
         if self.all_anon:
             force_anon = True
 
@@ -140,21 +539,31 @@ class S3ConnectionHandler(object):
 
         s3 = boto3.resource('s3', config=config)
 
-        try:
-            # see if the bucket exists
-            s3.meta.client.head_bucket(Bucket=name)
-        except ClientError as e:
-            if e.response['Error']['Code'] == "403":
-                # we got a 403 on the HEAD request, but that doesn't mean we don't have access at all
-                # just that we cannot perform a HEAD
-                # if we're currently authenticated, then we fall back to anonymous, since we'll just want to try GETs on objects and bucket listings
-                # otherwise, we'll just have to bubble through to the end, and see what happens on subsequent GETs
-                if not force_anon:
-                    print_stderr('Access denied for bucket "{}" using found credentials. '
-                                 'Retrying as an anonymous user.'.format(name), title='NOTICE')
-                    return self.get_bucket(name, region_name=region_name, force_anon=True)
-            else:
-                raise
+        known_anon = self.decisions['buckets'].get(name)
+        if known_anon and not force_anon:
+            return self.get_bucket(name, region_name=region_name, force_anon=True)
+
+        if known_anon is None:
+            try:
+                # see if the bucket exists
+                s3.meta.client.head_bucket(Bucket=name)
+            except ClientError as e:
+                if e.response['Error']['Code'] == "403":
+                    # we got a 403 on the HEAD request, but that doesn't mean we don't have access at all
+                    # just that we cannot perform a HEAD
+                    # if we're currently authenticated, then we fall back to anonymous, since we'll just want to try GETs on objects and bucket listings
+                    # otherwise, we'll just have to bubble through to the end, and see what happens on subsequent GETs
+                    if not force_anon:
+                        print_stderr('Access denied for bucket "{}" using found credentials. '
+                                     'Retrying as an anonymous user.'.format(name), title='NOTICE')
+                        self.decisions['buckets'][name] = True
+                        self.save_decisions()
+                        return self.get_bucket(name, region_name=region_name, force_anon=True)
+                else:
+                    raise
+
+            self.decisions['buckets'][name] = force_anon
+            self.save_decisions()
 
         self.buckets[name] = Bucket(s3.Bucket(name), anon=force_anon)
         return self.buckets[name]
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from tempfile import mkstemp
+from urllib.parse import urlsplit
+
+from botocore.exceptions import ClientError
+from natsort import natsorted
+
+from .utils import mkdir_p, print_stderr
+
+# How often, in seconds, a worker with nothing to claim looks at the queue again.
+POLL_INTERVAL = 5
+
+# Where a formula ends up once a worker is done with it; each is a directory of the run.
+STATUSES = ('succeeded', 'failed', 'skipped')
+
+
+class FileBackend(object):
+    """
+    Keeps the objects of a work queue as files below a directory.
+
+    For workers on one machine (and tests); a directory on a network filesystem works as long as
+    it has atomic hard links and working flock().
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def read(self, key):
+        """Returns an object's contents and version, or (None, None) if it doesn't exist."""
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None
+        return data, hashlib.sha256(data).hexdigest()
+
+    def _temp_file(self, key, data):
+        mkdir_p(os.path.dirname(self.path(key)))
+        fd, temp_path = mkstemp(prefix='.partial-', dir=os.path.dirname(self.path(key)))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return temp_path
+
+    def write(self, key, data):
+        os.replace(self._temp_file(key, data), self.path(key))
+        return hashlib.sha256(data).hexdigest()
+
+    def create(self, key, data):
+        """Writes an object unless it exists; returns its version, or None if it existed."""
+        temp_path = self._temp_file(key, data)
+        try:
+            # unlike rename, link fails if the target exists
+            os.link(temp_path, self.path(key))
+            return hashlib.sha256(data).hexdigest()
+        except FileExistsError:
+            return None
+        finally:
+            os.remove(temp_path)
+
+    def replace(self, key, data, version):
+        """Overwrites an object if it's still at the given version; returns the new version, or None if it wasn't."""
+        with open(os.path.join(os.path.dirname(self.path(key)), '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.read(key)[1] != version:
+                return None
+            return self.write(key, data)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        """Returns the keys of all objects below a prefix ending in a slash."""
+        keys = []
+        for root, dirs, files in os.walk(self.path(prefix.rstrip('/'))):
+            for name in files:
+                if not name.startswith('.'):
+                    keys.append('/'.join(os.path.relpath(os.path.join(root, name), self.root).split(os.sep)))
+        return keys
+
+
+class S3Backend(object):
+    """Keeps the objects of a work queue below a prefix in an S3 bucket, using conditional writes for leases."""
+
+    # what S3 answers when a conditional write loses, or races another one
+    CONFLICTS = ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409')
+
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def read(self, key):
+        try:
+            response = self.bucket.Object(self.prefix + key).get()
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return None, None
+        return response['Body'].read(), response['ETag']
+
+    def _put(self, key, data, **conditions):
+        try:
+            return self.bucket.meta.client.put_object(
+                Bucket=self.bucket.name, Key=self.prefix + key, Body=data, **conditions)['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in self.CONFLICTS:
+                raise
+            return None
+
+    def write(self, key, data):
+        return self._put(key, data)
+
+    def create(self, key, data):
+        return self._put(key, data, IfNoneMatch='*')
+
+    def replace(self, key, data, version):
+        return self._put(key, data, IfMatch=version)
+
+    def delete(self, key):
+        self.bucket.Object(self.prefix + key).delete()
+
+    def list(self, prefix):
+        return [obj.key[len(self.prefix):] for obj in self.bucket.objects.filter(Prefix=self.prefix + prefix)]
+
+
+def source_digest(full_path):
+    """Returns a hash of a formula script and its lockfile, to tell whether workers build what was submitted."""
+    digest = hashlib.sha256()
+    for path in [full_path, '{}.lock'.format(full_path)]:
+        try:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        except FileNotFoundError:
+            pass
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class WorkQueue(object):
+    """
+    A build plan shared by workers on any number of machines through a FileBackend or S3Backend.
+
+    `plan.json` lists the formulas of the current run, with the formulas of the run each depends
+    on and a digest of its script. Everything else of a run lives under `runs/<id>/`: a worker
+    claims a formula whose dependencies all succeeded by creating its lease in `leases/` (which
+    only one worker can), keeps the lease alive by rewriting its expiry every lease_time / 3
+    seconds, and finally records the outcome in `succeeded/`, `failed/` or `skipped/`. A lease
+    that expired, because its worker died or lost its connection, is taken over by the next
+    worker that finds it, through a write conditional on the lease being unchanged.
+
+    Lease expiry times come from the clocks of the workers, which need to be roughly in sync.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def submit(self, formulas, graph, selected, deploy_args=()):
+        """Writes a new plan for the selected formulas, replacing the current run; returns the plan."""
+        plan = {
+            'id': '{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8]),
+            'created_at': time.time(),
+            'deploy_args': list(deploy_args),
+            'formulas': dict((path, {
+                'deps': natsorted(graph.requires[path] & set(selected)),
+                'digest': source_digest(formulas[path].full_path),
+            }) for path in selected),
+        }
+
+        # workers of the old run notice the new plan and stop claiming
+        self.backend.write('plan.json', json.dumps(plan, indent=2, sort_keys=True).encode('utf-8'))
+        for key in self.backend.list('runs/'):
+            if not key.startswith('runs/{}/'.format(plan['id'])):
+                self.backend.delete(key)
+
+        return plan
+
+    def plan(self):
+        data, _ = self.backend.read('plan.json')
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def outcomes(self, run):
+        """Returns {formula: status} for the formulas of a run that are done."""
+        outcomes = {}
+        for key in self.backend.list('runs/{}/'.format(run)):
+            status, _, path = key.split('/', 2)[2].partition('/')
+            if status in STATUSES:
+                outcomes[path[:-len('.json')]] = status
+        return outcomes
+
+    def lease_key(self, run, path):
+        return 'runs/{}/leases/{}.json'.format(run, path)
+
+    def claim(self, run, path, worker, lease_time):
+        """Takes the lease for a formula; returns the Lease, or None if another worker holds it."""
+        key = self.lease_key(run, path)
+        lease = Lease(self, key, worker, lease_time)
+        lease.version = self.backend.create(key, lease.render())
+        if lease.version:
+            return lease
+
+        data, version = self.backend.read(key)
+        if data is None:
+            # released in the meantime, because it was finished
+            return None
+
+        held = json.loads(data.decode('utf-8'))
+        if held['expires_at'] > time.time():
+            return None
+
+        lease.version = self.backend.replace(key, lease.render(), version)
+        if not lease.version:
+            return None
+        print_stderr('Took over the expired lease on {} from {}.'.format(path, held['worker']), title='NOTICE')
+        return lease
+
+    def finish(self, run, path, status, **details):
+        details.update(status=status, finished_at=time.time())
+        self.backend.write('runs/{}/{}/{}.json'.format(run, status, path), json.dumps(details).encode('utf-8'))
+        self.backend.delete(self.lease_key(run, path))
+
+
+class Lease(object):
+    """A worker's claim on a formula, renewed by a background thread until released."""
+
+    def __init__(self, queue, key, worker, lease_time):
+        self.queue = queue
+        self.key = key
+        self.worker = worker
+        self.lease_time = lease_time
+        self.version = None
+        self.lost = threading.Event()
+        self.released = threading.Event()
+
+    def render(self):
+        # the token makes every write differ, so a version never comes back
+        return json.dumps({'worker': self.worker, 'expires_at': time.time() + self.lease_time,
+                           'token': uuid.uuid4().hex}).encode('utf-8')
+
+    def renew(self):
+        """Pushes the expiry out; returns False if the lease was taken over."""
+        version = self.queue.backend.replace(self.key, self.render(), self.version)
+        if not version:
+            return False
+        self.version = version
+        return True
+
+    def keep_alive(self, on_lost):
+        """Renews the lease until released, calling on_lost() if another worker took it over."""
+        def heartbeat():
+            while not self.released.wait(self.lease_time / 3.0):
+                try:
+                    renewed = self.renew()
+                except (ClientError, OSError) as e:
+                    # try again next time; the lease lasts for two more heartbeats
+                    print_stderr('Could not renew the lease {}: {}'.format(self.key, e), title='WARNING')
+                    continue
+                if not renewed:
+                    self.lost.set()
+                    on_lost()
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        return thread
+
+    def release(self):
+        self.released.set()
+
+
+class Worker(object):
+    """
+    Claims and deploys the formulas of a WorkQueue's plan, one at a time, until none are left.
+
+    Each formula is deployed by a `bob deploy` process, the same as with build-all. Formulas
+    depending on one that failed are recorded as skipped. Every worker checks at start that its
+    workspace has the formulas of the plan as they were submitted.
+    """
+
+    def __init__(self, queue, formulas, lease_time=60):
+        self.queue = queue
+        self.formulas = formulas
+        self.lease_time = lease_time
+        self.name = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def check_workspace(self, plan):
+        """Returns the formulas of the plan that are missing or different in the worker's workspace."""
+        return natsorted(path for path, entry in plan['formulas'].items()
+                         if path not in self.formulas or source_digest(self.formulas[path].full_path) != entry['digest'])
+
+    def run(self, plan):
+        """Works on the plan until all of its formulas are done; returns whether they all succeeded."""
+        run = plan['id']
+        entries = plan['formulas']
+        built = 0
+
+        while True:
+            current = self.queue.plan()
+            if not current or current['id'] != run:
+                print_stderr('Run {} was replaced by a new plan, stopping.'.format(run), title='NOTICE')
+                return False
+
+            outcomes = self.queue.outcomes(run)
+            pending = natsorted(path for path in entries if path not in outcomes)
+            if not pending:
+                counts = dict((status, sum(1 for s in outcomes.values() if s == status)) for status in STATUSES)
+                print_stderr('Run {} is done: {succeeded} succeeded, {failed} failed, {skipped} skipped; '
+                             '{built} built by this worker.'.format(run, built=built, **counts))
+                return counts['succeeded'] == len(entries)
+
+            lease = None
+            for path in pending:
+                deps = [outcomes.get(dep) for dep in entries[path]['deps']]
+                if any(status in ('failed', 'skipped') for status in deps):
+                    self.queue.finish(run, path, 'skipped', worker=self.name)
+                    outcomes[path] = 'skipped'
+                    print_stderr('[{}] skipped, a dependency failed'.format(path))
+                    continue
+                if any(status != 'succeeded' for status in deps):
+                    continue
+
+                lease = self.queue.claim(run, path, self.name, self.lease_time)
+                # another worker may have finished it between listing and claiming
+                if lease and path in self.queue.outcomes(run):
+                    lease.release()
+                    lease = None
+                if lease:
+                    break
+
+            if not lease:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            self.deploy(run, path, lease, plan['deploy_args'])
+            built += 1
+
+    def deploy(self, run, path, lease, deploy_args):
+        print_stderr('[{}] claimed by {}'.format(path, self.name))
+        args = [sys.executable, '-m', 'bob', 'deploy', path] + deploy_args
+        p = subprocess.Popen(args)
+
+        def stop():
+            print_stderr('[{}] lost the lease to another worker, stopping the build'.format(path), title='WARNING')
+            p.terminate()
+
+        lease.keep_alive(on_lost=stop)
+        try:
+            returncode = p.wait()
+        finally:
+            lease.release()
+
+        if lease.lost.is_set():
+            # the worker that took over records the outcome
+            return
+
+        status = 'succeeded' if returncode == 0 else 'failed'
+        self.queue.finish(run, path, status, worker=self.name, returncode=returncode)
+        if returncode == 0:
+            print_stderr('[{}] deployed'.format(path))
+        else:
+            print_stderr('[{}] failed with exit status {}'.format(path, returncode))
+
+
+def open_queue(url, get_bucket):
+    """
+    Returns the WorkQueue at a file:///path or s3://bucket/prefix URL.
+
+    get_bucket(name) returns a utils.Bucket; raises ValueError for other URLs and anonymous buckets.
+    """
+    parts = urlsplit(url)
+    if parts.scheme == 'file':
+        return WorkQueue(FileBackend(parts.path))
+
+    if parts.scheme == 's3' and parts.netloc:
+        bucket = get_bucket(parts.netloc)
+        if bucket.anon:
+            raise ValueError('Workers need credentials that can write to the bucket {}.'.format(parts.netloc))
+        prefix = parts.path.lstrip('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return WorkQueue(S3Backend(bucket.bucket, prefix))
+
+    raise ValueError('Unsupported work queue URL {}, use file:///path or s3://bucket/prefix.'.format(url))
@@ -13,6 +13,11 @@ setup(
     name='bob-builder',
     version='0.0.20',
     install_requires=deps,
+    # shutdown(cancel_futures=True), os.waitstatus_to_exitcode(), os.pidfd_open() and socket.send_fds()
+    python_requires='>=3.9',
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     description='Binary Build Toolkit.',
     # long_description='Meh.',/
     author='Heroku',
@@ -22,7 +27,7 @@ setup(
     license='MIT',
     entry_points={
         'console_scripts': [
-            'bob = bob:cli.dispatch',
+            'bob = bob.client:dispatch',
         ],
     }
 )
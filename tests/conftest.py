@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import boto3
+import pytest
+
+from bob.utils import S3ConnectionHandler
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    """An empty S3 bucket (a boto3 Bucket resource) in an in-process moto stand-in."""
+    moto = pytest.importorskip('moto')
+
+    for name in ['AWS_ENDPOINT_URL', 'AWS_PROFILE', 'AWS_SESSION_TOKEN', 'AWS_SECURITY_TOKEN']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    # buckets are shared by every S3ConnectionHandler of the process, and tied to a session
+    monkeypatch.setattr(S3ConnectionHandler, 'buckets', {})
+    monkeypatch.setattr(S3ConnectionHandler, 'all_anon', None)
+
+    with moto.mock_aws():
+        boto3.setup_default_session()
+        yield boto3.resource('s3').create_bucket(Bucket='bob-test')
+    boto3.DEFAULT_SESSION = None
+
+
+class Workspace(object):
+    """A workspace of formulas, with bob.models configured to build them against a moto bucket."""
+
+    def __init__(self, path, bucket):
+        self.path = path
+        self.bucket = bucket
+
+    def add(self, name, deps=(), build_path=None, script='echo building'):
+        """Writes a formula declaring deps (and build_path); returns its full path."""
+        full_path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        lines = ['#!/usr/bin/env bash']
+        if deps:
+            lines.append('# Build Deps: {}'.format(' '.join(deps)))
+        if build_path:
+            lines.append('# Build Path: {}'.format(build_path))
+        with open(full_path, 'w') as f:
+            f.write('\n'.join(lines + [script]) + '\n')
+        os.chmod(full_path, 0o755)
+        return full_path
+
+    def deploy(self, key, body=b'archive', **metadata):
+        """Puts an object into the bucket, as if a formula had been deployed to it."""
+        self.bucket.put_object(Key=key, Body=body, Metadata=metadata)
+        return self.bucket.Object(key)
+
+
+@pytest.fixture
+def workspace(tmp_path, bucket, monkeypatch):
+    from bob import models
+
+    path = str(tmp_path / 'workspace')
+    os.makedirs(path)
+    settings = {
+        'WORKSPACE': path, 'CACHE_DIR': str(tmp_path / 'cache'), 'HISTORY_PATH': '',
+        'S3_BUCKET': bucket.name, 'S3_PREFIX': '', 'UPSTREAM_S3_BUCKET': None,
+        'ARCHIVE_CODEC': 'gzip', 'TRANSITIVE_DEPS': False, 'EXCLUDE_DEPS': False, 'FINGERPRINT_ENV': [],
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(models, name, value)
+    return Workspace(path, bucket)
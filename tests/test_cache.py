@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import pytest
+
+from bob.cache import PARTIAL_MAX_AGE, PARTIAL_PREFIX, ArtifactCache
+from bob.transfer import TransferSettings
+
+
+def fetch(cache, key, size=-1):
+    """Reads an object through the cache; returns what was read and whether it was a hit."""
+    opened = cache.open(key, TransferSettings())
+    with opened as f:
+        return f.read(size), opened.hit
+
+
+def test_miss_then_hit(tmp_path, bucket):
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'archive')
+    cache = ArtifactCache(str(tmp_path), max_size=1024)
+
+    assert fetch(cache, bucket.Object('libraries/a.tar.gz')) == (b'archive', False)
+    assert fetch(cache, bucket.Object('libraries/a.tar.gz')) == (b'archive', True)
+    assert cache.stats() == (1, len(b'archive'))
+
+
+def test_stores_the_whole_object_when_the_reader_stops_early(tmp_path, bucket):
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'archive and trailing padding')
+    cache = ArtifactCache(str(tmp_path), max_size=1024)
+
+    assert fetch(cache, bucket.Object('libraries/a.tar.gz'), 7) == (b'archive', False)
+    assert fetch(cache, bucket.Object('libraries/a.tar.gz')) == (b'archive and trailing padding', True)
+
+
+def test_changed_object_is_not_served_stale(tmp_path, bucket):
+    cache = ArtifactCache(str(tmp_path), max_size=1024)
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'old')
+    fetch(cache, bucket.Object('libraries/a.tar.gz'))
+
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'new')
+    assert fetch(cache, bucket.Object('libraries/a.tar.gz')) == (b'new', False)
+
+
+def test_failed_read_stores_nothing(tmp_path, bucket):
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'archive')
+    cache = ArtifactCache(str(tmp_path), max_size=1024)
+
+    with pytest.raises(ValueError):
+        with cache.open(bucket.Object('libraries/a.tar.gz'), TransferSettings()) as f:
+            f.read(3)
+            raise ValueError('extraction failed')
+
+    assert cache.stats() == (0, 0)
+    assert os.listdir(os.path.join(str(tmp_path), 'archives')) == []
+
+
+def test_prune_evicts_least_recently_used(tmp_path, bucket):
+    cache = ArtifactCache(str(tmp_path), max_size=1000)
+    for name in ['a', 'b', 'c']:
+        bucket.put_object(Key=name, Body=name.encode('utf-8') * 400)
+    paths = dict((name, cache.entry_path('bob-test', name, bucket.Object(name).e_tag)) for name in ['a', 'b', 'c'])
+
+    fetch(cache, bucket.Object('a'))
+    fetch(cache, bucket.Object('b'))
+    # a was used after b
+    os.utime(paths['b'], (time.time() - 20, time.time() - 20))
+    assert fetch(cache, bucket.Object('a'))[1]
+
+    # storing c evicts b
+    fetch(cache, bucket.Object('c'))
+    assert sorted(entry[0] for entry in cache.entries()) == sorted([paths['a'], paths['c']])
+    assert cache.prune(max_size=400) == (1, 400)
+    assert [entry[0] for entry in cache.entries()] == [paths['c']]
+
+
+def test_prune_sweeps_interrupted_downloads(tmp_path):
+    cache = ArtifactCache(str(tmp_path), max_size=1000)
+    archives = os.path.join(str(tmp_path), 'archives')
+    os.makedirs(archives)
+
+    for name, size in [('entry.archive', 600), (PARTIAL_PREFIX + 'stale', 100), (PARTIAL_PREFIX + 'fresh', 500)]:
+        with open(os.path.join(archives, name), 'wb') as f:
+            f.write(b'x' * size)
+    stale = time.time() - PARTIAL_MAX_AGE - 1
+    os.utime(os.path.join(archives, PARTIAL_PREFIX + 'stale'), (stale, stale))
+
+    # the download still being written pushes the cache over its size
+    assert cache.prune() == (2, 700)
+    assert os.listdir(archives) == [PARTIAL_PREFIX + 'fresh']
+
+
+def test_disabled_cache_stores_nothing(tmp_path, bucket):
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'archive')
+    cache = ArtifactCache(str(tmp_path), max_size=0)
+
+    assert fetch(cache, bucket.Object('libraries/a.tar.gz')) == (b'archive', False)
+    assert fetch(cache, bucket.Object('libraries/a.tar.gz')) == (b'archive', False)
+    assert not os.path.exists(os.path.join(str(tmp_path), 'archives'))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from bob.ccache import COMPILERS, CompilerCache, cache_name
+from bob.compression import CODECS
+from bob.transfer import TransferSettings
+from bob.utils import Bucket
+
+
+def compiler_cache(tmp_path, machine, bucket=None):
+    cache = CompilerCache('runtimes/python', str(tmp_path / machine / 'ccache'), str(tmp_path / machine / 'state'),
+                          max_size=64 * 1024 * 1024, bucket=bucket and (lambda: Bucket(bucket)), prefix='ccache/',
+                          codec=CODECS['gzip'], transfer=TransferSettings())
+    # stands in for ccache itself, which only --cleanup and --show-stats are run with here
+    cache.ccache = '/bin/true'
+    return cache
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def test_cache_name():
+    assert cache_name('runtimes/python-3.8.1') == 'runtimes/python'
+    assert cache_name('libraries/libffi') == 'libraries/libffi'
+
+
+def test_wrappers_live_outside_the_cache(tmp_path):
+    cache = compiler_cache(tmp_path, 'a')
+    cache.restore()
+
+    assert sorted(os.listdir(cache.wrapper_path)) == sorted(COMPILERS)
+    assert os.readlink(os.path.join(cache.wrapper_path, 'gcc')) == '/bin/true'
+    assert not cache.wrapper_path.startswith(cache.path)
+    assert cache.environment('/tmp/build')['PATH'].split(os.pathsep)[0] == cache.wrapper_path
+
+
+def test_contents_ignore_what_cache_hits_rewrite(tmp_path):
+    cache = compiler_cache(tmp_path, 'a')
+    write(os.path.join(cache.path, '0', '1', 'objectM'), 'object')
+    contents = cache.contents()
+
+    write(os.path.join(cache.path, '0', 'stats'), 'hits 1')
+    write(os.path.join(cache.path, '0', '1', 'objectM.lock'), '')
+    write(os.path.join(cache.path, 'tmp', 'partial'), 'partial')
+    assert cache.contents() == contents
+
+    write(os.path.join(cache.path, '0', '2', 'objectR'), 'result')
+    assert cache.contents() != contents
+
+
+def test_snapshots_are_uploaded_when_changed_and_restored_when_newer(tmp_path, bucket, capsys):
+    cache = compiler_cache(tmp_path, 'a', bucket)
+    cache.restore()
+    write(os.path.join(cache.path, '0', '1', 'objectM'), 'object')
+    cache.save()
+
+    snapshot = bucket.Object('ccache/runtimes/python.tar.gz')
+    etag = snapshot.e_tag
+    assert cache.load_state()['etag'] == etag
+
+    write(os.path.join(cache.path, '0', 'stats'), 'hits 1')
+    cache.save()
+    assert 'unchanged, not uploading it' in capsys.readouterr().err
+    snapshot.reload()
+    assert snapshot.e_tag == etag
+
+    other = compiler_cache(tmp_path, 'b', bucket)
+    other.restore()
+    with open(os.path.join(other.path, '0', '1', 'objectM')) as f:
+        assert f.read() == 'object'
+    assert other.load_state()['etag'] == etag
+    assert 'Restored the compiler cache' in capsys.readouterr().err
+
+    # already in sync
+    other.restore()
+    assert 'Restored the compiler cache' not in capsys.readouterr().err
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import boto3
+import pytest
+
+from bob import cli
+
+
+@pytest.fixture
+def s3_calls(workspace, monkeypatch):
+    """Points the CLI at the workspace; returns the S3 operations made, as a list filled as they are."""
+    from bob import models
+
+    for name in ['WORKSPACE', 'CACHE_DIR', 'S3_BUCKET']:
+        monkeypatch.setattr(cli, name, getattr(models, name))
+    monkeypatch.setattr(cli, 'S3_REGION', None)
+
+    calls = []
+    boto3.DEFAULT_SESSION.events.register('before-call.s3', lambda model, **kwargs: calls.append(model.name))
+    return calls
+
+
+def test_status_lists_each_directory_once(workspace, s3_calls, capsys):
+    for name in ['libraries/a', 'libraries/b', 'libraries/c', 'runtimes/x']:
+        workspace.add(name)
+    workspace.deploy('libraries/a.tar.gz', b'a')
+    workspace.deploy('libraries/b.tar.gz', b'bb', **{'bob-fingerprint': 'stale'})
+
+    cli.status(as_json=True)
+
+    rows = dict((row['formula'], row) for row in json.loads(capsys.readouterr().out))
+    assert [path for path, row in sorted(rows.items()) if row['deployed']] == ['libraries/a', 'libraries/b']
+    assert rows['libraries/b']['size'] == 2 and rows['libraries/b']['changed'] is None
+    assert s3_calls.count('ListObjectsV2') == 2
+    assert 'HeadObject' not in s3_calls
+
+
+def test_status_checks_fingerprints_on_request(workspace, s3_calls, capsys):
+    from bob.models import Formula
+
+    workspace.add('libraries/a')
+    workspace.add('libraries/b')
+    workspace.deploy('libraries/a.tar.gz', **{'bob-fingerprint': Formula('libraries/a').fingerprint})
+    workspace.deploy('libraries/b.tar.gz', **{'bob-fingerprint': 'stale'})
+    del s3_calls[:]
+
+    cli.status(['libraries/*'], check_fingerprints=True)
+
+    out = capsys.readouterr().out
+    assert 'changed' in out.splitlines()[2] and 'libraries/b' in out.splitlines()[2]
+    assert '2 of 2 formulas deployed, 1 of them changed since.' in out
+    assert s3_calls.count('HeadObject') == 2
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+
+import pytest
+
+from bob import cli, daemon
+from bob.daemon import BuildServer, Request
+from bob.models import BUILD_PATH_MARKER
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = BuildServer(str(tmp_path / 'bob.sock'), BUILD_PATH_MARKER, cli.__doc__)
+    server.listen()
+    yield server
+    for conn in list(server.reading):
+        server.drop(conn)
+    server.listener.close()
+
+
+def step(server):
+    """Handles whatever the daemon's sockets have ready, as one turn of serve_forever()."""
+    for key, _ in server.selector.select(timeout=1):
+        key.data(key.fileobj)
+
+
+def connect(server):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(server.path)
+    step(server)
+    return client
+
+
+def test_build_path_of_the_requested_formula(server, tmp_path):
+    workspace = tmp_path / 'formulas'
+    (workspace / 'libraries').mkdir(parents=True)
+    (workspace / 'libraries' / 'x').write_text('#!/bin/sh\n# Build Path: /app/vendor/x\n')
+    (workspace / 'libraries' / 'y').write_text('#!/bin/sh\n')
+    env = {'WORKSPACE_DIR': 'formulas', 'DEFAULT_BUILD_PATH': '/app/default'}
+
+    def build_path(*argv):
+        return server.build_path(Request(None, list(argv), env, str(tmp_path), ()))
+
+    assert build_path('deploy', '--name', 'foo', 'libraries/x') == '/app/vendor/x'
+    assert build_path('build', 'libraries/y') == '/app/default'
+    assert build_path('build', 'libraries/missing') is None
+    assert build_path('build', '--no-such-option') is None
+
+
+def test_requests_are_read_without_blocking(server):
+    slow = connect(server)
+    request = json.dumps({'argv': ['status'], 'env': {}, 'cwd': '/'}).encode('utf-8') + b'\n'
+    socket.send_fds(slow, [request[:10]], [0, 1, 2])
+    step(server)
+
+    # another client gets its answer while the first one is still sending
+    fast = connect(server)
+    socket.send_fds(fast, [request], [0, 1, 2])
+    step(server)
+    assert 'only runs build and deploy' in json.loads(fast.recv(4096).decode('utf-8'))['error']
+
+    slow.sendall(request[10:])
+    step(server)
+    assert 'error' in json.loads(slow.recv(4096).decode('utf-8'))
+    assert not server.reading and not server.waiting
+
+
+def test_incomplete_requests_are_dropped(server, monkeypatch):
+    fds_before = len(os.listdir('/proc/self/fd'))
+    gone = connect(server)
+    socket.send_fds(gone, [b'{"argv": '], [0, 1, 2])
+    step(server)
+    gone.close()
+    step(server)
+
+    stale = connect(server)
+    socket.send_fds(stale, [b'{"argv": '], [0, 1, 2])
+    step(server)
+    monkeypatch.setattr(daemon, 'REQUEST_TIMEOUT', -1)
+    server.drop_stale()
+
+    assert not server.reading
+    assert stale.recv(4096) == b''
+    stale.close()
+    # the client's streams are closed again
+    assert len(os.listdir('/proc/self/fd')) == fds_before
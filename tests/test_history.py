@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from bob.history import BuildHistory, find_regressions, percentile
+from bob.report import BuildReport
+
+
+def record(history, formula, command, wall_time, artifact_size=None, succeeded=True, skipped=False):
+    report = BuildReport(formula)
+    report.started_at -= wall_time
+    report.details.update(command=command, artifact_size=artifact_size, build_size=artifact_size and artifact_size * 2)
+    if skipped:
+        report.details['skipped'] = True
+    report.add('build', wall_time)
+    history.record(report, succeeded=succeeded)
+
+
+def test_builds_are_grouped_by_formula_and_command(tmp_path):
+    history = BuildHistory(str(tmp_path / 'history' / 'history.sqlite'))
+    # each build is recorded as having started wall_time ago
+    record(history, 'libraries/a', 'deploy', 3, artifact_size=100)
+    record(history, 'libraries/a', 'build', 1)
+    record(history, 'libraries/a', 'deploy', 2, artifact_size=100)
+    record(history, 'libraries/a', 'deploy', 9, succeeded=False)
+    record(history, 'libraries/a', 'deploy', 0, skipped=True)
+    record(history, 'libraries/b', 'build', 1)
+
+    builds = history.builds()
+    assert list(builds) == [('libraries/a', 'build'), ('libraries/a', 'deploy'), ('libraries/b', 'build')]
+    deploys = builds[('libraries/a', 'deploy')]
+    assert [round(row['wall_time']) for row in deploys] == [3, 2]
+    assert deploys[0]['compression_ratio'] == 2
+    assert [phase['name'] for phase in history.phases(deploys[0]['id'])] == ['build']
+
+    assert list(history.builds('libraries/b')) == [('libraries/b', 'build')]
+
+
+def test_find_regressions_against_the_rolling_median():
+    builds = [{'id': i, 'wall_time': wall_time, 'artifact_size': None}
+              for i, wall_time in enumerate([10, 11, 100, 10, 12, 20, 12])]
+
+    regressions = find_regressions(builds, window=3, threshold=0.25)
+
+    # the first three builds have no baseline; 100 only skews the median, not the baseline of 20
+    assert [(build['id'], label, value, baseline) for build, label, value, baseline in regressions] == [
+        (5, 'duration', 20, 12)]
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    assert percentile([1, 2, 3, 4], 100) == 4
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+from bob.index import KeyIndex
+
+
+def deploy(bucket, *keys):
+    for key in keys:
+        bucket.put_object(Key=key, Body=key.encode('utf-8'))
+
+
+def test_lookup_picks_the_highest_version(tmp_path, bucket):
+    deploy(bucket, 'libraries/x-1.9.tar.gz', 'libraries/x-1.10.tar.gz', 'libraries/x-1.11.tar.gz.sig', 'libraries/y-2.0.tar.gz')
+    index = KeyIndex(str(tmp_path), ttl=300)
+
+    key, etag, size, last_modified = index.lookup(bucket, 'libraries/x-*.tar.gz')
+    assert (key, etag, size) == ('libraries/x-1.10.tar.gz', bucket.Object(key).e_tag, len(key))
+    assert last_modified == bucket.Object(key).last_modified.timestamp()
+    assert index.lookup(bucket, 'libraries/z-*.tar.gz') is None
+
+
+def test_listings_are_reused_until_they_expire(tmp_path, bucket):
+    deploy(bucket, 'libraries/x-1.0.tar.gz')
+    KeyIndex(str(tmp_path), ttl=300).lookup(bucket, 'libraries/x-*.tar.gz')
+    deploy(bucket, 'libraries/x-1.1.tar.gz')
+
+    assert KeyIndex(str(tmp_path), ttl=300).lookup(bucket, 'libraries/x-*.tar.gz')[0] == 'libraries/x-1.0.tar.gz'
+    assert KeyIndex(str(tmp_path), ttl=300, refresh=True).lookup(bucket, 'libraries/x-*.tar.gz')[0] == 'libraries/x-1.1.tar.gz'
+
+    # the refresh was saved for the next process
+    deploy(bucket, 'libraries/x-1.2.tar.gz')
+    assert KeyIndex(str(tmp_path), ttl=300).lookup(bucket, 'libraries/x-*.tar.gz')[0] == 'libraries/x-1.1.tar.gz'
+    assert KeyIndex(str(tmp_path), ttl=0).lookup(bucket, 'libraries/x-*.tar.gz')[0] == 'libraries/x-1.2.tar.gz'
+
+
+def test_listings_are_kept_per_directory(tmp_path, bucket):
+    deploy(bucket, 'libraries/x-1.0.tar.gz', 'runtimes/python-3.8.tar.gz')
+    index = KeyIndex(str(tmp_path), ttl=300)
+    index.lookup(bucket, 'libraries/x-*.tar.gz')
+
+    listings = []
+    for name in os.listdir(str(tmp_path)):
+        with open(os.path.join(str(tmp_path), name)) as f:
+            listings.append(json.load(f))
+    assert [(listing['prefix'], [entry[0] for entry in listing['keys']]) for listing in listings] == [
+        ('libraries/', ['libraries/x-1.0.tar.gz'])]
+
+
+def test_entries_lists_each_directory_once(tmp_path, bucket, monkeypatch):
+    deploy(bucket, 'a.tar.gz', 'libraries/x.tar.gz', 'libraries/sub/y.tar.gz', 'runtimes/z.tar.gz')
+    index = KeyIndex(str(tmp_path), ttl=300)
+
+    listed = []
+    listing = index.listing
+    monkeypatch.setattr(index, 'listing', lambda bucket, prefix: listed.append(prefix) or listing(bucket, prefix))
+
+    found = index.entries(bucket, ['libraries/x.tar.gz', 'libraries/sub/y.tar.gz', 'libraries/missing.tar.gz', 'runtimes/z.tar.gz'])
+    assert sorted(found) == ['libraries/sub/y.tar.gz', 'libraries/x.tar.gz', 'runtimes/z.tar.gz']
+    assert found['runtimes/z.tar.gz'][1] == bucket.Object('runtimes/z.tar.gz').e_tag
+    # libraries/sub/ is part of the libraries/ listing
+    assert sorted(listed) == ['libraries/', 'runtimes/']
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from bob import jobs
+from bob.jobs import JOBSERVER_ENV, Jobserver, available_cpus, cgroup_cpu_quota, inherited_jobserver, job_environment
+
+
+@pytest.fixture
+def cgroup(tmp_path, monkeypatch):
+    """Points the cgroup files at tmp_path; returns a function writing them, None leaving one out."""
+    paths = {name: str(tmp_path / name) for name in ['cpu.max', 'cpu.cfs_quota_us', 'cpu.cfs_period_us']}
+    monkeypatch.setattr(jobs, 'CGROUP_V2_CPU_MAX', paths['cpu.max'])
+    monkeypatch.setattr(jobs, 'CGROUP_V1_CPU_QUOTA', paths['cpu.cfs_quota_us'])
+    monkeypatch.setattr(jobs, 'CGROUP_V1_CPU_PERIOD', paths['cpu.cfs_period_us'])
+
+    def write(**files):
+        for name, value in files.items():
+            with open(paths[name.replace('_', '.', 1)], 'w') as f:
+                f.write(value + '\n')
+    return write
+
+
+@pytest.mark.parametrize('files, cpus', [
+    ({}, None),
+    ({'cpu_max': 'max 100000'}, None),
+    ({'cpu_max': '150000 100000'}, 2),
+    ({'cpu_max': '50000 100000'}, 1),
+    ({'cpu_cfs_quota_us': '-1', 'cpu_cfs_period_us': '100000'}, None),
+    ({'cpu_cfs_quota_us': '400000', 'cpu_cfs_period_us': '100000'}, 4),
+    ({'cpu_cfs_quota_us': 'garbage', 'cpu_cfs_period_us': '100000'}, None),
+])
+def test_cgroup_cpu_quota(cgroup, files, cpus):
+    cgroup(**files)
+    assert cgroup_cpu_quota() == cpus
+
+
+def test_available_cpus_are_capped_by_the_quota(cgroup):
+    cgroup(cpu_max='100000 100000')
+    assert available_cpus() == 1
+
+
+def test_jobserver_tokens_are_inherited(monkeypatch):
+    jobserver = Jobserver(3)
+    try:
+        assert os.read(jobserver.fds[0], 10) == b'+++'
+        assert not any(os.get_inheritable(fd) for fd in jobserver.fds)
+
+        monkeypatch.setenv(JOBSERVER_ENV, jobserver.environment()[JOBSERVER_ENV])
+        assert inherited_jobserver() == jobserver.fds
+    finally:
+        jobserver.close()
+
+    # closed, or never passed on
+    assert inherited_jobserver() is None
+    monkeypatch.setenv(JOBSERVER_ENV, 'garbage')
+    assert inherited_jobserver() is None
+    monkeypatch.delenv(JOBSERVER_ENV)
+    assert inherited_jobserver() is None
+
+
+def test_job_environment(monkeypatch):
+    monkeypatch.delenv('MAKEFLAGS', raising=False)
+    assert job_environment(4) == {'BOB_JOBS': '4', 'MAKEFLAGS': '-j4'}
+    assert job_environment(4, (5, 6)) == {'BOB_JOBS': '4', 'MAKEFLAGS': '-j --jobserver-fds=5,6'}
+
+    monkeypatch.setenv('MAKEFLAGS', '-j1')
+    assert job_environment(4) == {'BOB_JOBS': '4'}
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from bob.models import Formula, LockfileMismatch
+
+
+def test_dependency_deployed_with_another_codec(workspace):
+    workspace.add('app', deps=['libraries/x'])
+    workspace.deploy('libraries/x.tar.xz')
+
+    key_name, key, upstream = Formula('app').lookup_dep('libraries/x')
+    assert (key_name, key.key, upstream) == ('libraries/x.tar.gz', 'libraries/x.tar.xz', False)
+
+
+def test_wildcard_dependency_across_codecs(workspace):
+    workspace.add('app')
+    workspace.deploy('libraries/x-1.9.tar.gz')
+    workspace.deploy('libraries/x-1.10.tar.xz')
+    workspace.deploy('libraries/y-2.0.tar.xz')
+    workspace.deploy('libraries/y-2.0.tar.gz')
+
+    formula = Formula('app')
+    assert formula.lookup_dep('libraries/x-*')[1].key == 'libraries/x-1.10.tar.xz'
+    # the configured codec wins among equal versions
+    assert formula.lookup_dep('libraries/y-*')[1].key == 'libraries/y-2.0.tar.gz'
+
+
+def test_missing_dependency(workspace):
+    workspace.add('app')
+    assert Formula('app').lookup_dep('libraries/none') == ('libraries/none.tar.gz', None, False)
+
+
+def test_lockfile_pins_dependencies(workspace):
+    full_path = workspace.add('app', deps=['libraries/x-*'])
+    old = workspace.deploy('libraries/x-1.0.tar.gz', b'old')
+    Formula('app').lock()
+
+    with open(full_path + '.lock') as f:
+        locked = json.load(f)['deps']
+    assert [(entry['dep'], entry['key'], entry['etag']) for entry in locked] == [('libraries/x-*', 'libraries/x-1.0.tar.gz', old.e_tag)]
+
+    workspace.deploy('libraries/x-1.1.tar.gz', b'new')
+    formula = Formula('app')
+    formula.check_lock(formula.all_deps)
+    key_name, key, upstream = formula.lookup_dep('libraries/x-*')
+    assert (key.key, key.e_tag, key.content_length) == ('libraries/x-1.0.tar.gz', old.e_tag, 3)
+
+
+def test_lockfile_must_match_the_dependencies(workspace):
+    workspace.add('app', deps=['libraries/x'])
+    workspace.deploy('libraries/x.tar.gz')
+    Formula('app').lock()
+
+    workspace.add('app', deps=['libraries/x', 'libraries/y'])
+    formula = Formula('app')
+    with pytest.raises(LockfileMismatch, match='does not match the dependencies'):
+        formula.check_lock(formula.all_deps)
+
+
+def test_lockfile_must_match_the_bucket(workspace, monkeypatch):
+    from bob import models
+
+    workspace.add('app', deps=['libraries/x'])
+    workspace.deploy('libraries/x.tar.gz')
+    Formula('app').lock()
+
+    monkeypatch.setattr(models, 'S3_BUCKET', 'another-bucket')
+    formula = Formula('app')
+    with pytest.raises(LockfileMismatch, match='another-bucket'):
+        formula.check_lock(formula.all_deps)
+
+
+def test_transitive_deps_come_before_their_dependents(workspace, monkeypatch):
+    from bob import models
+
+    monkeypatch.setattr(models, 'TRANSITIVE_DEPS', True)
+    workspace.add('libraries/a')
+    workspace.add('libraries/b', deps=['libraries/a'])
+    workspace.add('libraries/c-1.0', deps=['libraries/a', 'libraries/deployed'])
+    # a second Build Deps line, and a wildcard resolving to a workspace formula
+    workspace.add('app', deps=['libraries/b'], script='# Build Deps: libraries/c-*\necho building')
+
+    assert Formula('app').depends_on == ['libraries/b', 'libraries/c-*']
+    assert Formula('app').all_deps == ['libraries/a', 'libraries/b', 'libraries/deployed', 'libraries/c-*']
+
+    monkeypatch.setattr(models, 'TRANSITIVE_DEPS', False)
+    assert Formula('app').all_deps == ['libraries/b', 'libraries/c-*']
+
+
+def test_transitive_deps_reject_cycles(workspace, monkeypatch, capsys):
+    from bob import models
+
+    monkeypatch.setattr(models, 'TRANSITIVE_DEPS', True)
+    workspace.add('libraries/a', deps=['libraries/b'])
+    workspace.add('libraries/b', deps=['libraries/a'])
+
+    with pytest.raises(SystemExit):
+        Formula('libraries/a').all_deps
+    assert 'libraries/a -> libraries/b -> libraries/a' in capsys.readouterr().err
+
+
+def test_fingerprint_covers_the_build_inputs(workspace, monkeypatch):
+    from bob import models
+
+    workspace.add('app', deps=['libraries/x'])
+    workspace.deploy('libraries/x.tar.gz', b'one')
+    fingerprint = Formula('app').fingerprint
+    assert Formula('app').fingerprint == fingerprint
+
+    changes = []
+    workspace.deploy('libraries/x.tar.gz', b'two')
+    changes.append(Formula('app').fingerprint)
+    workspace.add('app', deps=['libraries/x'], script='echo building differently')
+    changes.append(Formula('app').fingerprint)
+    monkeypatch.setattr(models, 'ARCHIVE_CODEC', 'xz')
+    changes.append(Formula('app').fingerprint)
+    monkeypatch.setattr(models, 'FINGERPRINT_ENV', ['STACK'])
+    monkeypatch.setenv('STACK', 'heroku-22')
+    changes.append(Formula('app').fingerprint)
+    monkeypatch.setenv('STACK', 'heroku-24')
+    changes.append(Formula('app').fingerprint)
+    changes.append(Formula('app', override_path='app-renamed').fingerprint)
+
+    assert len(set([fingerprint] + changes)) == len(changes) + 1
+
+
+def test_is_up_to_date_compares_the_deployed_fingerprint(workspace):
+    from bob.models import FINGERPRINT_METADATA
+
+    workspace.add('app')
+    assert not Formula('app').is_up_to_date()
+
+    workspace.deploy('app.tar.gz', **{FINGERPRINT_METADATA: 'stale'})
+    assert not Formula('app').is_up_to_date()
+
+    workspace.deploy('app.tar.gz', **{FINGERPRINT_METADATA: Formula('app').fingerprint})
+    assert Formula('app').is_up_to_date()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from bob.scheduler import BuildGraph, Scheduler, WorkspaceFormula, resolve_workspace_dep, scan_workspace
+
+DEPS_MARKER = '# Build Deps: '
+BUILD_PATH_MARKER = '# Build Path: '
+
+
+def graph(deps, build_paths=None):
+    """Builds a BuildGraph from {path: [deps]}, without a workspace on disk."""
+    build_paths = build_paths or {}
+    formulas = dict((path, WorkspaceFormula(path, '/workspace/' + path, path_deps, build_paths.get(path, '/app/.heroku')))
+                    for path, path_deps in deps.items())
+    return BuildGraph(formulas)
+
+
+def test_scan_workspace(tmp_path):
+    (tmp_path / 'libraries').mkdir()
+    (tmp_path / 'libraries' / 'a').write_text('#!/bin/sh\n')
+    (tmp_path / 'libraries' / 'b').write_text('#!/bin/sh\n# Build Deps: libraries/a\n# Build Path: /app/vendor\n')
+    (tmp_path / 'libraries' / 'b.lock').write_text('{}')
+    (tmp_path / 'libraries' / 'README').write_text('not a formula\n')
+    (tmp_path / '.git').mkdir()
+    (tmp_path / '.git' / 'hook').write_text('#!/bin/sh\n')
+
+    formulas = scan_workspace(str(tmp_path), DEPS_MARKER, BUILD_PATH_MARKER, '/app/.heroku')
+
+    assert sorted(formulas) == ['libraries/a', 'libraries/b']
+    assert formulas['libraries/a'].deps == [] and formulas['libraries/a'].build_path == '/app/.heroku'
+    assert formulas['libraries/b'].deps == ['libraries/a'] and formulas['libraries/b'].build_path == '/app/vendor'
+    assert formulas['libraries/b'].full_path == os.path.join(str(tmp_path), 'libraries', 'b')
+
+
+def test_resolve_workspace_dep():
+    formulas = dict.fromkeys(['libraries/x-1.9', 'libraries/x-1.10', 'libraries/y'])
+
+    assert resolve_workspace_dep(formulas, 'libraries/y') == 'libraries/y'
+    assert resolve_workspace_dep(formulas, 'libraries/x-*') == 'libraries/x-1.10'
+    assert resolve_workspace_dep(formulas, 'libraries/z') is None
+    assert resolve_workspace_dep(formulas, 'libraries/z-*') is None
+
+
+def test_graph_rejects_cycles():
+    with pytest.raises(ValueError, match='a -> b -> c -> a'):
+        graph({'a': ['b'], 'b': ['c'], 'c': ['a']})
+
+
+def test_graph_downstream_and_levels():
+    g = graph({'base': [], 'mid': ['base'], 'other': ['libraries/deployed'], 'top': ['mid', 'other']})
+
+    assert g.downstream(['mid']) == {'mid', 'top'}
+    assert g.downstream(['base']) == {'base', 'mid', 'top'}
+    assert g.levels(g.formulas) == [['base', 'other'], ['mid'], ['top']]
+    # unselected dependencies don't hold anything back
+    assert g.levels(['top', 'mid']) == [['mid'], ['top']]
+
+
+def test_scheduler_keeps_shared_build_paths_apart():
+    g = graph({'a': [], 'b': [], 'c': ['a']}, build_paths={'b': '/app/vendor'})
+    scheduler = Scheduler(g, ['a', 'b', 'c'])
+
+    assert scheduler.is_ready('a') and scheduler.is_ready('b') and not scheduler.is_ready('c')
+
+    scheduler.busy_paths.add('/app/.heroku')
+    scheduler.done.add('a')
+    assert not scheduler.is_ready('c') and scheduler.is_ready('b')
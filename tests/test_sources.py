@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.request import ProxyHandler, Request, build_opener
+
+import pytest
+
+from bob import sources
+from bob.sources import SourceProxy, SourceStore
+
+
+class Upstream(BaseHTTPRequestHandler):
+    """Serves files by path, with an ETag, answering If-None-Match with 304 Not Modified."""
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, self.headers.get('If-None-Match')))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+
+        body = self.server.files[self.path]
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    for name in ['http_proxy', 'HTTP_PROXY', 'no_proxy', 'NO_PROXY']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(sources, 'DOWNLOAD_ATTEMPTS', 1)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Upstream)
+    server.files, server.requests = {}, []
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_store_revalidates_with_upstream(tmp_path, upstream):
+    store = SourceStore(str(tmp_path), max_size=1024 * 1024)
+    upstream.files['/src.tar.gz'] = b'one'
+    url = upstream.url + '/src.tar.gz'
+
+    assert read(store.get(url)) == b'one'
+    assert read(store.get(url)) == b'one'
+    upstream.files['/src.tar.gz'] = b'two'
+    assert read(store.get(url)) == b'two'
+
+    etag = '"{}"'.format(hashlib.sha256(b'one').hexdigest()[:16])
+    assert upstream.requests == [('GET', '/src.tar.gz', None), ('GET', '/src.tar.gz', etag), ('GET', '/src.tar.gz', etag)]
+    assert store.stats()[0] == 2
+
+
+def test_store_uses_stored_source_when_upstream_is_down(tmp_path, upstream):
+    store = SourceStore(str(tmp_path), max_size=1024 * 1024)
+    upstream.files['/src.tar.gz'] = b'one'
+    url = upstream.url + '/src.tar.gz'
+    store.get(url)
+
+    upstream.shutdown()
+    upstream.server_close()
+    assert read(store.get(url)) == b'one'
+
+    with pytest.raises(URLError):
+        store.get(upstream.url + '/other.tar.gz')
+
+
+def test_store_pinned_sources(tmp_path, upstream):
+    store = SourceStore(str(tmp_path), max_size=1024 * 1024)
+    upstream.files['/src.tar.gz'] = upstream.files['/mirror/src.tar.gz'] = b'one'
+    sha256 = hashlib.sha256(b'one').hexdigest()
+
+    assert read(store.get(upstream.url + '/src.tar.gz', sha256)) == b'one'
+    # stored under its checksum, whatever the URL
+    assert read(store.get(upstream.url + '/mirror/src.tar.gz', sha256)) == b'one'
+    assert len(upstream.requests) == 1
+
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        store.get(upstream.url + '/mirror/src.tar.gz', hashlib.sha256(b'two').hexdigest())
+    with pytest.raises(HTTPError):
+        store.get(upstream.url + '/missing.tar.gz')
+    assert store.stats()[0] == 1
+
+
+def test_proxy_serves_from_the_store(tmp_path, upstream):
+    store = SourceStore(str(tmp_path), max_size=1024 * 1024)
+    upstream.files['/src.tar.gz'] = b'one'
+
+    with SourceProxy(store) as proxy:
+        opener = build_opener(ProxyHandler({'http': proxy.url}))
+        with opener.open(upstream.url + '/src.tar.gz') as response:
+            assert response.read() == b'one'
+
+        with opener.open(Request(upstream.url + '/src.tar.gz', method='HEAD')) as response:
+            assert response.headers['Content-Length'] == '3'
+            assert response.headers['ETag'] == '"{}"'.format(hashlib.sha256(b'one').hexdigest()[:16])
+
+        with pytest.raises(HTTPError) as e:
+            opener.open(upstream.url + '/missing.tar.gz')
+        assert e.value.code == 404
+
+    assert [request[:2] for request in upstream.requests] == [
+        ('GET', '/src.tar.gz'), ('HEAD', '/src.tar.gz'), ('GET', '/missing.tar.gz')]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from bob.transfer import MB, MultipartUploadWriter, RangedReader, TransferSettings, open_object
+
+
+def test_multipart_upload(bucket):
+    data = os.urandom(11 * MB + 123)
+    obj = bucket.Object('libraries/a.tar.gz')
+
+    with MultipartUploadWriter(obj, TransferSettings(part_size=5 * MB, concurrency=2),
+                               extra_args={'Metadata': {'bob-fingerprint': 'abc'}}) as writer:
+        for offset in range(0, len(data), 1000000):
+            writer.write(data[offset:offset + 1000000])
+
+    obj.load()
+    assert obj.get()['Body'].read() == data
+    assert obj.metadata == {'bob-fingerprint': 'abc'}
+    # three parts: 5 MB, 5 MB and the rest
+    assert obj.e_tag.strip('"').endswith('-3')
+
+
+def test_multipart_upload_of_nothing(bucket):
+    obj = bucket.Object('empty.tar.gz')
+    with MultipartUploadWriter(obj, TransferSettings()):
+        pass
+
+    assert obj.get()['Body'].read() == b''
+
+
+def test_failed_multipart_upload_is_aborted(bucket):
+    obj = bucket.Object('libraries/a.tar.gz')
+
+    with pytest.raises(ValueError):
+        with MultipartUploadWriter(obj, TransferSettings(part_size=5 * MB)) as writer:
+            writer.write(os.urandom(6 * MB))
+            raise ValueError('archiving failed')
+
+    assert list(bucket.objects.all()) == []
+    assert bucket.meta.client.list_multipart_uploads(Bucket=bucket.name).get('Uploads', []) == []
+
+
+def test_ranged_reads(bucket):
+    data = os.urandom(12 * MB + 5)
+    bucket.put_object(Key='libraries/a.tar.gz', Body=data)
+
+    reader = open_object(bucket.Object('libraries/a.tar.gz'), TransferSettings(part_size=5 * MB, concurrency=2))
+    assert isinstance(reader, RangedReader)
+    try:
+        chunks = [reader.read(4096), reader.read(3 * MB), reader.read()]
+    finally:
+        reader.close()
+
+    assert b''.join(chunks) == data
+    assert reader.read(10) == b''
+
+
+def test_small_objects_use_a_single_get(bucket):
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'archive')
+
+    reader = open_object(bucket.Object('libraries/a.tar.gz'), TransferSettings())
+    assert not isinstance(reader, RangedReader)
+    assert reader.read() == b'archive'
+    reader.close()
+
+
+def test_reporter_counts_bytes(bucket):
+    bucket.put_object(Key='libraries/a.tar.gz', Body=b'x' * 1000)
+    counted = []
+
+    reader = open_object(bucket.Object('libraries/a.tar.gz'), TransferSettings(), reporter=counted.append)
+    reader.read()
+    reader.close()
+
+    assert sum(counted) == 1000
+
+
+def test_part_size_has_the_s3_minimum():
+    assert TransferSettings(part_size=1).part_size == 5 * MB
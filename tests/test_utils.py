@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tarfile
+
+import pytest
+
+from bob.utils import extract_tree
+
+
+def crafted_archive(*members):
+    """Returns a gzipped tar of (TarInfo, contents or None) pairs, as a file object."""
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        for member, data in members:
+            if data is not None:
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+            else:
+                tar.addfile(member)
+    archive.seek(0)
+    return archive
+
+
+def entry(name, type=tarfile.REGTYPE, linkname=''):
+    member = tarfile.TarInfo(name)
+    member.type = type
+    member.linkname = linkname
+    member.mode = 0o755 if type == tarfile.DIRTYPE else 0o644
+    return member
+
+
+@pytest.mark.parametrize('members, error', [
+    ([(entry('../evil'), b'x')], 'Path Traversal'),
+    ([(entry('/tmp/evil'), b'x')], 'Path Traversal'),
+    ([(entry('link', tarfile.SYMTYPE, '../../evil'), None)], 'points outside of the archive'),
+    ([(entry('link', tarfile.SYMTYPE, '/tmp'), None), (entry('link/evil'), b'x')], 'written through a symlink'),
+    ([(entry('link', tarfile.SYMTYPE, '/tmp'), None), (entry('link', tarfile.DIRTYPE), None)], 'written through a symlink'),
+    ([(entry('link', tarfile.LNKTYPE, '../evil'), None)], 'points outside of the archive'),
+    ([(entry('link', tarfile.SYMTYPE, '/etc/passwd'), None), (entry('hardlink', tarfile.LNKTYPE, 'link'), None)],
+     'does not point to an extracted file'),
+    ([(entry('hardlink', tarfile.LNKTYPE, 'missing/file'), None)], 'does not point to an extracted file'),
+    ([(entry('dev', tarfile.CHRTYPE), None)], 'device or FIFO'),
+    ([(entry('fifo', tarfile.FIFOTYPE), None)], 'device or FIFO'),
+])
+def test_extract_rejects_malicious_members(tmp_path, members, error):
+    target = tmp_path / 'target'
+    target.mkdir()
+
+    with pytest.raises(Exception, match=error):
+        extract_tree(crafted_archive(*members), str(target))
+
+    assert sorted(os.listdir(str(tmp_path))) == ['target']
+
+
+def test_extract_replaces_symlink_instead_of_following_it(tmp_path):
+    target = tmp_path / 'target'
+    target.mkdir()
+    outside = tmp_path / 'outside'
+    outside.write_bytes(b'original')
+
+    extract_tree(crafted_archive((entry('file', tarfile.SYMTYPE, str(outside)), None), (entry('file'), b'replaced')), str(target))
+
+    assert outside.read_bytes() == b'original'
+    assert (target / 'file').read_bytes() == b'replaced'
+
+
+def test_extract_replaces_existing_symlinks_with_directories(tmp_path):
+    """An earlier dependency made lib64 a symlink; a later one has a real lib64 directory."""
+    target = tmp_path / 'target'
+    target.mkdir()
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+
+    extract_tree(crafted_archive((entry('lib', tarfile.DIRTYPE), None), (entry('lib/libfoo.so'), b'foo'),
+                                 (entry('lib64', tarfile.SYMTYPE, 'lib'), None)), str(target))
+    assert (target / 'lib64' / 'libfoo.so').read_bytes() == b'foo'
+    os.symlink(str(outside), str(target / 'share'))
+
+    extract_tree(crafted_archive((entry('lib64', tarfile.DIRTYPE), None), (entry('lib64/libbar.so'), b'bar'),
+                                 (entry('share/doc'), b'doc')), str(target))
+
+    assert not (target / 'lib64').is_symlink() and not (target / 'share').is_symlink()
+    assert os.listdir(str(target / 'lib64')) == ['libbar.so']
+    assert (target / 'lib' / 'libfoo.so').read_bytes() == b'foo'
+    assert (target / 'share' / 'doc').read_bytes() == b'doc'
+    assert os.listdir(str(outside)) == []
+
+
+def test_extract_hardlinks(tmp_path):
+    target = tmp_path / 'target'
+    target.mkdir()
+
+    extract_tree(crafted_archive((entry('bin/tool'), b'tool'), (entry('bin/alias', tarfile.LNKTYPE, 'bin/tool'), None)),
+                 str(target))
+
+    assert os.path.samefile(str(target / 'bin' / 'tool'), str(target / 'bin' / 'alias'))
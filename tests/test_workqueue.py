@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from bob.scheduler import BuildGraph, WorkspaceFormula
+from bob.workqueue import FileBackend, WorkQueue
+
+
+def test_submit_and_finish(tmp_path):
+    (tmp_path / 'a').write_text('#!/bin/sh\n')
+    (tmp_path / 'b').write_text('#!/bin/sh\n')
+    formulas = {
+        'a': WorkspaceFormula('a', str(tmp_path / 'a'), [], '/app/.heroku'),
+        'b': WorkspaceFormula('b', str(tmp_path / 'b'), ['a', 'libraries/deployed'], '/app/.heroku'),
+    }
+    queue = WorkQueue(FileBackend(str(tmp_path / 'queue')))
+
+    old = queue.submit(formulas, BuildGraph(formulas), ['a'])
+    queue.finish(old['id'], 'a', 'failed')
+    plan = queue.submit(formulas, BuildGraph(formulas), ['a', 'b'], deploy_args=['--overwrite'])
+
+    assert queue.plan() == plan
+    assert plan['deploy_args'] == ['--overwrite']
+    assert plan['formulas']['b']['deps'] == ['a']
+    # the new plan replaced the old run
+    assert queue.outcomes(old['id']) == {}
+
+    lease = queue.claim(plan['id'], 'a', 'worker', lease_time=60)
+    queue.finish(plan['id'], 'a', 'succeeded', wall_time=1)
+    assert queue.outcomes(plan['id']) == {'a': 'succeeded'}
+    # finishing released the lease
+    assert not lease.renew()
+
+
+def test_lease_renew_fails_after_takeover(tmp_path):
+    queue = WorkQueue(FileBackend(str(tmp_path)))
+
+    held = queue.claim('run', 'libraries/a', 'first', lease_time=60)
+    assert held.renew()
+    assert queue.claim('run', 'libraries/a', 'second', lease_time=60) is None
+
+    # a worker that stopped renewing: its lease is already expired
+    stale = queue.claim('run', 'libraries/b', 'first', lease_time=-1)
+    taken = queue.claim('run', 'libraries/b', 'second', lease_time=60)
+    assert taken is not None
+
+    assert not stale.renew()
+    assert taken.renew()